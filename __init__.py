@@ -2,15 +2,19 @@ import bpy
 import blf
 import tempfile
 import os
-from .comfy_bridge import Connect, Disconnect, Connect_Info
+import time
+from bpy_extras.io_utils import ExportHelper
+from .comfy_bridge import Connect, Disconnect, Connect_Info, Telemetry
 from .event import EventMan
 from .utils import GetCameraVPMatrix, GetViewVector
 from .renderTool import CreateProjectionTexture
 from .cb_props import CBProps, ReceiverNameGroup, SenderNameGroup, ProjectionProps, SimpleNameGroup
 from .queue_prompt import ExecuteQueuePrompt, on_receiver_changed
+from .batch_queue import BatchQueue, Variant
 from .tmp_setting import TmpSetting
 from .gpu_baker import StartBake
 from .gpu_depth_normal import DepthNormalRenderer
+from .tasks import ShutdownBackground
 
 
 bl_info = {
@@ -33,21 +37,160 @@ class CBPreferences(bpy.types.AddonPreferences):
         default=17777,
     ) # type: ignore
 
+    servers: bpy.props.StringProperty(
+        name="More Servers",
+        description="Other ComfyUI-ComfyBridge servers as host:port, comma separated. Each prompt goes to the least busy connected one",
+        default="",
+    ) # type: ignore
+
+    backend: bpy.props.EnumProperty(
+        name="Backend",
+        description="How the client talks to ComfyUI-ComfyBridge",
+        items=(
+            ('thread', 'Threads', 'One thread each for connecting, sending and receiving'),
+            ('asyncio', 'asyncio', 'Everything runs on one asyncio event loop thread'),
+        ),
+        default='thread',
+    ) # type: ignore
+
+    raw_images: bpy.props.BoolProperty(
+        name="Raw Images",
+        description="Send depth/normal/lineart/mask as raw pixels instead of PNG when ComfyUI-ComfyBridge supports it",
+        default=True,
+    ) # type: ignore
+
+    image_codec: bpy.props.EnumProperty(
+        name="Codec",
+        description="Compression for raw pixels, only codecs both sides have can be used",
+        items=(
+            ('auto', 'Auto', 'Fastest codec both sides support'),
+            ('none', 'None', 'No compression, best for localhost'),
+            ('lz4', 'LZ4', 'Needs the lz4 module'),
+            ('zstd', 'Zstandard', 'Needs the zstandard module'),
+            ('zlib', 'zlib', 'Always available, slowest'),
+        ),
+        default='auto',
+    ) # type: ignore
+
+    upload_chunk: bpy.props.IntProperty(
+        name="Upload Chunk (KB)",
+        description="Large images are sent in chunks of this size so heartbeats are not blocked",
+        default=512, min=16, max=64 * 1024,
+    ) # type: ignore
+
+    upload_window: bpy.props.IntProperty(
+        name="Upload Window (MB)",
+        description="Bytes sent but not yet acknowledged by ComfyUI-ComfyBridge, 0 means no limit",
+        default=4, min=0, max=1024,
+    ) # type: ignore
+
+    shared_memory: bpy.props.BoolProperty(
+        name="Shared Memory",
+        description="When ComfyUI runs on this machine, hand images over through shared memory and a unix socket instead of TCP",
+        default=True,
+    ) # type: ignore
+
+    keep_result_files: bpy.props.BoolProperty(
+        name="Keep Result Files",
+        description="Write received images to the temp directory and load them from there, instead of decoding them in memory",
+        default=False,
+    ) # type: ignore
+
+    redraw_rate: bpy.props.IntProperty(
+        name="Progress Redraws/s",
+        description="At most this many viewport redraws per second for progress updates",
+        default=10, min=1, max=60,
+    ) # type: ignore
+
+    event_budget: bpy.props.IntProperty(
+        name="Event Budget (ms)",
+        description="Time each UI tick may spend handling bridge and bake events; the rest waits for the next tick so the viewport stays responsive",
+        default=8, min=1, max=100,
+        update=lambda self, context: EventMan.SetBudget(self.event_budget / 1000),
+    ) # type: ignore
+
+    trace_events: bpy.props.BoolProperty(
+        name="Trace Events",
+        description="Record when each add-on event is triggered, queued and handled, to export as a Chrome/Perfetto trace",
+        default=False,
+        update=lambda self, context: EventMan.StartTrace() if self.trace_events else EventMan.StopTrace(),
+    ) # type: ignore
+
+    capture_file: bpy.props.StringProperty(
+        name="Capture File",
+        description="Record every frame sent and received to this file, to replay it later with tools/replay_capture.py. Empty to turn off",
+        default="",
+        subtype='FILE_PATH',
+    ) # type: ignore
+
+    batch_in_flight: bpy.props.IntProperty(
+        name="Batch Prompts in Flight",
+        description="Queue Batch keeps at most this many prompts queued on ComfyUI while rendering the next variants",
+        default=2, min=1, max=16,
+    ) # type: ignore
+
     def draw(self, context):
         layout = self.layout
         layout.prop(self, "port", text="Port")
+        layout.prop(self, "servers")
+        layout.prop(self, "backend", text="Backend")
+        row = layout.row()
+        row.prop(self, "raw_images", text="Raw Images")
+        sub = row.row()
+        sub.enabled = self.raw_images
+        sub.prop(self, "image_codec", text="Codec")
+        row = layout.row()
+        row.prop(self, "upload_chunk")
+        row.prop(self, "upload_window")
+        layout.prop(self, "shared_memory")
+        layout.prop(self, "keep_result_files")
+        layout.prop(self, "redraw_rate")
+        layout.prop(self, "event_budget")
+        row = layout.row()
+        row.prop(self, "trace_events")
+        row.operator(ExportTraceOperator.bl_idname, text="Export Trace")
+        layout.prop(self, "batch_in_flight")
+        layout.prop(self, "capture_file")
+
+    def bridge_options(self):
+        return {
+            'raw_images': self.raw_images,
+            'codec': self.image_codec,
+            'upload_chunk': self.upload_chunk * 1024,
+            'upload_window': self.upload_window * 1024 * 1024,
+            'shared_memory': self.shared_memory,
+            'decode_images': not self.keep_result_files,
+            'capture': bpy.path.abspath(self.capture_file) if self.capture_file else '',
+        }
+
+    def extra_servers(self):
+        """
+        servers里写的[(host, port)], 没写端口的用port
+        """
+        servers = []
+        for item in self.servers.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            host, _, port = item.rpartition(':')
+            if not host or not port.isdigit():
+                host, port = item, self.port
+            servers.append((host, int(port)))
+        return servers
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return f'{seconds * 1000:.1f} ms'
+    return f'{seconds:.2f} s'
 
 def on_image_received(pack):
     cb_props = bpy.context.scene.comfy_bridge_props
-    tmp_dir = tempfile.gettempdir()
+    prefs = bpy.context.preferences.addons[__name__].preferences
     request_name = pack['name']
     image_data = pack['data']
-    file_path = os.path.join(tmp_dir, f'{request_name}.png')
+    decoded = pack.get('pixels')
 
     cb_props.progress = 0
-    
-    with open(file_path, 'wb') as f:
-        f.write(image_data)
 
     is_new = False
     if request_name not in bpy.data.images:
@@ -55,9 +198,15 @@ def on_image_received(pack):
         is_new = True
 
     image = bpy.data.images[request_name]
-    image.filepath = file_path
-    image.source = 'FILE'
-    image.reload()
+    if prefs.keep_result_files:
+        load_image_file(image, request_name, image_data)
+    elif decoded is not None:
+        load_image_pixels(image, decoded)
+    else:
+        # 解不了的(比如没有PIL时的16bit PNG)交给blender自己从内存里读
+        image.pack(data=bytes(image_data), data_len=len(image_data))
+        image.source = 'FILE'
+        image.reload()
 
     if is_new:
         if TmpSetting.space_2D:
@@ -69,6 +218,59 @@ def on_image_received(pack):
     if request_name in TmpSetting.request_names:
         TmpSetting.request_names.remove(request_name)
 
+def load_image_file(image, request_name, image_data):
+    file_path = os.path.join(tempfile.gettempdir(), f'{request_name}.png')
+    with open(file_path, 'wb') as f:
+        f.write(image_data)
+
+    if image.packed_file is not None:
+        image.unpack(method='REMOVE')
+    image.filepath = file_path
+    image.source = 'FILE'
+    image.reload()
+
+def load_image_pixels(image, decoded):
+    """
+    decoded是image_decode.DecodedImage, 后台线程已经解好了, 这里只做一次foreach_set
+    """
+    if image.packed_file is not None:
+        image.unpack(method='REMOVE')
+    if image.source != 'GENERATED':
+        image.source = 'GENERATED'
+        image.filepath = ''
+    # 改这几个会重新生成buffer, 一样的话就不动
+    if image.use_generated_float != decoded.is_float:
+        image.use_generated_float = decoded.is_float
+    if tuple(image.size) != (decoded.width, decoded.height):
+        image.generated_width = decoded.width
+        image.generated_height = decoded.height
+    image.pixels.foreach_set(decoded.pixels)
+    image.update()
+
+class ProgressRedraw:
+    '''
+    进度条每一步都重画3D视图太费了, 一秒最多重画redraw_rate次
+    中间被跳过的用timer补一次, 保证最后那个值能画出来
+    '''
+    last_redraw = 0.0
+
+    @classmethod
+    def request(cls):
+        prefs = bpy.context.preferences.addons[__name__].preferences
+        wait = cls.last_redraw + 1.0 / prefs.redraw_rate - time.monotonic()
+        if wait <= 0:
+            cls.redraw()
+        elif not bpy.app.timers.is_registered(cls.redraw):
+            bpy.app.timers.register(cls.redraw, first_interval=wait)
+
+    # timers按函数对象认, classmethod每次取到的都是新的bound method, 所以用staticmethod
+    @staticmethod
+    def redraw():
+        ProgressRedraw.last_redraw = time.monotonic()
+        if TmpSetting.area_3D:
+            TmpSetting.area_3D.tag_redraw()
+        return None
+
 def on_progress(args):
     if len(TmpSetting.request_names) == 0:
         return
@@ -78,21 +280,35 @@ def on_progress(args):
     value = _p / _m
     cb_props = bpy.context.scene.comfy_bridge_props
     cb_props.progress = value
+    ProgressRedraw.request()
 
-    if TmpSetting.area_3D:
-        TmpSetting.area_3D.tag_redraw()
+def on_upload_progress(args):
+    if len(TmpSetting.request_names) == 0:
+        return
+
+    _p = args['progress']
+    _m = args['max']
+    cb_props = bpy.context.scene.comfy_bridge_props
+    # 传完了就回到ExecuteQueuePrompt刚开始时的样子, 等comfyUI的PROGRESS
+    cb_props.progress = _p / _m if _p < _m else 0.01
+    ProgressRedraw.request()
 
 def do_connect():
     cb_props = bpy.context.scene.comfy_bridge_props
     EventMan.Add('on_image_received', on_image_received)
     EventMan.Add('on_progress', on_progress)
+    EventMan.Add('on_upload_progress', on_upload_progress)
     prefs = bpy.context.preferences.addons[__name__].preferences
+    EventMan.SetBudget(prefs.event_budget / 1000)
+    if prefs.trace_events and not EventMan.IsTracing():
+        EventMan.StartTrace()
+    EventMan.ResetStats()
     port = prefs.port
-    Connect(cb_props.server_host, port)
+    Connect(cb_props.server_host, port, prefs.backend, prefs.bridge_options(), prefs.extra_servers())
 
 @bpy.app.handlers.persistent
 def do_disconnect(dummy=None):
-    if not Connect_Info['isConnected']:
+    if not Connect_Info['isConnected'] and not Connect_Info['isReconnecting']:
         return
     
     print('disconnecting...')
@@ -101,7 +317,14 @@ def do_disconnect(dummy=None):
     cb_props.info = ''
     EventMan.Remove('on_image_received', on_image_received)
     EventMan.Remove('on_progress', on_progress)
+    EventMan.Remove('on_upload_progress', on_upload_progress)
+    if BatchQueue.current is not None:
+        BatchQueue.current.cancel()
     Disconnect()
+    stats = EventMan.Stats()
+    if stats['overruns']:
+        print(f"event ticks: {stats['overruns']}/{stats['busy_ticks']} over the {stats['budget'] * 1000:.0f}ms budget, "
+              f"slowest {stats['max_tick'] * 1000:.1f}ms, {stats['carried']} carried over")
 
 def is_in_camera(context):
     for area in context.window.screen.areas:
@@ -123,7 +346,7 @@ class ConnectOperator(bpy.types.Operator):
     
     def execute(self, context):
         cb_props = context.scene.comfy_bridge_props
-        if not Connect_Info['isConnected']:
+        if not Connect_Info['isConnected'] and not Connect_Info['isReconnecting']:
             cb_props.show_info = True
             do_connect()
             on_receiver_changed(context)
@@ -204,6 +427,11 @@ class QueuePromptOperator(bpy.types.Operator):
     def execute(self, context):
         if not Connect_Info['isConnected']:
             return {'FINISHED'} # 未连接则不执行
+        batch = BatchQueue.current
+        if batch is not None and batch.rendering is not None:
+            # 两边的渲染都走render_complete, 同时渲的话图会混到一起
+            self.report({'WARNING'}, 'A batch is rendering, try again when it is done')
+            return {'CANCELLED'}
         
         cb_props = context.scene.comfy_bridge_props
         senders = [item for item in cb_props.sender_list if item.enabled]
@@ -213,6 +441,67 @@ class QueuePromptOperator(bpy.types.Operator):
 
         return {'FINISHED'}
 
+class QueueBatchOperator(bpy.types.Operator):
+    bl_idname = "cb.queue_batch"
+    bl_label = "Queue Batch"
+    bl_description = "每个变体(选中的摄像机, 或者不同的seed)排一个prompt, 结果存到 接收名.变体名"
+
+    mode: bpy.props.EnumProperty(
+        items=(
+            ('CAMERAS', 'Selected Cameras', 'One prompt per selected camera'),
+            ('SEEDS', 'Seeds', 'One prompt per seed, needs ComfyBridge to support prompt params'),
+        ),
+        default='CAMERAS',
+    ) # type: ignore
+    seed: bpy.props.IntProperty(name="First Seed", default=0, min=0) # type: ignore
+    count: bpy.props.IntProperty(name="Count", default=4, min=1, max=256) # type: ignore
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        if not Connect_Info['isConnected']:
+            return {'FINISHED'} # 未连接则不执行
+
+        if self.mode == 'CAMERAS':
+            cameras = [obj for obj in context.selected_objects if obj.type == 'CAMERA']
+            variants = [Variant(camera.name, camera=camera) for camera in cameras]
+        else:
+            variants = [Variant(f'seed{seed}', params={'seed': seed}) for seed in range(self.seed, self.seed + self.count)]
+        if len(variants) == 0:
+            self.report({'WARNING'}, 'Select the cameras to render first')
+            return {'CANCELLED'}
+
+        cb_props = context.scene.comfy_bridge_props
+        prefs = context.preferences.addons[__name__].preferences
+        receivers = [item for item in cb_props.receiver_list if item.enabled]
+        error = BatchQueue(context, variants, receivers, prefs.batch_in_flight).start()
+        if error is not None:
+            self.report({'WARNING'}, error)
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+class CancelBatchOperator(bpy.types.Operator):
+    bl_idname = "cb.cancel_batch"
+    bl_label = "Cancel Batch"
+
+    def execute(self, context):
+        if BatchQueue.current is not None:
+            BatchQueue.current.cancel()
+        return {'FINISHED'}
+
+class ExportTraceOperator(bpy.types.Operator, ExportHelper):
+    bl_idname = "cb.export_event_trace"
+    bl_label = "Export Event Trace"
+    bl_description = "Write the recorded events as a trace JSON for chrome://tracing or ui.perfetto.dev"
+    filename_ext = ".json"
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'}) # type: ignore
+
+    def execute(self, context):
+        count = EventMan.ExportTrace(self.filepath)
+        self.report({'INFO'}, f"{count} trace records written to {self.filepath}")
+        return {'FINISHED'}
+
 class AddProjectionOperator(bpy.types.Operator):
     bl_idname = "cb.add_projection"
     bl_label = "Add Projection"
@@ -402,26 +691,79 @@ class ComfyBridgePanel(bpy.types.Panel):
         row.operator(TestOperator.bl_idname, text='', icon='VIEW3D')
         # row.operator('wm.url_open', text = '', icon = 'HOME').url = "https://github.com/robtl2/ComfyBridge-Blender-beta"
 
+    def draw_telemetry(self, layout, cb_props):
+        """
+        出图慢的时候看是卡在哪: heartbeat是网络, 到第一个PROGRESS是bridge, 到出图是comfyUI本身
+        """
+        col = layout.column()
+        row = col.row()
+        icon = 'DOWNARROW_HLT' if cb_props.show_telemetry else 'RIGHTARROW'
+        row.prop(cb_props, "show_telemetry", text="Connection Stats", emboss=False, icon=icon)
+        if not cb_props.show_telemetry:
+            return
+
+        stats = Telemetry()
+        if not stats:
+            return
+        box = col.box()
+        labels = (
+            ('heartbeat_rtt', 'Heartbeat RTT'),
+            ('queue_to_wire', 'Queue to wire'),
+            ('prompt_to_progress', 'Prompt to progress'),
+            ('prompt_to_image', 'Prompt to image'),
+            ('prompt_to_done', 'Prompt to done'),
+        )
+        for metric, label in labels:
+            summary = stats['latency'][metric]
+            row = box.row()
+            row.label(text=label)
+            if summary['count'] == 0:
+                row.label(text='-')
+            else:
+                row.label(text=f"{format_seconds(summary['p50'])} / p99 {format_seconds(summary['p99'])}")
+
+        sent = sum(counter['bytes_out'] for counter in stats['opcodes'].values())
+        received = sum(counter['bytes_in'] for counter in stats['opcodes'].values())
+        row = box.row()
+        row.label(text=f'Sent {sent / 1024 / 1024:.1f} MB')
+        row.label(text=f'Received {received / 1024 / 1024:.1f} MB')
+        if stats['replay_overflows']:
+            box.label(text=f"{stats['replay_overflows']} ops beyond the replay log", icon='ERROR')
+
     def draw(self, context):
         layout = self.layout
         cb_props = context.scene.comfy_bridge_props
 
         row = layout.row()
-        if not Connect_Info['isConnected']:
+        linked = Connect_Info['isConnected'] or Connect_Info['isReconnecting']
+        if not linked:
             row.prop(cb_props, 'server_host', text='ServerIP')
         else:
             info = f'Connected to {cb_props.server_host}'
+            if Connect_Info['servers'] is not None:
+                info += f' +{Connect_Info["servers"][1] - 1} ({Connect_Info["servers"][0]} up)'
+            elif Connect_Info['transport'] == 'unix':
+                info += ' (local)'
+            if Connect_Info['isReconnecting']:
+                info = f'Reconnecting to {cb_props.server_host}...'
             if Connect_Info['isClosing']:
                 info = ' Disconnecting...'
             row.label(text=info)
 
 
-        icon = "LINKED" if Connect_Info['isConnected'] else "UNLINKED"
-        row.operator(ConnectOperator.bl_idname, text='', icon=icon, depress=Connect_Info['isConnected'])
+        icon = "LINKED" if linked else "UNLINKED"
+        row.operator(ConnectOperator.bl_idname, text='', icon=icon, depress=linked)
 
         if Connect_Info['isConnected']:
             row = layout.row()
             row.operator(QueuePromptOperator.bl_idname, text=QueuePromptOperator.bl_label) 
+            if BatchQueue.current is None:
+                row.operator(QueueBatchOperator.bl_idname, text='', icon='RENDER_ANIMATION')
+            else:
+                row.operator(CancelBatchOperator.bl_idname, text='', icon='CANCEL')
+
+        if linked:
+            self.draw_telemetry(layout, cb_props)
 
         col = layout.column()
         row = col.row()
@@ -519,7 +861,7 @@ class ComfyBridgePanel(bpy.types.Panel):
                     col.operator(BakeTextureOperator.bl_idname, text="Bake")
                     
 classes = (
-    ComfyBridgePanel, QueuePromptOperator, TestOperator, CBPreferences, 
+    ComfyBridgePanel, QueuePromptOperator, QueueBatchOperator, CancelBatchOperator, TestOperator, CBPreferences, ExportTraceOperator,
     ConnectOperator, SenderOperator, ReceiverOperator, Resume_CameraOperator,
     AddProjectionOperator, BakeTextureOperator, RemoveProjectionOperator,
     SenderList, ReceiverList, SimpleNameGroup,
@@ -605,6 +947,7 @@ def register():
 
 def unregister():
     do_disconnect()
+    ShutdownBackground()
 
     del bpy.types.Object.projection_props
     del bpy.types.Scene.comfy_bridge_props
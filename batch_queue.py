@@ -0,0 +1,212 @@
+"""
+一次排好几个变体(不同摄像机, 不同sender, 不同seed), 不用一下一下点Queue Prompt
+渲染和上传一个变体接一个变体做, comfyUI那边最多同时排着in_flight个job, 结束一个就补一个, GPU不会闲着
+一个变体的图, 要的名字和QueuePrompt等都渲完了才一口气排进发送队列, 中间不会插进别的变体或者交互的op
+每个变体的结果各放各的图: 接收名.变体名
+要comfyBridge支持pipeline, 不然对不上哪张图是哪个变体的
+"""
+
+from .comfy_bridge import SendImages, SendRequestNames, QueuePrompt, CancelJob, HasFeature
+from .event import EventMan
+from .op_queue import PRIORITY_BATCH
+from .protocol import FEATURE_PIPELINE, FEATURE_PARAMS
+from .renderTool import RenderCollection
+from .tmp_setting import TmpSetting
+import bpy
+
+
+class Variant:
+    """
+    label: 结果图名字的后缀, 同一批里不要重复
+    camera: 用哪个摄像机渲, None就是当前的
+    senders: 渲哪几个sender, None就是面板上勾了的那些
+    params: 这次要改的工作流参数, 比如{'seed': 3}, 要comfyBridge支持FEATURE_PARAMS
+    """
+    def __init__(self, label, camera=None, senders=None, params=None):
+        self.label = label
+        self.camera = camera
+        self.senders = senders
+        self.params = params
+
+def ResultName(request_name, label):
+    return f'{request_name}.{label}'
+
+
+class BatchQueue:
+    """
+    一次只跑一批, 正在跑的是BatchQueue.current
+    """
+    current = None
+
+    def __init__(self, context, variants, receivers, in_flight=2):
+        self.context = context
+        self.variants = list(variants)
+        self.total = len(self.variants)
+        self.request_names = [item.text for item in receivers]
+        self.default_senders = [item for item in context.scene.comfy_bridge_props.sender_list if item.enabled]
+        self.in_flight = max(1, in_flight)
+        # job id -> Variant, 已经QueuePrompt了还没结束的
+        self.jobs = {}
+        # 正在渲的变体, 它还没渲的sender, 正在等哪个sender的render_complete, 已经渲好的图
+        self.rendering = None
+        self.senders = []
+        self.sender = None
+        self.names = []
+        self.image_datas = []
+        self.finished = 0
+        self.failed = 0
+        self.cancelled = False
+
+        self.camera = context.scene.camera
+        self.region_3d = None
+        self.view_perspective = None
+        self.undo_steps = bpy.context.preferences.edit.undo_steps
+
+    # ------public methods------
+    def start(self):
+        """
+        返回错误信息, 没问题的话是None
+        """
+        if BatchQueue.current is not None:
+            return 'a batch is already running'
+        if not HasFeature(FEATURE_PIPELINE):
+            return 'ComfyBridge does not support pipelined prompts'
+        if not HasFeature(FEATURE_PARAMS) and any(variant.params for variant in self.variants):
+            print('~~~~~~~~~ComfyBridge does not support prompt params, all variants use the same ones')
+        if len(self.request_names) == 0 or len(self.variants) == 0:
+            return 'nothing to queue'
+
+        if any(variant.camera is not None for variant in self.variants):
+            # 渲染是按3D视图渲的, 要从摄像机看出去才是换摄像机
+            for area in self.context.window.screen.areas:
+                if area.type == 'VIEW_3D':
+                    self.region_3d = area.spaces.active.region_3d
+                    self.view_perspective = self.region_3d.view_perspective
+                    self.region_3d.view_perspective = 'CAMERA'
+                    break
+
+        BatchQueue.current = self
+        EventMan.Add('render_complete', self.on_render_done)
+        EventMan.Add('on_job_finished', self.on_job_finished)
+        self.update_info()
+        self.pump()
+        return None
+
+    def cancel(self):
+        """
+        还没开始的不做了, 排着的job都取消掉; 正在渲的那个渲完就停
+        """
+        self.cancelled = True
+        self.variants = []
+        for job_id in list(self.jobs):
+            CancelJob(job_id)
+        if self.rendering is None:
+            self.finish()
+
+    # ------一个一个变体往下走------
+    def pump(self):
+        """
+        不在渲染, 在跑的job也没满的话, 开始渲下一个变体
+        """
+        if self.rendering is not None or self.cancelled:
+            return
+        if self.variants and len(self.jobs) < self.in_flight:
+            self.render_variant(self.variants.pop(0))
+        elif not self.variants and not self.jobs:
+            self.finish()
+
+    def render_variant(self, variant):
+        self.rendering = variant
+        self.names = []
+        self.image_datas = []
+        self.senders = list(self.default_senders if variant.senders is None else variant.senders)
+        if variant.camera is not None:
+            self.context.scene.camera = variant.camera
+        if self.senders:
+            bpy.context.preferences.edit.undo_steps = 0
+            self.render_next_sender()
+        else:
+            self.queue_variant()
+
+    def render_next_sender(self):
+        self.sender = self.senders.pop(0)
+        RenderCollection(self.context, self.sender)
+
+    def on_render_done(self, data):
+        # 交互的Queue Prompt也会发render_complete, 不是在等的这个就不管
+        if self.rendering is None or data['sender'] != self.sender:
+            return
+        # 先攒着, 渲一个sender就发一个的话, 别的变体的job完了补进来的渲染会和这个变体的op交错
+        self.names += data['names']
+        self.image_datas += data['image_datas']
+        if self.senders and not self.cancelled:
+            self.render_next_sender()
+            return
+        self.sender = None
+        bpy.context.preferences.edit.undo_steps = self.undo_steps
+        if self.cancelled:
+            self.rendering = None
+            self.names = []
+            self.image_datas = []
+            self.finish()
+            return
+        self.queue_variant()
+
+    def queue_variant(self):
+        variant = self.rendering
+        rename = {name: ResultName(name, variant.label) for name in self.request_names}
+        # 一个组: 前面的都不带group_end, QueuePrompt带, 发送那边一个组发完才换别的
+        if self.names:
+            SendImages(self.names, self.image_datas, PRIORITY_BATCH)
+        SendRequestNames(self.request_names, PRIORITY_BATCH)
+        job_id = QueuePrompt(PRIORITY_BATCH, variant.params, rename)
+        self.rendering = None
+        self.names = []
+        self.image_datas = []
+        if job_id is None:
+            # 断开了
+            self.cancel()
+            return
+        self.jobs[job_id] = variant
+        print(f'batch variant {variant.label}: job {job_id}')
+        self.pump()
+
+    def on_job_finished(self, args):
+        variant = self.jobs.pop(args['job'], None)
+        if variant is None:
+            return
+        if args['ok']:
+            self.finished += 1
+        else:
+            self.failed += 1
+            print(f'batch variant {variant.label} failed')
+        self.update_info()
+        self.pump()
+
+    def finish(self):
+        if BatchQueue.current is not self:
+            return
+        BatchQueue.current = None
+        EventMan.Remove('render_complete', self.on_render_done)
+        EventMan.Remove('on_job_finished', self.on_job_finished)
+
+        self.context.scene.camera = self.camera
+        if self.region_3d is not None:
+            self.region_3d.view_perspective = self.view_perspective
+        bpy.context.preferences.edit.undo_steps = self.undo_steps
+
+        cb_props = self.context.scene.comfy_bridge_props
+        cb_props.info = ''
+        cb_props.progress = 0
+        print(f'batch done: {self.finished} finished, {self.failed} failed, {self.total - self.finished - self.failed} skipped')
+        self.redraw()
+
+    def update_info(self):
+        cb_props = self.context.scene.comfy_bridge_props
+        cb_props.info = f'batch {self.finished + self.failed}/{self.total}'
+        cb_props.progress = max(0.01, (self.finished + self.failed) / self.total)
+        self.redraw()
+
+    def redraw(self):
+        if TmpSetting.area_3D:
+            TmpSetting.area_3D.tag_redraw()
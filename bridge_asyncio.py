@@ -0,0 +1,454 @@
+"""
+asyncio版的comfyBridge client
+所有的收发都在一个event loop线程里, heartbeat和断线检测用loop自己的call_later
+blender主线程通过call_soon_threadsafe把op塞进来
+"""
+
+import asyncio
+import contextlib
+import socket
+from .bridge_client import (
+    BridgeClient, legacy_servers, local_paths, TRANSPORT_TCP, TRANSPORT_UNIX,
+    CONNECT_TIMEOUT, NEGOTIATE_TIMEOUT, REPLY_TIMEOUT
+)
+from .protocol import (
+    HANDSHAKE, NEGOTIATE, RESUME, SHM_ATTACH,
+    PROTOCOL_V2, FRAME_HEADER, MAX_FRAME_SIZE, INCOMING_LAYOUTS, FEATURE_RESUME, FEATURE_SHM,
+    unpackFeatures, fieldsSize, PayloadReader
+)
+from .telemetry import METRIC_CONNECT
+from concurrent.futures import Future
+import threading
+import time
+
+
+# StreamReader的缓冲上限, 默认的64K对图像来说太小了
+STREAM_LIMIT = 4 * 1024 * 1024
+# 等event loop收拾干净的最长时间
+STOP_TIMEOUT = 5.0
+# 关连接时等没发完的数据发出去的最长时间
+CLOSE_TIMEOUT = 1.0
+# sender先停了的话, 等receiver把socket里已经到了的回复读完最多等这么久
+DRAIN_TIMEOUT = 2.0
+# 大的帧分这么大一段一段读写, 每段都算一次还活着
+IO_CHUNK_SIZE = 1024 * 1024
+
+
+class AsyncioBridgeClient(BridgeClient):
+    backend_name = 'asyncio'
+
+    def __init__(self, host, port, options=None, info=None):
+        super().__init__(host, port, options, info)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+        self.main_future = None
+
+        # op_queues是线程安全的, 谁调用的add_operation就在谁的线程里放进去, 放完用这个叫醒sender
+        self.op_ready = asyncio.Event()
+        self.op_queues.listener = self.wake_sender
+        self.reader = None
+        self.writer = None
+        self.writer_lock = asyncio.Lock()
+        # 还没写完的heartbeat, 连接断了要全部cancel掉, 不然会写到下一条连接上去
+        self.heartbeat_tasks = set()
+
+    # ------BridgeClient------
+    def start(self):
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        self.main_future = asyncio.run_coroutine_threadsafe(self.client_loop(), self.loop)
+
+    def stop(self):
+        self.stopping = True
+        self.update_info(isClosing=True)
+        if self.main_future is not None:
+            # main_future.cancel()会马上返回, client_loop的finally可能还没跑完, 得在loop里等它真的结束
+            try:
+                asyncio.run_coroutine_threadsafe(self.cancel_main(), self.loop).result(STOP_TIMEOUT)
+            except BaseException as e:
+                pass
+            self.main_future = None
+
+        if self.loop_thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop_thread = None
+            self.loop.close()
+
+    async def cancel_main(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def wake_sender(self):
+        try:
+            self.loop.call_soon_threadsafe(self.op_ready.set)
+        except RuntimeError as e:
+            # loop已经关了
+            pass
+
+    def schedule(self, delay, callback):
+        # 都是在loop线程里调用的
+        return self.loop.call_later(delay, callback)
+
+    def send_heartbeat(self):
+        # 写是await的, 不会卡住loop, 和正在分块发的图交替着写
+        task = self.loop.create_task(self.run_operation({'op': self.op_heartbeat, 'args': (), 'request_id': 0}))
+        self.heartbeat_tasks.add(task)
+        task.add_done_callback(self.heartbeat_tasks.discard)
+
+    def abort_connection(self):
+        if self.writer is not None:
+            self.writer.transport.abort()
+
+    # ------stream------
+    async def write(self, buffers):
+        if self.writer is None:
+            raise ConnectionError('not connected')
+        async with self.writer_lock:
+            for buffer in buffers:
+                if len(buffer) <= IO_CHUNK_SIZE:
+                    self.writer.write(buffer)
+                    continue
+                view = memoryview(buffer).cast('B')
+                for offset in range(0, len(view), IO_CHUNK_SIZE):
+                    self.writer.write(view[offset:offset + IO_CHUNK_SIZE])
+                    await self.writer.drain()
+                    self.last_activity = time.monotonic()
+            await self.writer.drain()
+            self.frames_sent += 1
+        self.last_activity = time.monotonic()
+
+    async def read_exactly(self, size):
+        """
+        大的一段分几次读, 每读到一段都算一次还活着, 不然一张大图读得久了会被当成断线
+        """
+        if size <= IO_CHUNK_SIZE:
+            data = await self.reader.readexactly(size)
+        else:
+            data = bytearray(size)
+            for offset in range(0, size, IO_CHUNK_SIZE):
+                piece = await self.reader.readexactly(min(IO_CHUNK_SIZE, size - offset))
+                data[offset:offset + len(piece)] = piece
+                self.last_activity = time.monotonic()
+        self.last_activity = time.monotonic()
+        return data
+
+    async def receive_int(self):
+        return int.from_bytes(await self.read_exactly(4), byteorder='big')
+
+    async def receive_string(self):
+        length = self.check_length(await self.receive_int())
+        return (await self.read_exactly(length)).decode('utf-8')
+
+    async def receive_strings(self):
+        count = await self.receive_int()
+        return [await self.receive_string() for _ in range(count)]
+
+    async def receive_image(self):
+        length = self.check_length(await self.receive_int())
+        return await self.read_exactly(length)
+
+    async def receive_message(self):
+        if self.protocol >= PROTOCOL_V2:
+            opCode, request_id, length = FRAME_HEADER.unpack(await self.read_exactly(FRAME_HEADER.size))
+            if length > MAX_FRAME_SIZE:
+                raise ConnectionError(f'frame too large: {length}')
+            payload = await self.read_exactly(length)
+            self.telemetry.received(opCode, FRAME_HEADER.size + length)
+            self.capture_received(opCode, request_id, payload)
+            layout = INCOMING_LAYOUTS.get(opCode)
+            if layout is None:
+                return opCode, request_id, None
+            return opCode, request_id, PayloadReader(payload).readFields(layout)
+
+        opCode = await self.receive_int()
+        layout = INCOMING_LAYOUTS.get(opCode)
+        if layout is None:
+            self.telemetry.received(opCode, 4)
+            self.capture_received(opCode, 0)
+            return opCode, 0, None
+        readers = {
+            'int': self.receive_int,
+            'str': self.receive_string,
+            'strs': self.receive_strings,
+            'blob': self.receive_image,
+        }
+        fields = [await readers[field]() for field in layout]
+        self.telemetry.received(opCode, 4 + fieldsSize(layout, fields))
+        self.capture_received(opCode, 0, fields=fields)
+        return opCode, 0, fields
+
+    # ------connection------
+    async def open(self):
+        path = local_paths.get((self.host, self.port))
+        if path:
+            # 和线程版一样, 连不上就忘掉这个路径, 走TCP重新问
+            try:
+                self.reader, self.writer = await self.open_stream(socket.AF_UNIX, path)
+                self.transport = TRANSPORT_UNIX
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f'~~~~~~~~~unix socket {path} failed:{e}, use tcp')
+                local_paths.pop((self.host, self.port), None)
+
+        self.transport = TRANSPORT_TCP
+        loop = asyncio.get_running_loop()
+        infos = await asyncio.wait_for(
+            loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM), CONNECT_TIMEOUT
+        )
+        family, _, _, _, address = infos[0]
+        self.reader, self.writer = await self.open_stream(family, address)
+
+    async def open_stream(self, family, address):
+        """
+        socket自己建, connect之前先tune_socket, 连上了再交给asyncio的stream
+        """
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.tune_socket(sock)
+            sock.setblocking(False)
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, address), CONNECT_TIMEOUT)
+        except BaseException:
+            sock.close()
+            raise
+        if family == socket.AF_INET or family == socket.AF_INET6:
+            return await asyncio.open_connection(sock=sock, limit=STREAM_LIMIT)
+        return await asyncio.open_unix_connection(sock=sock, limit=STREAM_LIMIT)
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+            # 对面死了的话没发完的数据永远发不完, wait_closed就一直等着
+            await asyncio.wait_for(self.writer.wait_closed(), CLOSE_TIMEOUT)
+        except Exception as e:
+            self.writer.transport.abort()
+        self.reader = None
+        self.writer = None
+
+    async def negotiate(self):
+        """
+        和线程版一样, 等不到NEGOTIATE就当对面是老版本
+        """
+        async def read_reply():
+            if await self.receive_int() != NEGOTIATE:
+                return None
+            version = await self.receive_int()
+            features = await self.receive_string()
+            self.capture_received(NEGOTIATE, 0, fields=[version, features])
+            return version, unpackFeatures(features)
+
+        try:
+            await self.write(self.encode_negotiate())
+            reply = await asyncio.wait_for(read_reply(), NEGOTIATE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f'~~~~~~~~~negotiate failed:{e}')
+            return False
+        if reply is None:
+            return False
+
+        version, features = reply
+
+        self.apply_negotiation(version, features)
+        return True
+
+    async def resume(self):
+        """
+        和线程版一样, 对面支持的话带着session id接着上次的来
+        """
+        if FEATURE_RESUME not in self.features:
+            self.resume_session(False, 0)
+            return True
+
+        try:
+            await self.write(self.encode_resume())
+            code, _, fields = await asyncio.wait_for(self.receive_message(), NEGOTIATE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f'~~~~~~~~~resume failed:{e}')
+            return False
+        if code != RESUME:
+            return False
+
+        resumed, frames = fields
+        self.resume_session(resumed != 0, frames)
+        return True
+
+    async def attach_shm(self):
+        """
+        和线程版一样, 在同一台机器上的话告诉对面共享内存的名字
+        """
+        if FEATURE_SHM not in self.features:
+            return True
+        message = self.encode_shm_attach()
+        if message is None:
+            return True
+
+        try:
+            await self.write(message)
+            code, _, fields = await asyncio.wait_for(self.receive_message(), NEGOTIATE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f'~~~~~~~~~shared memory attach failed:{e}')
+            return False
+        if code != SHM_ATTACH:
+            return False
+
+        attached, path = fields
+        self.apply_shm_attach(attached != 0, path)
+        return True
+
+    async def handshake(self):
+        await self.write(self.encode_handshake())
+        if await self.receive_int() != HANDSHAKE:
+            return False
+        self.capture_received(HANDSHAKE, 0)
+
+        server = (self.host, self.port)
+        if server in legacy_servers or await self.negotiate():
+            return True
+
+        print('ComfyBridge does not support protocol v2, fall back to v1')
+        legacy_servers.add(server)
+        await self.close()
+        await self.open()
+        await self.write(self.encode_handshake())
+        if await self.receive_int() != HANDSHAKE:
+            return False
+        self.capture_received(HANDSHAKE, 0)
+        return True
+
+    async def run_operation(self, operation):
+        steps = self.operation_steps(operation)
+        reply = None
+        while True:
+            try:
+                step = steps.send(reply)
+            except StopIteration:
+                self.finish_operation(operation)
+                return
+            reply = None
+            if isinstance(step, Future):
+                # 回复是receiver task在同一个loop里填的, 这里await不会卡住它
+                try:
+                    # shield住, 自己这个task被cancel的时候不要顺带把step也cancel了, 不然下面分不清是谁
+                    reply = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(step)), REPLY_TIMEOUT)
+                except asyncio.TimeoutError as e:
+                    reply = None
+                except asyncio.CancelledError as e:
+                    # 断开时Future被cancel了就当没回复, 是自己这个task被cancel了就接着往外抛
+                    if not step.cancelled():
+                        raise
+                    reply = None
+            else:
+                opCode, parts, request_id = step
+                await self.write(self.encode_message(opCode, parts, request_id))
+
+    async def sender_loop(self):
+        while True:
+            operation = self.next_replay() or self.op_queues.get_nowait()
+            if operation is None:
+                self.op_ready.clear()
+                # clear之后再看一眼, 免得正好在这中间放进来的没人叫醒
+                operation = self.op_queues.get_nowait()
+                if operation is None:
+                    group_wait = self.op_queues.group_wait()
+                    if group_wait > 0:
+                        # 在等一组后面的op, 一直不来的话到时间了放别的优先级走
+                        with contextlib.suppress(asyncio.TimeoutError):
+                            await asyncio.wait_for(self.op_ready.wait(), group_wait)
+                    else:
+                        await self.op_ready.wait()
+                    continue
+            await self.run_operation(operation)
+
+    async def receiver_loop(self):
+        while True:
+            code, request_id, fields = await self.receive_message()
+            if not self.handle_message(code, request_id, fields):
+                return
+
+    async def open_session(self, switching=False):
+        try:
+            await self.open()
+            is_ok = await self.handshake() and await self.resume() and await self.attach_shm()
+            if not is_ok:
+                print('ComfyBridge Handshake failed')
+        except Exception as e:
+            print(f'Error in connectToComfyBridge: {e}')
+            is_ok = False
+
+        if not is_ok:
+            await self.close()
+            return False
+
+        if not switching and self.should_switch_transport():
+            print('ComfyBridge is on this machine, switch to unix socket')
+            await self.close()
+            self.reset_negotiation()
+            return await self.open_session(switching=True)
+        return True
+
+    async def run_session(self):
+        """
+        一直跑到连接断开, 排队的op留在op_queues里给下一次连接
+        """
+        self.connected = True
+        self.on_connected()
+
+        tasks = []
+        try:
+            await self.run_operation({'op': self.op_heartbeat, 'args': (), 'request_id': 0})
+            sender = asyncio.create_task(self.sender_loop())
+            receiver = asyncio.create_task(self.receiver_loop())
+            tasks = [sender, receiver]
+            # 谁先停了(出错或者对面断开)就全部停掉
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if receiver not in done:
+                # 写不出去了不等于读不到了, 对面断开之前发的结果还在缓冲区里, 读到EOF为止
+                drained, _ = await asyncio.wait([receiver], timeout=DRAIN_TIMEOUT)
+                done |= drained
+            for task in done:
+                if task.exception() is not None:
+                    print(f'~~~~~~~~~connection error:{task.exception()}')
+        except Exception as e:
+            print(f'~~~~~~~~~connection error:{e}')
+        finally:
+            self.connected = False
+            tasks += self.heartbeat_tasks
+            self.heartbeat_tasks.clear()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close()
+
+    async def client_loop(self):
+        """
+        第一次就连不上直接放弃, 连上过之后断了就按reconnect_delay重连
+        """
+        self.update_info(isConnecting=True)
+        has_connected = False
+        attempt = 0
+        try:
+            while not self.stopping:
+                started = time.monotonic()
+                if await self.open_session():
+                    self.telemetry.record(METRIC_CONNECT, time.monotonic() - started)
+                    has_connected = True
+                    attempt = 0
+                    await self.run_session()
+                if not has_connected or not self.should_reconnect(attempt):
+                    break
+
+                self.on_connection_lost()
+                delay = self.reconnect_delay(attempt)
+                attempt += 1
+                print(f'ComfyBridge reconnecting in {delay:.1f}s ({attempt})')
+                await asyncio.sleep(delay)
+        finally:
+            self.update_info(isConnecting=False)
+            self.op_queues.clear()
+            if has_connected:
+                self.on_disconnected()
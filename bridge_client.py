@@ -0,0 +1,1000 @@
+"""
+comfyBridge client里和怎么收发无关的那部分
+要发什么, 收到了怎么处理, job怎么记, 线程版和asyncio版都是一样的
+"""
+
+from .event import EventMan
+from .protocol import (
+    HANDSHAKE, HEARTBEAT, NEGOTIATE, RESUME, SHM_ATTACH,
+    SEND_IMAGE, REQUEST_IMAGE, QUEUE_PROMPT, RESPONSED_IMAGE, IMAGE_REF, IMAGE_MISS, IMAGE_CHUNK, CHUNK_ACK,
+    SHM_RELEASE, CANCEL, PROGRESS, ERROR, OK,
+    PROTOCOL_V1, PROTOCOL_V2, MAX_FRAME_SIZE, FEATURE_PIPELINE, FEATURE_RAW, FEATURE_DEDUP, FEATURE_CHUNKED, FEATURE_RESUME,
+    FEATURE_SHM, FEATURE_CANCEL, FEATURE_PARAMS, CODECS, CODEC_NONE, RawImage,
+    INCOMING_LAYOUTS, packInt, packString, packBlob, packFrame, packFields, packFeatures, packRawImage, packShmRef,
+    codecFeatures, pickCodec, splitParts
+)
+from .dedup import HashIndex, imageDigest
+from .op_queue import OpQueue, OVERFLOW_DROP_OLDEST, PRIORITY_INTERACTIVE
+from .shm_ring import ShmRing, shared_memory
+from .telemetry import Telemetry, METRIC_QUEUE_TO_WIRE
+from .image_decode import ImageDecoder, canDecode
+from .wire_capture import WireCapture
+from collections import OrderedDict
+from concurrent.futures import Future
+import json
+import ipaddress
+import itertools
+import random
+import socket
+import threading
+import time
+import uuid
+
+
+def newConnectInfo():
+    return {
+        'isConnected': False,
+        'isClosing': False,
+        'isConnecting': False,
+        'isReconnecting': False,
+        'protocol': PROTOCOL_V1,
+        'features': set(),
+        'backend': '',
+        'codec': CODEC_NONE,
+        'transport': '',
+        # 连接池的时候是(连上了几台, 一共几台), 只有一条连接是None
+        'servers': None,
+    }
+
+Connect_Info = newConnectInfo()
+
+DEFAULT_OPTIONS = {
+    # 对面支持的话, gpu画出来的图直接发像素, 不存PNG
+    'raw_images': True,
+    # 裸像素用什么压缩, auto就是双方都有的里面挑最快的
+    'codec': 'auto',
+    # 没变过的图只发hash, 下面两个是记录对面有哪些图的上限
+    'dedup': True,
+    'dedup_entries': 64,
+    'dedup_bytes': 512 * 1024 * 1024,
+    # 大图拆成这么大一块一块发, 块与块之间heartbeat之类的可以插进来
+    'upload_chunk': 512 * 1024,
+    # 发出去了但对面还没CHUNK_ACK的字节最多这么多, 超了就等
+    'upload_window': 4 * 1024 * 1024,
+    # 连接断了自动重连, 间隔从reconnect_delay开始翻倍, 最长reconnect_max_delay, 0次就是一直重试
+    'reconnect': True,
+    'reconnect_attempts': 10,
+    'reconnect_delay': 0.5,
+    'reconnect_max_delay': 30.0,
+    # 发出去了但对面还没确认的op最多记这么多个, 重连后重发
+    'replay_limit': 64,
+    # 这么久什么都没收到也没发出去就当对面死了, 不等TCP自己报错
+    # 正常情况下最多HEARTBEAT_DELAY就会有一个HEARTBEAT回来
+    'dead_peer_timeout': 30.0,
+    # 还没发出去的op最多排这么多, 满了怎么办见op_queue里的OVERFLOW_xxx
+    'queue_limit': 256,
+    'queue_overflow': OVERFLOW_DROP_OLDEST,
+    # 小消息(heartbeat, QUEUE_PROMPT)马上发, 不等Nagle攒包, 不然每次要多等一个delayed ACK(40ms左右)
+    'tcp_nodelay': True,
+    # socket的收发缓冲区, 连之前设好; 0是用系统的(linux上会自己调大, 设了反而不调了)
+    'socket_buffer': 0,
+    # comfyBridge在同一台机器上的话, 图像写进这么大的共享内存里, 不走socket
+    'shared_memory': True,
+    'shm_size': 256 * 1024 * 1024,
+    # 收到的图先在后台线程里解成像素, 主线程上直接写进bpy的image, 不经过临时文件
+    'decode_images': True,
+    # 新的交互job要的图和还没结束的交互job有重名的, 旧的就不要了(CANCEL掉), 免得晚到的结果盖掉新的
+    'supersede': True,
+    # 收发的每一帧都记到这个文件里, 空的就是不记; 见wire_capture和tools/replay_capture.py
+    'capture': '',
+    # 记的时候payload比这大的只留头尾, 0是全都留着; 想之后照着重放图像的话别设
+    'capture_payload_limit': 0,
+}
+CONNECT_TIMEOUT = 5.0
+# 老版本的comfyBridge不认识NEGOTIATE, 等这么久没回复就当它是老的
+NEGOTIATE_TIMEOUT = 2.0
+HEARTBEAT_DELAY = 10
+# op里等对面回复最多等这么久, 等不到就当没回
+REPLY_TIMEOUT = 5.0
+
+# 协商失败过的(host, port), 下次直接用v1, 省得每次都等超时
+legacy_servers = set()
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_UNIX = 'unix'
+# 老的windows上没有unix socket, 那就只用共享内存, 控制消息还是走TCP
+HAS_UNIX_SOCKET = hasattr(socket, 'AF_UNIX')
+# (host, port) -> comfyBridge给的unix socket路径, 之后连它都走unix socket
+local_paths = {}
+# 比这小的图还是直接跟着消息发, 不值得去共享内存里占一段
+SHM_MIN_SIZE = 64 * 1024
+# 取消了的job id最多记这么多, 它们晚到的进度和图都扔掉
+MAX_CANCELLED = 256
+
+
+class BridgeClient:
+    """
+    一条到comfyBridge的连接
+    子类只管把消息变成字节发出去, 把字节变回消息交给handle_message
+
+    op都是generator, 一条一条yield出(opCode, parts, request_id),
+    backend按顺序把它们写到socket上
+    要等对面回复的时候yield一个expect_reply拿到的Future,
+    backend等到结果(超时或者断开了就是None)再send回generator里
+    """
+    backend_name = ''
+
+    def __init__(self, host, port, options=None, info=None):
+        self.host = host
+        self.port = port
+        self.options = {**DEFAULT_OPTIONS, **(options or {})}
+        # 连接状态写到哪, 连接池里每条连接有自己的一份, 单独用的时候就是Connect_Info
+        self.info = Connect_Info if info is None else info
+        self.connected = False
+        self.protocol = PROTOCOL_V1
+        self.features = set()
+        self.codec = CODEC_NONE
+
+        self.op_queues = OpQueue(self.options['queue_limit'], self.options['queue_overflow'])
+
+        # v2里每个请求都有个id, QUEUE_PROMPT的id就是job的id
+        self.request_ids = itertools.count(1)
+        # job id -> {'names': 还没收到的图像名, 'priority': op_queue里的PRIORITY_xxx, 'rename': 收到的图改叫什么,
+        #            'sent': QUEUE_PROMPT开始发了没有}
+        # 收齐了, 失败了, 取消了都从这里删掉(end_job)
+        self.jobs = {}
+        # 取消了的job id, 按取消的顺序
+        self.cancelled = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        # 最近一次SendRequestNames的名字, QueuePrompt时记到job里
+        self.request_names = []
+
+        # request id -> 等着对面回复的Future
+        self.pending_replies = {}
+        self.pending_lock = threading.Lock()
+
+        # 觉得对面已经存着的图
+        self.image_index = HashIndex(self.options['dedup_entries'], self.options['dedup_bytes'])
+        self.dedup_stats = {'hits': 0, 'misses': 0, 'sent': 0}
+
+        # 正在分块上传的request id -> 对面确认收到的字节数
+        self.uploads = {}
+
+        # 重连后靠它让对面认出是同一个client
+        self.session_id = uuid.uuid4().hex
+        self.stopping = False
+        # 这个session里写出去的帧数, 对面HEARTBEAT回来的是它收到的帧数
+        self.frames_sent = 0
+        # 开始发了但对面还没确认收全的op, 和重连后还没来得及重发的op
+        self.replay_log = []
+        self.replay_ops = []
+        self.replay_lock = threading.Lock()
+        # 为了让对面确认收到的帧数提前发了HEARTBEAT, 还没回
+        self.ack_requested = False
+        # replay_log满了, sender等着对面确认的Future; 等超时过一次就不再等, 直到下一次确认回来
+        self.ack_waiter = None
+        self.ack_stalled = False
+        # 最近一次真的发出去的REQUEST_IMAGE, 对面不记得session的话重连后要再发一次
+        self.registered_names = None
+
+        self.heartbeat_timer = None
+        self.deadline_timer = None
+        # 最后一次收到或者发出去数据的时间, 一帧很大的话读写到一半也算
+        self.last_activity = 0.0
+
+        # 现在这条连接走的是TCP还是unix socket
+        self.transport = TRANSPORT_TCP
+        # 第一次用到时才建, 重连也接着用, 彻底断开时才释放
+        self.shm_ring = None
+        # 这条连接上对面已经attach了的话就是shm_ring, 不然是None
+        self.shm = None
+        self.local_peer = None
+
+        self.telemetry = Telemetry()
+        # 没有numpy就没法解, on_image_received拿到的还是原始数据
+        self.decoder = ImageDecoder() if self.options['decode_images'] and canDecode() else None
+        self.capture = None
+        if self.options['capture']:
+            try:
+                self.capture = WireCapture(
+                    self.options['capture'], self.options['capture_payload_limit'],
+                    {'host': host, 'port': port, 'backend': self.backend_name}
+                )
+            except OSError as e:
+                print(f'~~~~~~~~~can not capture to {self.options["capture"]}:{e}')
+
+    # ------需要子类实现的------
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def schedule(self, delay, callback):
+        """
+        delay秒后调用callback, 返回的东西要能cancel()
+        """
+        raise NotImplementedError
+
+    def send_heartbeat(self):
+        """
+        heartbeat定时器到了, 在定时器的线程里调用, 不能阻塞
+        """
+        raise NotImplementedError
+
+    def abort_connection(self):
+        """
+        判定对面已经死了, 把连接掐掉, 收发卡着的地方都会报错退出, 然后走重连
+        """
+        raise NotImplementedError
+
+    # ------public methods------
+    def SendImages(self, image_names, image_datas, priority=PRIORITY_INTERACTIVE):
+        """
+        返回False表示队列满了, 这些图直接被扔掉了
+        """
+        return self.add_operation(
+            self.op_send_images, image_names, image_datas, request_id=self.new_request_id(), priority=priority
+        )
+
+    def SendRequestNames(self, names, priority=PRIORITY_INTERACTIVE, group_end=False):
+        """
+        改receiver名字的时候每敲一个字都会调用, 还没发出去的直接被新的顶掉
+        group_end: 后面不跟QueuePrompt, 自己就是一组; 不然sender会等着这一组的QueuePrompt, 别的优先级都发不了
+        """
+        self.request_names = list(names)
+        self.add_operation(
+            self.op_send_request_names, names, request_id=self.new_request_id(), key='request_names',
+            priority=priority, group_end=group_end
+        )
+
+    def QueuePrompt(self, priority=PRIORITY_INTERACTIVE, params=None, rename=None):
+        """
+        返回job id, v2里这个job的PROGRESS和RESPONSED_IMAGE都带着它
+        job不管连没连着都先记下, 真发的时候对面不支持pipeline(v1里对不上号)就马上当失败结束掉
+        priority: 同一优先级的按顺序发, 交互的(默认)排在批量的前面
+        params: 这次要改的工作流参数{名字: 值}, 对面支持FEATURE_PARAMS才有用
+        rename: {REQUEST_IMAGE里的名字: 收到后叫什么}, 批量跑的时候每个job的图各放各的, 也要v2才对得上
+        job结束(收齐了, 失败了, 取消了)的时候Trigger on_job_finished
+        """
+        job_id = self.new_request_id()
+        # 正在重连的时候protocol和features都是空的, 这里还看不出对面支不支持, 到op_queue_prompt里再看
+        names = [name for name in self.request_names if name != 'None']
+        if priority == PRIORITY_INTERACTIVE and self.options['supersede']:
+            self.supersede(names)
+        with self.jobs_lock:
+            self.jobs[job_id] = {'names': names, 'priority': priority, 'rename': dict(rename or {}), 'sent': False}
+        self.add_operation(self.op_queue_prompt, params, request_id=job_id, priority=priority, group_end=True)
+        return job_id
+
+    def CancelJob(self, job_id):
+        """
+        不要这个job了: QUEUE_PROMPT还没发出去就连同它那一组的SEND_IMAGE, REQUEST_IMAGE一起拿掉, 发出去了就叫对面停掉
+        之后收到的这个job的进度和图都扔掉; 返回False表示没有这个job(结束了, 或者v1里不记job)
+        """
+        if not self.abandon_job(job_id):
+            return False
+
+        removed = self.op_queues.remove_group(
+            lambda operation: operation['op'] == self.op_queue_prompt and operation['request_id'] == job_id
+        )
+        unsent = any(operation['op'] == self.op_queue_prompt for operation in removed)
+        if not unsent and FEATURE_CANCEL in self.features:
+            self.add_operation(self.op_cancel, job_id, request_id=self.new_request_id(), group_end=True)
+        print(f'~~~~~~~~~cancel job {job_id}{"" if unsent else " on ComfyBridge"}')
+        return True
+
+    def abandon_job(self, job_id):
+        """
+        job当失败结束, 之后收到的它的进度和图都扔掉; 没有这个job返回False
+        """
+        with self.jobs_lock:
+            if job_id not in self.jobs:
+                return False
+            self.cancelled[job_id] = True
+            while len(self.cancelled) > MAX_CANCELLED:
+                self.cancelled.popitem(last=False)
+        self.end_job(job_id, False)
+        self.telemetry.prompt_failed(job_id)
+        return True
+
+    def supersede(self, names):
+        """
+        还没结束的交互job里, 要的图和names有重名的都取消掉
+        """
+        names = set(names)
+        with self.jobs_lock:
+            superseded = [
+                job_id for job_id, job in self.jobs.items()
+                if job['priority'] == PRIORITY_INTERACTIVE and names & set(job['names'])
+            ]
+        for job_id in superseded:
+            self.CancelJob(job_id)
+
+    # ------Operations------
+    def op_send_images(self, names, image_datas, request_id=0):
+        if len(names) != len(image_datas):
+            return
+
+        images = []
+        for name, image_data in zip(names, image_datas):
+            if isinstance(image_data, RawImage) and FEATURE_RAW not in self.features:
+                # 这里是sender线程, 没法再去找bpy压PNG了
+                print(f'~~~~~~~~~skip raw image {name}: not supported by ComfyBridge')
+                continue
+            images.append((name, image_data))
+
+        dedup = FEATURE_DEDUP in self.features
+        if dedup:
+            digests = {name: imageDigest(image_data) for name, image_data in images}
+            # touch顺便挪到最新, 一直没变的图才不会因为来得早被先扔掉
+            known = [name for name, _ in images if self.image_index.touch(digests[name])]
+            if known:
+                reply = self.expect_reply(request_id)
+                parts = [packInt(len(known))]
+                for name in known:
+                    parts += packString(name)
+                    parts += packBlob(digests[name])
+                yield IMAGE_REF, parts, request_id
+
+                missed = yield reply
+                self.drop_reply(request_id)
+                if missed is None:
+                    # 没等到回复, 当对面全都没有
+                    missed = known
+                missed = {name for name in missed if name in digests}
+                for name in missed:
+                    self.image_index.discard(digests[name])
+                self.dedup_stats['hits'] += len(known) - len(missed)
+                self.dedup_stats['misses'] += len(missed)
+
+                images = [(name, image_data) for name, image_data in images if name not in known or name in missed]
+                if len(images) == 0:
+                    return
+
+        parts = []
+        for name, image_data in images:
+            parts += packString(name)
+            parts += yield from self.pack_image(image_data)
+            if dedup:
+                parts += packBlob(digests[name])
+                self.image_index.add(digests[name], len(image_data))
+        self.dedup_stats['sent'] += len(images)
+        yield from self.upload(SEND_IMAGE, [packInt(len(images)), *parts], request_id)
+
+    def op_send_request_names(self, names, request_id=0):
+        self.registered_names = list(names)
+        parts = [packInt(len(names))]
+        for name in names:
+            parts += packString(name)
+        yield REQUEST_IMAGE, parts, request_id
+
+    def op_queue_prompt(self, params=None, request_id=0):
+        with self.jobs_lock:
+            if request_id in self.jobs:
+                self.jobs[request_id]['sent'] = True
+        # v1的回复不带id, 只能当成同一个
+        self.telemetry.prompt_sent(request_id if self.protocol >= PROTOCOL_V2 else 0)
+        if self.protocol < PROTOCOL_V2 or FEATURE_PIPELINE not in self.features:
+            # 结果对不上是哪个job的, 记着也等不到它结束; 照样发, 图按原来的名字收
+            if self.end_job(request_id, False) is not None:
+                print(f'~~~~~~~~~job {request_id} can not be tracked by ComfyBridge')
+        if FEATURE_PARAMS not in self.features:
+            if params:
+                print(f'~~~~~~~~~ignore params of job {request_id}: not supported by ComfyBridge')
+            yield QUEUE_PROMPT, (), request_id
+            return
+        yield QUEUE_PROMPT, packString(json.dumps(params) if params else ''), request_id
+
+    def op_cancel(self, job_id, request_id=0):
+        yield CANCEL, [packInt(job_id)], request_id
+
+    def op_heartbeat(self):
+        yield HEARTBEAT, (), 0
+
+    def pack_image(self, image_data):
+        """
+        一张图的blob, 用着共享内存的话内容写进ring里, blob里只剩位置和长度
+        ring满了就等对面SHM_RELEASE, 等不到就还是跟着消息发
+        """
+        shm = self.shm
+        if isinstance(image_data, RawImage):
+            # 写共享内存就是复制一次, 压缩只会更慢
+            parts = packRawImage(image_data, CODEC_NONE if shm is not None else self.codec)
+        else:
+            parts = packBlob(image_data)
+        body = parts[1:]
+        length = sum(len(part) for part in body)
+        if shm is None or length < SHM_MIN_SIZE or length > shm.size:
+            return parts
+
+        offset = shm.allocate(length)
+        while offset is None:
+            waiter = shm.wait_release()
+            # 拿到waiter之前可能正好释放了
+            offset = shm.allocate(length)
+            if offset is not None:
+                break
+            if (yield waiter) is None:
+                print('~~~~~~~~~shared memory is full, send the image inline')
+                return parts
+            offset = shm.allocate(length)
+        shm.write(offset, body)
+        return packBlob(packShmRef(offset, length))
+
+    def upload(self, opCode, parts, request_id):
+        """
+        不在一次write里把整条消息发完, 拆成IMAGE_CHUNK一块一块yield出去,
+        backend每写完一块就放开writer_lock, heartbeat之类的帧可以插进来
+        没确认的字节超过upload_window就等CHUNK_ACK, 最后一块用opCode本身发
+        对面不支持的话还是一整条发
+        """
+        total = sum(len(part) for part in parts)
+        chunk_size = self.options['upload_chunk']
+        if self.protocol < PROTOCOL_V2 or FEATURE_CHUNKED not in self.features or total <= chunk_size:
+            yield opCode, parts, request_id
+            self.on_upload_progress(request_id, total, total)
+            return
+
+        window = self.options['upload_window']
+        chunks = list(splitParts(parts, chunk_size))
+        sent = 0
+        self.uploads[request_id] = 0
+        try:
+            for index, chunk in enumerate(chunks):
+                size = sum(len(piece) for piece in chunk)
+                while window > 0 and sent + size - self.uploads[request_id] > window:
+                    # 先登记再检查, 免得ACK正好在这中间到了
+                    reply = self.expect_reply(request_id)
+                    if sent + size - self.uploads[request_id] <= window:
+                        self.drop_reply(request_id)
+                        break
+                    if (yield reply) is None:
+                        # 等不到ACK就不再等了, 交给TCP自己的流控
+                        print(f'~~~~~~~~~no CHUNK_ACK for request {request_id}, stop waiting')
+                        window = 0
+
+                last = index == len(chunks) - 1
+                yield (opCode if last else IMAGE_CHUNK), chunk, request_id
+                sent += size
+                self.on_upload_progress(request_id, sent, total)
+        finally:
+            with self.pending_lock:
+                self.uploads.pop(request_id, None)
+
+    def add_operation(self, op, *args, request_id=None, key=None, priority=PRIORITY_INTERACTIVE, group_end=False):
+        """
+        带request_id的op断线后可以重发, request_id作为最后一个参数传给op
+        key相同的op还排着没发的话会被这个顶掉
+        priority和group_end见op_queue.OpQueue
+        返回False表示队列满了, 这个op直接被扔掉了
+        """
+        operation = {'op': op, 'args': args, 'request_id': 0, 'key': key, 'priority': priority, 'group_end': group_end}
+        if request_id is not None:
+            operation['args'] = (*args, request_id)
+            operation['request_id'] = request_id
+        return self.submit(operation)
+
+    def submit(self, operation):
+        """
+        可能在任何线程里调用, 返回False表示operation自己被扔掉了
+        """
+        operation['queued_at'] = time.monotonic()
+        queued = True
+        for dropped in self.op_queues.put(operation):
+            self.on_operation_dropped(dropped)
+            queued = queued and dropped is not operation
+        return queued
+
+    def on_operation_dropped(self, operation):
+        print(f'~~~~~~~~~op queue full, drop {operation["op"].__name__} (request {operation["request_id"]})')
+        if operation['op'] == self.op_queue_prompt:
+            self.end_job(operation['request_id'], False)
+
+    # ------replay------
+    def operation_steps(self, operation):
+        """
+        backend跑op就是跑这个: replay_log满了先等对面确认收到了多少, 腾出地方再开始
+        不等的话发得比确认快时replay_log只留得住最后replay_limit个, 断线后前面的就重发不了了
+        """
+        if operation['request_id'] != 0 and FEATURE_RESUME in self.features:
+            waiter = self.wait_acknowledge()
+            if waiter is not None and (yield waiter) is None:
+                with self.replay_lock:
+                    self.ack_stalled = True
+        self.log_operation(operation)
+        yield from operation['op'](*operation['args'])
+
+    def wait_acknowledge(self):
+        """
+        replay_log没满返回None, 满了返回对面下一次确认时完成的Future
+        """
+        with self.replay_lock:
+            if len(self.replay_log) < self.options['replay_limit'] or self.ack_stalled:
+                return None
+            if self.ack_waiter is None:
+                self.ack_waiter = Future()
+            waiter = self.ack_waiter
+            request_ack = not self.ack_requested
+            self.ack_requested = True
+        if request_ack:
+            self.send_heartbeat()
+        return waiter
+
+    def log_operation(self, operation):
+        """
+        backend开始跑一个op之前调用, 对面确认收全了才从replay_log里扔掉
+        """
+        # 重发的时候就不算了
+        queued_at = operation.pop('queued_at', None)
+        if queued_at is not None:
+            self.telemetry.record(METRIC_QUEUE_TO_WIRE, time.monotonic() - queued_at)
+        if operation['request_id'] == 0 or FEATURE_RESUME not in self.features:
+            return
+        operation['frames'] = None
+        limit = self.options['replay_limit']
+        with self.replay_lock:
+            self.replay_log.append(operation)
+            overflow = len(self.replay_log) > limit
+            if overflow:
+                self.replay_log.pop(0)
+            # 一下发很多的时候等不到下一个HEARTBEAT就满了, 满一半就先问对面收到多少了
+            request_ack = len(self.replay_log) >= max(1, limit // 2) and not self.ack_requested
+            if request_ack:
+                self.ack_requested = True
+        if overflow:
+            self.telemetry.replay_overflow()
+        if request_ack:
+            self.send_heartbeat()
+
+    def finish_operation(self, operation):
+        """
+        op的最后一帧写出去了, 对面收到的帧数到了这里就算收全了
+        """
+        operation['frames'] = self.frames_sent
+
+    def acknowledge(self, frames):
+        with self.replay_lock:
+            self.ack_requested = False
+            self.ack_stalled = False
+            waiter, self.ack_waiter = self.ack_waiter, None
+            self.replay_log = [
+                operation for operation in self.replay_log
+                if operation['frames'] is None or operation['frames'] > frames
+            ]
+        if waiter is not None and not waiter.done():
+            waiter.set_result(frames)
+
+    def next_replay(self):
+        """
+        sender每次先看看有没有要重发的, 没有了才从队列里拿新的
+        """
+        with self.replay_lock:
+            if self.replay_ops:
+                return self.replay_ops.pop(0)
+        return None
+
+    def resume_session(self, resumed, frames):
+        """
+        每次握手成功后调用, 决定这次连接开始时先重发哪些op
+        对面还记得session就只重发它没收全的, 不记得(重启过或者根本不支持)就当它什么都没有
+        QUEUE_PROMPT已经发出去了又不重发的job, 结果是从旧的连接上回来的, 没收完的也收不到了,
+        不管对面记不记得session都当失败结束掉, 不然等着它的(比如BatchQueue)就一直卡着
+        """
+        if resumed:
+            self.acknowledge(frames)
+        self.frames_sent = frames if resumed else 0
+        with self.replay_lock:
+            # 上次连接里发了一半的在前面, 还没轮到重发的在后面
+            replay = self.replay_log + self.replay_ops
+            self.replay_log = []
+            self.ack_requested = False
+            self.ack_stalled = False
+
+        replayed_jobs = {operation['request_id'] for operation in replay if operation['op'] == self.op_queue_prompt}
+        with self.jobs_lock:
+            lost_jobs = [job_id for job_id, job in self.jobs.items() if job['sent'] and job_id not in replayed_jobs]
+        for job_id in lost_jobs:
+            print(f'~~~~~~~~~job {job_id} lost with the connection')
+            self.abandon_job(job_id)
+
+        if not resumed:
+            self.image_index.clear()
+            if self.registered_names is not None:
+                replay.insert(0, {'op': self.op_send_request_names, 'args': (self.registered_names, 0), 'request_id': 0})
+
+        with self.replay_lock:
+            self.replay_ops = replay
+        if replay:
+            print(f'~~~~~~~~~{"resumed" if resumed else "new"} session, replay {len(replay)} operations')
+
+    def reconnect_delay(self, attempt):
+        """
+        指数退避, 再在一半到全部之间随机一下, 免得farm上一堆client同时冲上去
+        """
+        delay = min(self.options['reconnect_max_delay'], self.options['reconnect_delay'] * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def should_reconnect(self, attempt):
+        attempts = self.options['reconnect_attempts']
+        return self.options['reconnect'] and not self.stopping and (attempts <= 0 or attempt < attempts)
+
+    def expect_reply(self, request_id):
+        """
+        先登记再发请求, 免得回复比登记还快
+        """
+        future = Future()
+        with self.pending_lock:
+            self.pending_replies[request_id] = future
+        return future
+
+    def drop_reply(self, request_id):
+        with self.pending_lock:
+            self.pending_replies.pop(request_id, None)
+
+    def resolve_reply(self, request_id, result):
+        with self.pending_lock:
+            future = self.pending_replies.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    # ------messages------
+    def new_request_id(self):
+        return next(self.request_ids) & 0xFFFFFFFF
+
+    def encode_message(self, opCode, parts=(), request_id=0):
+        """
+        v1: opcode后面直接跟parts
+        v2: 帧头(opcode, request_id, 长度)后面跟parts
+        """
+        if self.protocol >= PROTOCOL_V2:
+            buffers = packFrame(opCode, request_id, parts)
+        else:
+            buffers = [packInt(opCode), *parts]
+        self.capture_sent(opCode, request_id, parts)
+        self.telemetry.sent(opCode, sum(len(buffer) for buffer in buffers))
+        if opCode == HEARTBEAT:
+            self.telemetry.heartbeat_sent()
+        return buffers
+
+    def check_length(self, length):
+        """
+        v1的字符串和图像长度没有帧兜底, 和v2的帧一样不能超过MAX_FRAME_SIZE, 不然对面发错一个数就要分配好几G
+        """
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f'field too large: {length}')
+        return length
+
+    def encode_handshake(self):
+        self.capture_sent(HANDSHAKE, 0, ())
+        return [packInt(HANDSHAKE)]
+
+    def client_features(self):
+        """
+        想和对面商量着用的功能
+        """
+        features = {FEATURE_PIPELINE, FEATURE_CHUNKED, FEATURE_CANCEL, FEATURE_PARAMS}
+        if self.options['reconnect']:
+            features.add(FEATURE_RESUME)
+        if self.options['dedup']:
+            features.add(FEATURE_DEDUP)
+        if self.options['shared_memory'] and shared_memory is not None and self.is_local_peer():
+            features.add(FEATURE_SHM)
+        if self.options['raw_images']:
+            features.add(FEATURE_RAW)
+            codec = self.options['codec']
+            if codec == 'auto':
+                features |= codecFeatures(CODECS)
+            elif codec in CODECS:
+                features |= codecFeatures([codec])
+        return features
+
+    def encode_negotiate(self):
+        """
+        NEGOTIATE是在协商之前发的, 所以永远是v1的格式
+        """
+        parts = [packInt(PROTOCOL_V2), *packString(packFeatures(self.client_features()))]
+        self.capture_sent(NEGOTIATE, 0, parts)
+        return [packInt(NEGOTIATE), *parts]
+
+    def encode_resume(self):
+        return self.encode_message(RESUME, packString(self.session_id))
+
+    def capture_sent(self, opCode, request_id, parts):
+        if self.capture is not None:
+            self.capture.sent(opCode, request_id, parts, self.protocol >= PROTOCOL_V2)
+
+    def capture_received(self, opCode, request_id, payload=None, fields=()):
+        """
+        v2的给整个payload; v1的给一个个读出来的fields, 按INCOMING_LAYOUTS拼回去
+        """
+        if self.capture is None:
+            return
+        parts = [payload] if payload is not None else packFields(INCOMING_LAYOUTS.get(opCode, ()), fields)
+        self.capture.received(opCode, request_id, parts, self.protocol >= PROTOCOL_V2)
+
+    def apply_negotiation(self, version, features):
+        self.protocol = min(version, PROTOCOL_V2)
+        self.features = features & self.client_features() if self.protocol >= PROTOCOL_V2 else set()
+        self.codec = pickCodec(self.features)
+
+    def tune_socket(self, sock):
+        """
+        connect之前调用, 缓冲区大小要在握手之前定下来才有用
+        """
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.options['tcp_nodelay'] else 0)
+        size = self.options['socket_buffer']
+        if size > 0:
+            # 比系统给的小就不动了
+            for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+                if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                    sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+    def is_local_peer(self):
+        """
+        comfyBridge是不是在同一台机器上, 只认loopback和本机自己的地址
+        """
+        if self.local_peer is None:
+            try:
+                addresses = {info[4][0] for info in socket.getaddrinfo(self.host, self.port, proto=socket.IPPROTO_TCP)}
+                local = set()
+                try:
+                    local = set(socket.gethostbyname_ex(socket.gethostname())[2])
+                except OSError as e:
+                    pass
+                self.local_peer = any(
+                    address in local or ipaddress.ip_address(address.split('%')[0]).is_loopback
+                    for address in addresses
+                )
+            except (OSError, ValueError) as e:
+                self.local_peer = False
+        return self.local_peer
+
+    def encode_shm_attach(self):
+        """
+        建不了共享内存(比如/dev/shm满了)就返回None, 这次连接不用它
+        """
+        if self.shm_ring is None:
+            try:
+                self.shm_ring = ShmRing(self.options['shm_size'])
+            except (OSError, ValueError) as e:
+                print(f'~~~~~~~~~can not create shared memory:{e}')
+                self.features.discard(FEATURE_SHM)
+                return None
+        return self.encode_message(SHM_ATTACH, [*packString(self.shm_ring.name), packInt(self.shm_ring.size)])
+
+    def apply_shm_attach(self, attached, path):
+        """
+        对面attach不上(比如不是同一个用户跑的)就不用共享内存
+        给了unix socket路径的话记下来, 之后连这个server都走它
+        """
+        if not attached:
+            print('~~~~~~~~~ComfyBridge can not attach shared memory')
+            self.features.discard(FEATURE_SHM)
+            return
+        self.shm_ring.reset()
+        self.shm = self.shm_ring
+        if path and HAS_UNIX_SOCKET:
+            local_paths[(self.host, self.port)] = path
+
+    def should_switch_transport(self):
+        """
+        握手是走TCP做的, 对面给了unix socket的话断开换过去, 靠RESUME接着用同一个session
+        """
+        return self.transport == TRANSPORT_TCP and bool(local_paths.get((self.host, self.port)))
+
+    def handle_message(self, code, request_id, fields):
+        """
+        返回False表示这条连接不能再用了
+        """
+        self.last_activity = time.monotonic()
+        if code == HEARTBEAT:
+            self.telemetry.heartbeat_received()
+            if FEATURE_RESUME in self.features:
+                self.acknowledge(request_id)
+            self.on_heartbeat()
+        elif code == RESPONSED_IMAGE:
+            name, image_data, is_ok = fields
+            if request_id in self.cancelled:
+                print(f'~~~~~~~~~drop image {name} of cancelled job {request_id}')
+            elif is_ok == OK:
+                target, finished = self.on_job_image(request_id, name)
+                self.telemetry.prompt_image(request_id, finished)
+                pack = {
+                    'name':target, 'request_name':name, 'data':image_data,
+                    'job':request_id, 'server':(self.host, self.port)
+                }
+                if self.decoder is not None:
+                    self.decoder.submit(pack)
+                else:
+                    EventMan.Trigger('on_image_received', pack)
+            else:
+                print(f'~~~~~~~~~receive image error:{is_ok}')
+        elif code == IMAGE_MISS:
+            self.resolve_reply(request_id, fields[0])
+        elif code == CHUNK_ACK:
+            with self.pending_lock:
+                # 上传已经结束了的ACK不要再记回去
+                if request_id in self.uploads and fields[0] > self.uploads[request_id]:
+                    self.uploads[request_id] = fields[0]
+            self.resolve_reply(request_id, fields[0])
+        elif code == SHM_RELEASE:
+            if self.shm is not None:
+                self.shm.release(fields[0])
+        elif code == PROGRESS:
+            progress, max = fields
+            if request_id in self.cancelled:
+                return True
+            self.telemetry.prompt_progress(request_id)
+            EventMan.TriggerLatest('on_progress', {'progress':progress, 'max':max, 'job':request_id})
+        elif code == OK:
+            print('~~~~~~~~~receive ok')
+        elif code == ERROR:
+            if request_id != 0:
+                # v2里带id的ERROR只是这一个请求失败了, 连接还能用
+                print(f'~~~~~~~~~request {request_id} error')
+                self.end_job(request_id, False)
+                self.telemetry.prompt_failed(request_id)
+                return True
+            print(f'~~~~~~~~~receive error:{code}')
+            return False
+        elif self.protocol >= PROTOCOL_V2:
+            # 有帧长度兜底, 不认识的帧跳过就行
+            print(f'~~~~~~~~~skip unknown frame:{code}')
+        else:
+            print(f'~~~~~~~~~unknown operation:{code}')
+            return False
+        return True
+
+    # ------timers------
+    def on_heartbeat(self):
+        """
+        收到HEARTBEAT后过HEARTBEAT_DELAY再回一个, 还没到时间的那个作废, 不会越排越多
+        """
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.cancel()
+        self.heartbeat_timer = self.schedule(HEARTBEAT_DELAY, self.send_heartbeat)
+
+    def start_deadline(self):
+        self.last_activity = time.monotonic()
+        self.deadline_timer = self.schedule(self.options['dead_peer_timeout'], self.check_deadline)
+
+    def check_deadline(self):
+        """
+        收发的时候只记个时间, 到期了再看是不是真的这么久没动静, 不是就按最后一次的时间重新排
+        """
+        if not self.connected:
+            return
+        timeout = self.options['dead_peer_timeout']
+        idle = time.monotonic() - self.last_activity
+        if idle >= timeout:
+            print(f'~~~~~~~~~nothing from ComfyBridge for {idle:.1f}s, drop the connection')
+            self.abort_connection()
+            return
+        self.deadline_timer = self.schedule(timeout - idle, self.check_deadline)
+
+    def cancel_timers(self):
+        for timer in (self.heartbeat_timer, self.deadline_timer):
+            if timer is not None:
+                timer.cancel()
+        self.heartbeat_timer = None
+        self.deadline_timer = None
+
+    def on_upload_progress(self, request_id, sent, total):
+        """
+        和下载的PROGRESS一样走EventMan
+        """
+        EventMan.TriggerLatest('on_upload_progress', {'progress':sent, 'max':total, 'request':request_id})
+
+    def on_job_image(self, job_id, name):
+        """
+        收到一张图就从job里划掉, 全收到了这个job就结束了
+        返回(这张图改叫什么, job是不是结束了)
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return name, True
+            if name in job['names']:
+                job['names'].remove(name)
+            target = job['rename'].get(name, name)
+            finished = len(job['names']) == 0
+        if finished:
+            self.end_job(job_id, True)
+        return target, finished
+
+    def end_job(self, job_id, ok):
+        """
+        job从表里拿掉, 不在表里的(已经结束了, 或者v1里不记job)什么都不做, 返回None
+        """
+        with self.jobs_lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None:
+            EventMan.Trigger('on_job_finished', {'job':job_id, 'ok':ok, 'server':(self.host, self.port)})
+        return job
+
+    # ------connection state------
+    def on_connected(self):
+        print(f'ComfyBridge Handshake success, protocol v{self.protocol} ({self.backend_name})')
+        self.update_info(
+            isConnected=True, isConnecting=False, isReconnecting=False,
+            protocol=self.protocol, features=set(self.features), backend=self.backend_name,
+            codec=self.codec, transport=self.transport
+        )
+        self.start_deadline()
+
+    def on_connection_lost(self):
+        """
+        连接断了但还要重连: 等着的回复都取消掉, 排队的op, job, 没确认的op都留着
+        """
+        self.update_info(
+            isConnected=False, isReconnecting=True,
+            protocol=PROTOCOL_V1, features=set(), codec=CODEC_NONE, transport=''
+        )
+        self.reset_negotiation()
+        self.cancel_timers()
+        self.telemetry.connection_lost()
+
+        with self.pending_lock:
+            for future in self.pending_replies.values():
+                future.cancel()
+            self.pending_replies.clear()
+        with self.replay_lock:
+            waiter, self.ack_waiter = self.ack_waiter, None
+        if waiter is not None:
+            waiter.cancel()
+
+    def reset_negotiation(self):
+        """
+        这条连接上商量好的都作废, 断线和换transport的时候用
+        """
+        self.protocol = PROTOCOL_V1
+        self.features = set()
+        self.codec = CODEC_NONE
+        # 对面不会再释放了, 等着空间的也都叫醒
+        self.shm = None
+        if self.shm_ring is not None:
+            self.shm_ring.reset()
+
+    def on_disconnected(self):
+        self.on_connection_lost()
+        self.update_info(isClosing=False, isConnecting=False, isReconnecting=False)
+
+        with self.jobs_lock:
+            lost_jobs = list(self.jobs)
+        for job_id in lost_jobs:
+            self.end_job(job_id, False)
+        with self.jobs_lock:
+            self.cancelled.clear()
+        with self.replay_lock:
+            self.replay_log = []
+            self.replay_ops = []
+        # 对面重启了的话之前存的图就都没了, 保险起见从头来
+        self.image_index.clear()
+        if self.shm_ring is not None:
+            self.shm_ring.close()
+            self.shm_ring = None
+        if self.decoder is not None:
+            self.decoder.close()
+        if self.capture is not None:
+            self.capture.close()
+        self.on_closed()
+        print('~~~~~~~~~Disconnected')
+
+    def update_info(self, **values):
+        self.info.update(values)
+        self.on_info_changed()
+
+    # ------连接池(bridge_pool)里会换掉的, 单独用的时候就是下面这样------
+    def on_info_changed(self):
+        """
+        self.info改了之后调用
+        """
+        pass
+
+    def on_closed(self):
+        """
+        彻底断开了, 不会再重连
+        """
+        EventMan.stop()
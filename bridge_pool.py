@@ -0,0 +1,184 @@
+"""
+好几台comfyUI一起用: 每台一条BridgeClient, QueuePrompt派给排队最少的那台
+SendImages和SendRequestNames先记着, 派活的时候才发给选中的那台
+只发这次QueuePrompt之前SendImages的那些, 同名的只发最新的, 那台已经有的版本就不再发
+job id在整个池子里不重复, on_image_received带的job和server都能对上
+"""
+
+import functools
+import itertools
+import os
+import threading
+
+from .bridge_client import Connect_Info, newConnectInfo
+from .event import EventMan
+from .op_queue import PRIORITY_INTERACTIVE
+from .protocol import PROTOCOL_V1, CODEC_NONE
+
+
+class BridgePool:
+    def __init__(self, servers, backend_class, options=None):
+        """
+        servers: [(host, port)], 第一台是主的, 都一样闲的时候先给它
+        """
+        self.request_ids = itertools.count(1)
+        self.clients = []
+        for host, port in servers:
+            client = backend_class(host, port, self.member_options(options, host, port), newConnectInfo())
+            client.request_ids = self.request_ids
+            client.on_info_changed = functools.partial(self.on_client_changed, client)
+            client.on_closed = functools.partial(self.on_client_changed, client)
+            self.clients.append(client)
+
+        self.lock = threading.Lock()
+        # 名字 -> (版本, 图), 下一次QueuePrompt要发的, 同名的新的顶掉旧的; 派出去了就不再留着
+        self.images = {}
+        self.image_versions = itertools.count(1)
+        # client -> {名字: 那台已经有的版本}, 放进那台的发送队列了才记, 断线后就不作数了
+        self.sent_images = {client: {} for client in self.clients}
+        self.request_names = []
+        # client -> 一共派过去几个job, 一样闲的时候轮着来
+        self.dispatched = {client: 0 for client in self.clients}
+
+        self.info_lock = threading.Lock()
+        self.has_connected = False
+
+    def member_options(self, options, host, port):
+        """
+        抓包的话每台记到自己的文件里: xxx.cbcap -> xxx.host_port.cbcap
+        """
+        if not options or not options.get('capture'):
+            return options
+        root, ext = os.path.splitext(options['capture'])
+        return {**options, 'capture': f'{root}.{host}_{port}{ext}'}
+
+    # ------和BridgeClient一样用------
+    @property
+    def features(self):
+        """
+        连上的每一台都支持的才算, 图还不知道会派给哪台
+        """
+        features = [client.features for client in self.clients if client.connected]
+        return set.intersection(*features) if features else set()
+
+    def start(self):
+        for client in self.clients:
+            # 都先标成正在连, 免得第一台很快失败时以为全都结束了
+            client.info['isConnecting'] = True
+        for client in self.clients:
+            client.start()
+
+    def stop(self):
+        Connect_Info['isClosing'] = True
+        for client in self.clients:
+            client.stop()
+        Connect_Info['isClosing'] = False
+
+    def SendImages(self, image_names, image_datas, priority=PRIORITY_INTERACTIVE):
+        """
+        priority用的是之后QueuePrompt的, 派活的时候才真的发
+        """
+        with self.lock:
+            for name, image_data in zip(image_names, image_datas):
+                self.images[name] = (next(self.image_versions), image_data)
+
+    def SendRequestNames(self, names, priority=PRIORITY_INTERACTIVE, group_end=False):
+        """
+        后面跟着QueuePrompt的, 派活的时候才和它一组发给选中的那台
+        group_end=True的(比如只是改了receiver)后面没有QueuePrompt, 马上发给连着的每一台
+        没连着的那几台下次派到它们的时候QueuePrompt会补发
+        """
+        with self.lock:
+            self.request_names = list(names)
+        if group_end:
+            for client in self.clients:
+                if client.connected:
+                    client.SendRequestNames(names, priority, group_end)
+
+    def QueuePrompt(self, priority=PRIORITY_INTERACTIVE, params=None, rename=None):
+        """
+        返回job id, 和单独一条连接时一样
+        交互的job要先把所有server上重名的旧交互job都取消掉, 新的不一定派到同一台
+        """
+        with self.lock:
+            request_names = self.request_names
+        if priority == PRIORITY_INTERACTIVE:
+            for client in self.clients:
+                if client.options['supersede']:
+                    client.supersede([name for name in request_names if name != 'None'])
+
+        client = self.pick()
+        with self.lock:
+            images, self.images = self.images, {}
+            sent = self.sent_images[client]
+            names = [name for name, (version, _) in images.items() if sent.get(name) != version]
+            self.dispatched[client] += 1
+        # 队列满了可能会等, 不能拿着锁
+        queued = not names or client.SendImages(names, [images[name][1] for name in names], priority)
+        with self.lock:
+            for name in names:
+                if queued:
+                    self.sent_images[client][name] = images[name][0]
+                else:
+                    # 没放进去, 留给下一次QueuePrompt再发; 这中间又SendImages了同名的就用新的
+                    self.images.setdefault(name, images[name])
+        if client.request_names != request_names:
+            client.SendRequestNames(request_names, priority)
+        return client.QueuePrompt(priority, params, rename)
+
+    def CancelJob(self, job_id):
+        return any(client.CancelJob(job_id) for client in self.clients)
+
+    # ------派活------
+    def load(self, client):
+        """
+        还没收齐图的job数, 只有v2能数; v1的server一直是0, 靠dispatched轮着来
+        """
+        with client.jobs_lock:
+            return len(client.jobs)
+
+    def pick(self):
+        """
+        连着的里面job最少的; 一台都没连上就给还在重连的, 连上了再发
+        """
+        healthy = [client for client in self.clients if client.connected]
+        if not healthy:
+            healthy = [client for client in self.clients if client.info['isReconnecting']] or self.clients[:1]
+        return min(healthy, key=lambda client: (self.load(client), self.dispatched[client]))
+
+    # ------连接状态------
+    def on_client_changed(self, client):
+        """
+        某一台的info变了, 汇总到Connect_Info里给界面看
+        """
+        with self.info_lock:
+            if not client.info['isConnected']:
+                # 断过线的话对面可能重启了, 之前发过的图都重新发, 真还在的话dedup只会发hash
+                with self.lock:
+                    self.sent_images[client] = {}
+
+            connected = [other for other in self.clients if other.info['isConnected']]
+            self.has_connected = self.has_connected or bool(connected)
+            active = any(
+                other.info['isConnected'] or other.info['isConnecting'] or other.info['isReconnecting']
+                for other in self.clients
+            )
+            first = connected[0].info if connected else None
+            Connect_Info.update(
+                isConnected=bool(connected),
+                isConnecting=not connected and any(other.info['isConnecting'] for other in self.clients),
+                isReconnecting=not connected and any(other.info['isReconnecting'] for other in self.clients),
+                protocol=min(other.info['protocol'] for other in connected) if connected else PROTOCOL_V1,
+                features=self.features,
+                backend=first['backend'] if first else '',
+                codec=first['codec'] if first else CODEC_NONE,
+                transport=first['transport'] if first else '',
+                servers=(len(connected), len(self.clients)),
+            )
+            stopped = self.has_connected and not active
+            if stopped:
+                self.has_connected = False
+
+        if stopped:
+            # 和单独一条连接时一样, 全都断了才停
+            EventMan.stop()
@@ -0,0 +1,507 @@
+"""
+线程版的comfyBridge client
+一个线程连接, 一个线程发, 一个线程收, 定时的事都在一个scheduler线程里
+"""
+
+import socket
+from .bridge_client import (
+    BridgeClient, legacy_servers, local_paths, TRANSPORT_TCP, TRANSPORT_UNIX,
+    CONNECT_TIMEOUT, NEGOTIATE_TIMEOUT, REPLY_TIMEOUT
+)
+from .protocol import (
+    HANDSHAKE, HEARTBEAT, NEGOTIATE, RESUME, SHM_ATTACH, ERROR,
+    PROTOCOL_V2, FRAME_HEADER, MAX_FRAME_SIZE, INCOMING_LAYOUTS, FEATURE_RESUME, FEATURE_SHM,
+    unpackFeatures, fieldsSize, PayloadReader
+)
+from .scheduler import Scheduler
+from .telemetry import METRIC_CONNECT
+from concurrent.futures import Future, CancelledError, TimeoutError
+from collections import deque
+import threading
+import time
+
+
+# 一次recv_into最多读这么多, 4K的RGBA图也就几十次系统调用
+RECV_CHUNK_SIZE = 1024 * 1024
+# 大buffer拆成这么大一段一段发, 每段发完都算一次还活着
+SEND_CHUNK_SIZE = 1024 * 1024
+# 一次sendmsg最多带这么多段, linux上IOV_MAX是1024
+SEND_IOV_MAX = 1024
+# windows的socket没有sendmsg, 只能一段一段sendall
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class ThreadBridgeClient(BridgeClient):
+    backend_name = 'thread'
+
+    def __init__(self, host, port, options=None, info=None):
+        super().__init__(host, port, options, info)
+        self.client_socket = None
+        self.client_thread = None
+        self.reader_lock = threading.Lock()
+        self.writer_lock = threading.Lock()
+        # stop()的时候叫醒正在等着重连的client线程
+        self.stop_event = threading.Event()
+        self.scheduler = Scheduler()
+        # heartbeat之类的控制消息, scheduler线程放进来, sender线程在op之间插着发
+        self.control_messages = deque()
+
+    # ------BridgeClient------
+    def start(self):
+        self.scheduler.start()
+        self.client_thread = threading.Thread(target=self.client_loop)
+        self.client_thread.daemon = True
+        self.client_thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.stop_event.set()
+        self.connected = False
+        self.update_info(isClosing=True)
+        self.wake_sender()
+        self.close_socket()
+
+        if self.client_thread is not None:
+            try:
+                self.client_thread.join()
+            except Exception as e:
+                pass
+            self.client_thread = None
+        self.scheduler.stop()
+
+    def schedule(self, delay, callback):
+        return self.scheduler.call_later(delay, callback)
+
+    def send_heartbeat(self):
+        # 对面死了的话写socket会一直卡着, 那样断线检测也跑不了, 所以交给sender去写
+        self.control_messages.append((HEARTBEAT, (), 0))
+        self.wake_sender()
+
+    def abort_connection(self):
+        self.connected = False
+        self.shutdown_socket()
+
+    # ------socket------
+    def connect_socket(self):
+        try:
+            if self.client_socket is not None:
+                return False
+
+            path = local_paths.get((self.host, self.port))
+            if path and self.connect_unix(path):
+                return True
+
+            self.transport = TRANSPORT_TCP
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tune_socket(self.client_socket)
+            # 对面机器整个没了的话connect要等好几分钟才失败, 重连的时候等不起
+            self.client_socket.settimeout(CONNECT_TIMEOUT)
+            self.client_socket.connect((self.host, self.port))
+            self.client_socket.settimeout(None)
+            return True
+        except Exception as e:
+            print(f'Error in connectToComfyBridge: {e}')
+            self.client_socket = None
+            return False
+
+    def connect_unix(self, path):
+        """
+        comfyBridge在同一台机器上, 之前告诉过unix socket的路径
+        连不上(比如它重启后换了路径)就忘掉, 走TCP重新问
+        """
+        try:
+            self.client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.tune_socket(self.client_socket)
+            self.client_socket.settimeout(CONNECT_TIMEOUT)
+            self.client_socket.connect(path)
+            self.client_socket.settimeout(None)
+            self.transport = TRANSPORT_UNIX
+            return True
+        except Exception as e:
+            print(f'~~~~~~~~~unix socket {path} failed:{e}, use tcp')
+            self.close_socket()
+            local_paths.pop((self.host, self.port), None)
+            return False
+
+    def shutdown_socket(self):
+        """
+        光close叫不醒阻塞在recv里的receiver, 得先shutdown
+        """
+        if self.client_socket is not None:
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except Exception as e:
+                pass
+
+    def close_socket(self):
+        if self.client_socket is not None:
+            self.shutdown_socket()
+            try:
+                self.client_socket.close()
+            except Exception as e:
+                pass
+            self.client_socket = None
+
+    def write(self, buffers):
+        """
+        连接已经断了要抛出去, 不能当发成功了, 不然这个op就不会重发
+        """
+        if not self.connected or self.client_socket is None:
+            raise ConnectionError('not connected')
+        with self.writer_lock:
+            if HAS_SENDMSG:
+                self.send_vectored(buffers)
+            else:
+                for buffer in buffers:
+                    if len(buffer) <= SEND_CHUNK_SIZE:
+                        self.client_socket.sendall(buffer)
+                    else:
+                        view = memoryview(buffer).cast('B')
+                        for offset in range(0, len(view), SEND_CHUNK_SIZE):
+                            self.client_socket.sendall(view[offset:offset + SEND_CHUNK_SIZE])
+                            self.last_activity = time.monotonic()
+            self.frames_sent += 1
+        self.last_activity = time.monotonic()
+
+    def send_vectored(self, buffers):
+        """
+        一帧的帧头, 名字, 长度, 像素都是分开的小buffer, 不拼起来, 用sendmsg一起交给内核
+        每次最多SEND_CHUNK_SIZE字节, 大图还是一段一段的, 没发完的从断的地方接着发
+        """
+        views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+        index = 0
+        while index < len(views):
+            batch = []
+            size = 0
+            for view in views[index:index + SEND_IOV_MAX]:
+                piece = view[:SEND_CHUNK_SIZE - size]
+                batch.append(piece)
+                size += len(piece)
+                if size >= SEND_CHUNK_SIZE:
+                    break
+            sent = self.client_socket.sendmsg(batch)
+            self.last_activity = time.monotonic()
+            while sent > 0:
+                length = len(views[index])
+                if sent >= length:
+                    sent -= length
+                    index += 1
+                else:
+                    views[index] = views[index][sent:]
+                    sent = 0
+
+    def flush_control(self):
+        while self.control_messages:
+            opCode, parts, request_id = self.control_messages.popleft()
+            self.write(self.encode_message(opCode, parts, request_id))
+
+    def recv_into(self, view):
+        """
+        把view填满才返回, 对端断开就抛异常
+        recv一次不一定能读够, 少读了后面的数据就全乱了
+        """
+        size = len(view)
+        received = 0
+        while received < size:
+            count = self.client_socket.recv_into(view[received:], min(RECV_CHUNK_SIZE, size - received))
+            if count == 0:
+                raise ConnectionError('connection closed by ComfyBridge')
+            received += count
+            self.last_activity = time.monotonic()
+
+    def recv_exactly(self, size):
+        """
+        预先分配好长度, 直接读进去, 不再一包一包的拼bytes
+        """
+        buffer = bytearray(size)
+        self.recv_into(memoryview(buffer))
+        return buffer
+
+    def receive_int(self):
+        if not self.connected or self.client_socket is None:
+            return ERROR
+        with self.reader_lock:
+            int_bytes = self.recv_exactly(4)
+        return int.from_bytes(int_bytes, byteorder='big')
+
+    def receive_string(self):
+        if not self.connected or self.client_socket is None:
+            return ERROR
+        length = self.check_length(self.receive_int())
+        with self.reader_lock:
+            string_bytes = self.recv_exactly(length)
+        return string_bytes.decode('utf-8')
+
+    def receive_strings(self):
+        count = self.receive_int()
+        return [self.receive_string() for _ in range(count)]
+
+    def receive_image(self):
+        """
+        返回的是bytearray, 直接交给on_image_received, 不再复制
+        """
+        if not self.connected or self.client_socket is None:
+            return ERROR
+        image_length = self.check_length(self.receive_int())
+        with self.reader_lock:
+            image_data = self.recv_exactly(image_length)
+        return image_data
+
+    def receive_message(self):
+        """
+        返回(opCode, request_id, fields), 不认识的opCode的fields是None
+        v2的帧整个读进一块buffer里再拆, 图像是这块buffer的memoryview切片
+        """
+        if self.protocol >= PROTOCOL_V2:
+            with self.reader_lock:
+                opCode, request_id, length = FRAME_HEADER.unpack(self.recv_exactly(FRAME_HEADER.size))
+                if length > MAX_FRAME_SIZE:
+                    raise ConnectionError(f'frame too large: {length}')
+                payload = self.recv_exactly(length)
+            self.telemetry.received(opCode, FRAME_HEADER.size + length)
+            self.capture_received(opCode, request_id, payload)
+            layout = INCOMING_LAYOUTS.get(opCode)
+            if layout is None:
+                return opCode, request_id, None
+            return opCode, request_id, PayloadReader(payload).readFields(layout)
+
+        opCode = self.receive_int()
+        layout = INCOMING_LAYOUTS.get(opCode)
+        if layout is None:
+            self.telemetry.received(opCode, 4)
+            self.capture_received(opCode, 0)
+            return opCode, 0, None
+        readers = {
+            'int': self.receive_int,
+            'str': self.receive_string,
+            'strs': self.receive_strings,
+            'blob': self.receive_image,
+        }
+        fields = [readers[field]() for field in layout]
+        self.telemetry.received(opCode, 4 + fieldsSize(layout, fields))
+        self.capture_received(opCode, 0, fields=fields)
+        return opCode, 0, fields
+
+    # ------connection------
+    def negotiate(self):
+        """
+        HANDSHAKE之后问问对面支不支持v2
+        返回False表示对面不认识NEGOTIATE, 这条连接已经不可信了, 得断开用v1重连
+        """
+        self.client_socket.settimeout(NEGOTIATE_TIMEOUT)
+        try:
+            # 有的老版本收到不认识的opcode直接断开, 连NEGOTIATE都可能发不完
+            self.write(self.encode_negotiate())
+            if self.receive_int() != NEGOTIATE:
+                return False
+            version = self.receive_int()
+            features = self.receive_string()
+            self.capture_received(NEGOTIATE, 0, fields=[version, features])
+            features = unpackFeatures(features)
+        except (socket.timeout, ConnectionError) as e:
+            print(f'~~~~~~~~~negotiate failed:{e}')
+            return False
+        self.client_socket.settimeout(None)
+
+        self.apply_negotiation(version, features)
+        return True
+
+    def resume(self):
+        """
+        对面支持的话告诉它session id, 它记得这个session就能接着上次的来
+        """
+        if FEATURE_RESUME not in self.features:
+            self.resume_session(False, 0)
+            return True
+
+        self.client_socket.settimeout(NEGOTIATE_TIMEOUT)
+        try:
+            self.write(self.encode_resume())
+            code, _, fields = self.receive_message()
+        except (socket.timeout, ConnectionError) as e:
+            print(f'~~~~~~~~~resume failed:{e}')
+            return False
+        self.client_socket.settimeout(None)
+        if code != RESUME:
+            return False
+
+        resumed, frames = fields
+        self.resume_session(resumed != 0, frames)
+        return True
+
+    def attach_shm(self):
+        """
+        在同一台机器上的话告诉对面共享内存的名字, 它attach上了图像就都走共享内存
+        """
+        if FEATURE_SHM not in self.features:
+            return True
+        message = self.encode_shm_attach()
+        if message is None:
+            return True
+
+        self.client_socket.settimeout(NEGOTIATE_TIMEOUT)
+        try:
+            self.write(message)
+            code, _, fields = self.receive_message()
+        except (socket.timeout, ConnectionError) as e:
+            print(f'~~~~~~~~~shared memory attach failed:{e}')
+            return False
+        self.client_socket.settimeout(None)
+        if code != SHM_ATTACH:
+            return False
+
+        attached, path = fields
+        self.apply_shm_attach(attached != 0, path)
+        return True
+
+    def handshake(self):
+        """
+        连上之后先HANDSHAKE, 能协商就协商, 协商不了就重连一次用v1
+        """
+        self.write(self.encode_handshake())
+        if self.receive_int() != HANDSHAKE:
+            return False
+        self.capture_received(HANDSHAKE, 0)
+
+        server = (self.host, self.port)
+        if server in legacy_servers or self.negotiate():
+            return True
+
+        print('ComfyBridge does not support protocol v2, fall back to v1')
+        legacy_servers.add(server)
+        self.close_socket()
+        if not self.connect_socket():
+            return False
+        self.write(self.encode_handshake())
+        if self.receive_int() != HANDSHAKE:
+            return False
+        self.capture_received(HANDSHAKE, 0)
+        return True
+
+    def run_operation(self, operation):
+        steps = self.operation_steps(operation)
+        reply = None
+        while True:
+            try:
+                step = steps.send(reply)
+            except StopIteration:
+                self.finish_operation(operation)
+                return
+            reply = None
+            if isinstance(step, Future):
+                # 等的回复可能正是排着的HEARTBEAT要来的
+                self.flush_control()
+                try:
+                    reply = step.result(REPLY_TIMEOUT)
+                except (CancelledError, TimeoutError) as e:
+                    reply = None
+            else:
+                opCode, parts, request_id = step
+                self.write(self.encode_message(opCode, parts, request_id))
+                # 大图分块发的时候heartbeat从这里插进去
+                self.flush_control()
+
+    def wake_sender(self):
+        self.op_queues.wake()
+
+    def sender_loop(self):
+        while self.connected:
+            try:
+                self.flush_control()
+                operation = self.next_replay()
+                if operation is None:
+                    # 没活干就一直阻塞着, add_operation或者heartbeat一进来马上就发
+                    operation = self.op_queues.get()
+                    if operation is None:
+                        continue
+                self.run_operation(operation)
+            except Exception as e:
+                self.connected = False
+                print(f'~~~~~~~~~sender error:{e}')
+                # receiver可能还阻塞在recv里
+                self.shutdown_socket()
+
+    def receiver_loop(self):
+        while self.connected:
+            try:
+                code, request_id, fields = self.receive_message()
+                if not self.handle_message(code, request_id, fields):
+                    self.connected = False
+            except Exception as e:
+                self.connected = False
+                print(f'~~~~~~~~~receive error:{e}')
+
+        self.wake_sender()
+
+    def open_session(self, switching=False):
+        self.connected = False
+        if not self.connect_socket():
+            return False
+        self.connected = True
+
+        try:
+            is_ok = self.handshake() and self.resume() and self.attach_shm()
+        except Exception as e:
+            print(f'Error in connectToComfyBridge: {e}')
+            is_ok = False
+        if not is_ok:
+            print('ComfyBridge Handshake failed')
+            self.connected = False
+            self.close_socket()
+            return False
+
+        if not switching and self.should_switch_transport():
+            print('ComfyBridge is on this machine, switch to unix socket')
+            self.connected = False
+            self.close_socket()
+            self.reset_negotiation()
+            return self.open_session(switching=True)
+        return True
+
+    def run_session(self):
+        """
+        一直跑到连接断开
+        """
+        self.control_messages.clear()
+        self.on_connected()
+        try:
+            self.run_operation({'op': self.op_heartbeat, 'args': (), 'request_id': 0})
+        except Exception as e:
+            self.connected = False
+
+        sender_thread = threading.Thread(target=self.sender_loop)
+        receiver_thread = threading.Thread(target=self.receiver_loop)
+        sender_thread.start()
+        receiver_thread.start()
+        sender_thread.join()
+        receiver_thread.join()
+
+        self.close_socket()
+
+    def client_loop(self):
+        """
+        第一次就连不上直接放弃, 连上过之后断了就按reconnect_delay重连
+        """
+        self.update_info(isConnecting=True)
+        has_connected = False
+        attempt = 0
+        while not self.stopping:
+            started = time.monotonic()
+            if self.open_session():
+                self.telemetry.record(METRIC_CONNECT, time.monotonic() - started)
+                has_connected = True
+                attempt = 0
+                self.run_session()
+            if not has_connected or not self.should_reconnect(attempt):
+                break
+
+            self.on_connection_lost()
+            delay = self.reconnect_delay(attempt)
+            attempt += 1
+            print(f'ComfyBridge reconnecting in {delay:.1f}s ({attempt})')
+            self.stop_event.wait(delay)
+
+        self.update_info(isConnecting=False)
+        self.op_queues.clear()
+        if has_connected:
+            self.on_disconnected()
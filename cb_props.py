@@ -222,6 +222,10 @@ class CBProps(bpy.types.PropertyGroup):
         name = '', default=True,
     ) # type: ignore
 
+    show_telemetry: bpy.props.BoolProperty(
+        name = '', default=False,
+    ) # type: ignore
+
     background_index: bpy.props.IntProperty(
         default=-1,
     ) # type: ignore
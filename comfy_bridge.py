@@ -1,307 +1,116 @@
 """
 与comfyUI那边的comfyBridge通信的client
+具体怎么收发在bridge_thread和bridge_asyncio里, 这里只管选一个用
+配了好几台的话用bridge_pool把它们包起来
 """
 
-import socket
-from .event import EventMan
-import threading
-import time
-import queue
+from .bridge_client import Connect_Info
+from .bridge_thread import ThreadBridgeClient
+from .bridge_asyncio import AsyncioBridgeClient
+from .bridge_pool import BridgePool
+from .telemetry import Telemetry as ConnectionTelemetry
+from .op_queue import PRIORITY_INTERACTIVE
 
 
-'''
--------------------------------------------------------------
---OpCodes--
-'''
-HANDSHAKE = 101
-HEARTBEAT = 102
-
-SEND_IMAGE = 201
-REQUEST_IMAGE = 202
-QUEUE_PROMPT = 203
-RESPONSED_IMAGE = 204
-
-PROGRESS = 301
-
-ERROR = 404
-OK = 666
-'''
--------------------------------------------------------------
-'''
-
-Connect_Info = {
-    'isConnected': False,
-    'isClosing': False,
-    'isConnecting': False
+BACKENDS = {
+    'thread': ThreadBridgeClient,
+    'asyncio': AsyncioBridgeClient,
 }
+DEFAULT_BACKEND = 'thread'
 
-_connected = False
-
-op_queues = queue.Queue()
-client_socket = None
-client_thread = None
-
-reader_lock = threading.Lock()
-writer_lock = threading.Lock()
-
-def connectToComfyBridge(host, port):
-    global client_socket
-    try:
-        if Connect_Info['isConnected'] or client_socket is not None:
-            return False
-        
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((host, port))
-        return True
-    except Exception as e:
-        print(f'Error in connectToComfyBridge: {e}')
-        return False
-
-def sendInt(opCode):
-    if not _connected or client_socket is None:
-        return
-    with writer_lock:
-        client_socket.sendall(opCode.to_bytes(4, byteorder='big'))
-
-def sendString(string):
-    if not _connected or client_socket is None:
-        return
-    string_bytes = string.encode('utf-8')
-    length_bytes = len(string_bytes).to_bytes(4, byteorder='big')
-    with writer_lock:
-        client_socket.sendall(length_bytes)
-        client_socket.sendall(string_bytes)
-
-def sendImage(image_data):
-    if not _connected or client_socket is None:
-        return
-    image_length_bytes = len(image_data).to_bytes(4, byteorder='big')
-    with writer_lock:
-        client_socket.sendall(image_length_bytes)
-        client_socket.sendall(image_data)
-
-def receiveInt():
-    if not _connected or client_socket is None:
-        return ERROR
-    with reader_lock:
-        int_bytes = client_socket.recv(4)
-        return int.from_bytes(int_bytes, byteorder='big')
-
-def receiveString():
-    if not _connected or client_socket is None:
-        return ERROR
-    
-    length = receiveInt()
-    
-    with reader_lock:
-        string_bytes = client_socket.recv(length)
-    result = string_bytes.decode('utf-8')
-    return result
-
-def receiveImage():
-    if not _connected or client_socket is None:
-        return ERROR
-    
-    image_length = receiveInt()
-    with reader_lock:   
-        image_data = b''
-        while len(image_data) < image_length:
-            packet = client_socket.recv(min(4096, image_length - len(image_data)))
-            image_data += packet
-    return image_data
-
-def heartbeat():
-    step = 0.5
-    delay = 10
-    
-    def delayDo():
-        tick = 0
-        while _connected:
-            time.sleep(step)
-            tick += step
-            if not _connected:
-                return
-            if tick >= delay:
-                sendInt(HEARTBEAT)
-                tick = 0
-                return
-
-    threading.Thread(target=delayDo).start()
+_client = None
 
-
-'''
--------------------------------------------------------------
---Operations--
-'''
-def op_sendImages(names, image_datas):
-    if len(names) != len(image_datas):
-        return False
-    
-    sendInt(SEND_IMAGE)
-    sendInt(len(names))
-
-    for i in range(len(names)):
-        sendString(names[i])
-        sendImage(image_datas[i])
-
-def op_sendRequestNames(names):
-    sendInt(REQUEST_IMAGE)
-    sendInt(len(names))
-    for name in names:
-        sendString(name)
-
-def op_queuePrompt():
-    sendInt(QUEUE_PROMPT)
-
-def addOperation(op, *args):
-    global op_queues
-    op_queues.put({'op':op, 'args':args})
-
-'''
--------------------------------------------------------------
---socket loop--
-'''
-def sender_loop():
-    global _connected
-    while _connected:
-        try:
-            if not op_queues.empty():
-                operation = op_queues.get()
-                op = operation['op']
-                args = operation['args']
-                op(*args)
-            else:
-                time.sleep(0.025)
-        except Exception as e:
-            _connected = False
-            print(f'~~~~~~~~~sender error:{e}')
-
-def receiver_loop():
-    global _connected
-    while _connected:
-        try:
-            code = receiveInt()
-            if code == HEARTBEAT:
-                heartbeat()
-            elif code == RESPONSED_IMAGE:
-                name = receiveString()
-                image_data = receiveImage()
-                is_ok = receiveInt()
-                if is_ok == OK:
-                    EventMan.Trigger('on_image_received', {'name':name, 'data':image_data})
-                else:
-                    print(f'~~~~~~~~~receive image error:{is_ok}')
-            elif code == PROGRESS:
-                progress = receiveInt()
-                max = receiveInt()
-                EventMan.Trigger('on_progress', {'progress':progress, 'max':max})
-            elif code == OK:
-                print('~~~~~~~~~receive ok')
-                time.sleep(0.025)
-                continue
-            elif code == ERROR:
-                print(f'~~~~~~~~~receive error:{code}')
-                _connected = False
-            else:
-                print(f'~~~~~~~~~unknown operation:{code}')
-                _connected = False
-        except Exception as e:
-            _connected = False
-            print(f'~~~~~~~~~receive error:{e}')
-
-def client_loop(host, port):
-    global _connected
-    global op_queues
-    global client_thread
-    global client_socket
-
-    Connect_Info['isConnecting'] = True
-
-    _connected = False
-    if not connectToComfyBridge(host, port):
-        return
-    _connected = True
-
-    sendInt(HANDSHAKE)
-    opCode = receiveInt()
-
-    sender_thread = threading.Thread(target=sender_loop)
-    receiver_thread = threading.Thread(target=receiver_loop)
-    if opCode == HANDSHAKE:
-        print('ComfyBridge Handshake success')
-        Connect_Info['isConnected'] = True
-        Connect_Info['isConnecting'] = False
-
-        sendInt(HEARTBEAT)
-
-        sender_thread.start()
-        receiver_thread.start()
-    else:
-        print('ComfyBridge Handshake failed')
-        return
-    
-    sender_thread.join()
-    receiver_thread.join()
-
-    Connect_Info['isConnected'] = False
-    Connect_Info['isClosing'] = False
-    
-    if client_socket is not None:
-        try:
-            client_socket.close()
-        except Exception as e:
-            pass
-        client_socket = None
-
-    if client_thread is not None:
-        try:
-            client_thread.join()
-        except Exception as e:
-            pass
-        client_thread = None
-
-    op_queues.queue.clear()
-    EventMan.stop()
-    print('~~~~~~~~~Disconnected')
+def _clients():
+    if _client is None:
+        return []
+    if isinstance(_client, BridgePool):
+        return _client.clients
+    return [_client]
 
 '''
 -------------------------------------------------------------
 --Public Functions--
 '''
-def Connect(host, port=17777):
-    global client_thread
-    client_thread = threading.Thread(target=client_loop, args=(host, port))
-    client_thread.daemon = True
-    client_thread.start()
+def Connect(host, port=17777, backend=DEFAULT_BACKEND, options=None, servers=None):
+    """
+    options见bridge_client.DEFAULT_OPTIONS
+    servers: 另外几台comfyBridge的[(host, port)], 有的话每次QueuePrompt派给最闲的那台
+    """
+    global _client
+    if _client is not None:
+        _client.stop()
+    Connect_Info['isClosing'] = False
+    Connect_Info['servers'] = None
+    backend_class = BACKENDS.get(backend, BACKENDS[DEFAULT_BACKEND])
+    if servers:
+        _client = BridgePool([(host, port), *servers], backend_class, options)
+    else:
+        _client = backend_class(host, port, options)
+    _client.start()
 
 def Disconnect():
-    global _connected
-    global client_thread
-    global client_socket
-    _connected = False
-    Connect_Info['isClosing'] = True
-
-    if client_socket is not None:
-        try:
-            client_socket.close()
-        except Exception as e:
-            pass
-        client_socket = None
-
-    if client_thread is not None:
-        try:
-            client_thread.join()
-        except Exception as e:
-            pass
-        client_thread = None
-
-def SendImages(image_names, image_datas):
-    addOperation(op_sendImages, image_names, image_datas)
-
-def SendRequestNames(names):
-    addOperation(op_sendRequestNames, names)
-
-def QueuePrompt():
-    addOperation(op_queuePrompt)
-
-
+    global _client
+    if _client is not None:
+        _client.stop()
+        _client = None
+
+def HasFeature(feature):
+    """
+    当前连接有没有和comfyBridge商量好用这个功能, 见protocol里的FEATURE_xxx
+    """
+    return _client is not None and feature in _client.features
+
+def QueueStats():
+    """
+    op队列的计数: 排进去的, 被合并掉的, 满了被扔掉的, 最多同时排了多少
+    """
+    stats = {}
+    for client in _clients():
+        for key, value in client.op_queues.stats.items():
+            # 最多同时排了多少取最大的, 别的加起来
+            stats[key] = max(stats.get(key, 0), value) if key == 'peak' else stats.get(key, 0) + value
+    return stats
+
+def Telemetry():
+    """
+    每种opcode收发了多少, 几段关键耗时的分位数(秒), 见telemetry.Telemetry.snapshot
+    断开重连都接着记, 换一个client(重新Connect)才从头开始
+    """
+    clients = _clients()
+    if not clients:
+        return {}
+    if len(clients) == 1:
+        return clients[0].telemetry.snapshot()
+    # 连接池的话几台加在一起
+    telemetry = ConnectionTelemetry()
+    for client in clients:
+        telemetry.merge(client.telemetry)
+    return telemetry.snapshot()
+
+def ResetTelemetry():
+    for client in _clients():
+        client.telemetry.reset()
+
+def SendImages(image_names, image_datas, priority=PRIORITY_INTERACTIVE):
+    if _client is not None:
+        _client.SendImages(image_names, image_datas, priority)
+
+def SendRequestNames(names, priority=PRIORITY_INTERACTIVE, group_end=False):
+    """
+    后面不跟QueuePrompt的(比如只是改了receiver)要group_end=True
+    """
+    if _client is not None:
+        _client.SendRequestNames(names, priority, group_end)
+
+def QueuePrompt(priority=PRIORITY_INTERACTIVE, params=None, rename=None):
+    """
+    交互的(默认)会把要同名图的旧交互job取消掉, 批量的用op_queue.PRIORITY_BATCH
+    params, rename见BridgeClient.QueuePrompt
+    """
+    if _client is not None:
+        return _client.QueuePrompt(priority, params, rename)
+
+def CancelJob(job_id):
+    if _client is not None:
+        return _client.CancelJob(job_id)
+    return False
@@ -0,0 +1,89 @@
+"""
+按内容hash给图像去重
+场景没变的时候_D, _N, _L, _M每次都一模一样, 对面已经有了就只发个hash过去
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from .protocol import RawImage
+
+
+DIGEST_SIZE = 16
+
+
+def imageDigest(image_data):
+    """
+    PNG就hash文件内容, 裸像素把尺寸和类型也算进去, 跟用什么压缩无关
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    if isinstance(image_data, RawImage):
+        h.update(f'{image_data.width}x{image_data.height}x{image_data.channels}:{image_data.dtype}'.encode('utf-8'))
+        h.update(image_data.data)
+    else:
+        h.update(image_data)
+    return h.digest()
+
+
+class HashIndex:
+    """
+    有上限的LRU, digest -> (大小, 值)
+    client这边只记对面大概有哪些, 值是None; stand-in server那边值就是图像本身
+    超过条数或者总字节数就从最久没用过的开始扔
+    """
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, digest):
+        with self.lock:
+            return digest in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, digest):
+        """
+        找到了顺便挪到最新
+        """
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            self.entries.move_to_end(digest)
+            return entry[1]
+
+    def touch(self, digest):
+        with self.lock:
+            if digest not in self.entries:
+                return False
+            self.entries.move_to_end(digest)
+            return True
+
+    def add(self, digest, size, value=None):
+        with self.lock:
+            old = self.entries.pop(digest, None)
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.entries[digest] = (size, value)
+            self.total_bytes += size
+
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, (evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evicted += 1
+
+    def discard(self, digest):
+        with self.lock:
+            old = self.entries.pop(digest, None)
+            if old is not None:
+                self.total_bytes -= old[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
@@ -4,88 +4,456 @@
 """
 
 import bpy
+import collections
+import heapq
+import itertools
+import json
+import os
 import queue
+import threading
+import time
 
 FPS = 30
+# 一直没事做的话tick越隔越久, 最多隔这么久; 别的线程Trigger的最晚过这么久才处理
+IDLE_DELAY = 0.1
+# 连着这么多个tick没事做才开始拉长
+IDLE_TICKS = FPS
+
+class EventTrace:
+    """
+    EventMan.StartTrace()以后记下每个事件在哪个线程什么时候Trigger的, 什么时候取出来的, 每个handler花了多久
+    ExportTrace写成chrome://tracing和Perfetto都能打开的JSON
+    没开的时候Trigger只多看一下enabled, 排队的多带一个None
+    """
+    enabled = False
+    # 都是主线程在分发时加的, 太多了丢最早的
+    records = collections.deque(maxlen=200000)
+    # thread.ident -> 名字, Trigger的线程; 各个线程都会写, 读写都拿着threads_lock
+    threads = {}
+    threads_lock = threading.Lock()
+    ids = itertools.count(1)
+
+    @classmethod
+    def start(cls, max_records):
+        cls.records = collections.deque(maxlen=max_records)
+        with cls.threads_lock:
+            cls.threads = {}
+        cls.enabled = True
+
+    @classmethod
+    def triggered(cls):
+        """
+        Trigger的时候调, 返回跟着事件走的(序号, 时间, 线程)
+        """
+        thread = threading.current_thread()
+        with cls.threads_lock:
+            cls.threads[thread.ident] = thread.name
+        return (next(cls.ids), time.perf_counter(), thread.ident)
+
+    @classmethod
+    def handled(cls, kind, event_name, trace, start, end, handlers):
+        cls.records.append(('event', kind, event_name, trace, start, end, handlers))
+
+    @classmethod
+    def tick(cls, start, end, dispatched, backlog):
+        if dispatched:
+            cls.records.append(('tick', start, end, dispatched, backlog))
+
+    @classmethod
+    def export(cls, path):
+        """
+        Trace Event Format: tick和每个事件, handler是主线程上一层套一层的X, Trigger是发出的线程上的i
+        从Trigger到被取出来用flow连起来, 在Perfetto里能看到从哪个线程过来, 排了多久
+        """
+        pid = os.getpid()
+        main = threading.main_thread().ident
+        records = list(cls.records)
+
+        def begins(record):
+            if record[0] == 'tick':
+                return record[1]
+            trace = record[3]
+            return record[4] if trace is None else trace[1]
+        origin = min(map(begins, records), default=0.0)
+
+        def us(seconds):
+            return round((seconds - origin) * 1e6, 3)
+
+        events = [{'ph': 'M', 'name': 'process_name', 'pid': pid, 'args': {'name': 'Blender'}}]
+        with cls.threads_lock:
+            threads = {**cls.threads, main: threading.main_thread().name}
+        for ident, name in threads.items():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': ident, 'args': {'name': name}})
+
+        for record in records:
+            if record[0] == 'tick':
+                _, start, end, dispatched, backlog = record
+                events.append({'ph': 'X', 'name': 'tick', 'cat': 'tick', 'pid': pid, 'tid': main,
+                               'ts': us(start), 'dur': round((end - start) * 1e6, 3),
+                               'args': {'events': dispatched, 'backlog': backlog}})
+                continue
+
+            _, kind, event_name, trace, start, end, handlers = record
+            args = {'kind': kind, 'handlers': len(handlers)}
+            if trace is not None:
+                trace_id, triggered, ident = trace
+                args['queued_ms'] = round((start - triggered) * 1e3, 3)
+                args['trigger_thread'] = threads.get(ident, str(ident))
+                events.append({'ph': 'i', 'name': event_name, 'cat': 'trigger', 'pid': pid, 'tid': ident,
+                               'ts': us(triggered), 's': 't'})
+                events.append({'ph': 's', 'name': event_name, 'cat': 'flow', 'id': trace_id, 'pid': pid, 'tid': ident,
+                               'ts': us(triggered)})
+                events.append({'ph': 'f', 'bp': 'e', 'name': event_name, 'cat': 'flow', 'id': trace_id, 'pid': pid, 'tid': main,
+                               'ts': us(start)})
+            events.append({'ph': 'X', 'name': event_name, 'cat': 'event', 'pid': pid, 'tid': main,
+                           'ts': us(start), 'dur': round((end - start) * 1e6, 3), 'args': args})
+            for name, handler_start, handler_end in handlers:
+                events.append({'ph': 'X', 'name': name, 'cat': 'handler', 'pid': pid, 'tid': main,
+                               'ts': us(handler_start), 'dur': round((handler_end - handler_start) * 1e6, 3),
+                               'args': {'event': event_name}})
+
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        return len(records)
+
 
 class EventMan:
     is_running = False
     delay = 1.0 / FPS
+    # 一个tick最多花这么多秒在handler上, 剩下的留到下个tick, 中间blender能重画, 处理输入
+    # 至少处理一个, 一个handler自己就超了的没办法
+    budget = 0.008
+    # 最近分发一个事件平均花多久, 估计下一个做完会超budget就留到下个tick
+    event_cost = 0.0
+    # 现在排的下一个tick在多久后, 连着几个tick没事做了, 在不在process_events里
+    sleep = delay
+    idle_ticks = 0
+    in_tick = False
+    stats = {}
+    # event_name -> {id(listener): {'listener', 'handler'}}, 按Add的顺序, 分发时后加的先收到
+    # 监听者按是不是同一个对象认, 不用==比, gpu_baker那种大dict比起来太慢, 内容一样的两个也会被当成一个
+    # dict里留着listener本身, 还注册着的时候id不会被别的对象重用
     event_dict = {}
+    # 改event_dict的都要拿着它; 分发时只在拿快照的时候拿, 调handler的时候不拿, handler里可以Add/Remove
+    registry_lock = threading.Lock()
     GLOBAL_LISTENER = 'GlobalListener'
-    event_queue = queue.Queue()  # Thread-safe queue for events
+    event_queue = queue.Queue()  # Thread-safe queue for events, Post的event_name是None, args是要调的函数
+    # 还有几个tasks.py的Future没完, 不是0就算没有监听者也不停, 不然别的线程Post的就没人跑了
+    holds = 0
+    hold_lock = threading.Lock()
+    # TriggerLatest的: (event_name, id(target)) -> (target, 最新的args, trace), 每个tick处理一次
+    latest_events = {}
+    latest_lock = threading.Lock()
+    # TriggerAfter/TriggerAt的: (time.monotonic()的时间, 序号, event_name, args, target, trace)的最小堆
+    # trace都是EventTrace.triggered()的, 没在trace的时候是None
+    # 没到时间的只占着堆里的一格, 每个tick只看堆顶
+    timers = []
+    timer_ids = itertools.count()
+    timer_lock = threading.Lock()
 
     @classmethod
     def clear(cls):
-        cls.event_dict = {}
+        with cls.registry_lock:
+            cls.event_dict = {}
+        with cls.latest_lock:
+            cls.latest_events = {}
+        with cls.timer_lock:
+            cls.timers = []
+
+    @classmethod
+    def reset_stats(cls):
+        cls.stats = {
+            'ticks': 0,        # 一共几个tick
+            'busy_ticks': 0,   # 有事做的
+            'overruns': 0,     # 花的时间超了budget的
+            'carried': 0,      # 没做完留到下个tick的
+            'events': 0,       # 一共分发了几个
+            'busy_time': 0.0,  # 有事做的tick一共花了多少秒
+            'max_tick': 0.0,   # 最慢的一个tick
+            'max_overrun': 0.0,  # 最多超了多少秒
+            'max_backlog': 0,  # tick结束时最多还剩几个没处理
+        }
+
+    @classmethod
+    def record_tick(cls, elapsed, dispatched, backlog):
+        stats = cls.stats
+        stats['ticks'] += 1
+        if not dispatched:
+            return
+        stats['busy_ticks'] += 1
+        stats['events'] += dispatched
+        stats['busy_time'] += elapsed
+        stats['max_tick'] = max(stats['max_tick'], elapsed)
+        if elapsed > cls.budget:
+            stats['overruns'] += 1
+            stats['max_overrun'] = max(stats['max_overrun'], elapsed - cls.budget)
+        if backlog:
+            stats['carried'] += 1
+            stats['max_backlog'] = max(stats['max_backlog'], backlog)
+
+    @classmethod
+    def snapshot(cls, event_name, target):
+        """
+        这次要通知的监听者, 后加的在前面
+        target不是None的话只有它, 直接按id找, 不用一个个看
+        """
+        with cls.registry_lock:
+            listeners = cls.event_dict.get(event_name)
+            if not listeners:
+                return ()
+            if target is not None:
+                event = listeners.get(id(target))
+                return () if event is None else (event,)
+            return tuple(reversed(listeners.values()))
+
+    @classmethod
+    def dispatch(cls, event_name, args, target):
+        for event in cls.snapshot(event_name, target):
+            # 前面的handler里Remove掉了的监听者handler是空的; 自己的handler列表也复制一份再调, 调的时候可以删自己
+            handlers = event['handler']
+            if not handlers:
+                continue
+            listener = event['listener']
+            if listener is cls.GLOBAL_LISTENER:
+                for handler in tuple(handlers):
+                    handler(args)
+            else:
+                for handler in tuple(handlers):
+                    handler(listener, args)
+
+    @classmethod
+    def dispatch_traced(cls, event_name, args, target):
+        """
+        和dispatch一样, 另外返回每个handler的(名字, 开始, 结束)
+        """
+        handled = []
+        for event in cls.snapshot(event_name, target):
+            handlers = event['handler']
+            if not handlers:
+                continue
+            listener = event['listener']
+            for handler in tuple(handlers):
+                start = time.perf_counter()
+                if listener is cls.GLOBAL_LISTENER:
+                    handler(args)
+                else:
+                    handler(listener, args)
+                handled.append((getattr(handler, '__qualname__', repr(handler)), start, time.perf_counter()))
+        return handled
+
+    @classmethod
+    def run(cls, kind, event_name, args, target, trace):
+        start = time.perf_counter()
+        if event_name is None:
+            args()
+            end = time.perf_counter()
+            if EventTrace.enabled:
+                EventTrace.handled('call', getattr(args, '__qualname__', repr(args)), trace, start, end, ())
+        elif EventTrace.enabled:
+            handlers = cls.dispatch_traced(event_name, args, target)
+            end = time.perf_counter()
+            EventTrace.handled(kind, event_name, trace, start, end, handlers)
+        else:
+            cls.dispatch(event_name, args, target)
+            end = time.perf_counter()
+        cls.event_cost += (end - start - cls.event_cost) * 0.25
+
+    @classmethod
+    def has_time(cls, deadline, dispatched):
+        # 至少做一个, 不然一个慢的handler就永远轮不到
+        return dispatched == 0 or time.perf_counter() + cls.event_cost <= deadline
 
     @classmethod
     def process_events(cls):
-        delay_events = []
-        while not cls.event_queue.empty():
-            event_name, args, target = cls.event_queue.get()
-            if event_name in cls.event_dict:
-                for event in reversed(cls.event_dict[event_name]):
-                    if event['listener'] == target or target is None:
-                        for handler in event['handler']:
-                            if 'delay' in args and args['delay'] > 0:
-                                delay_events.append((event_name, args, event['listener']))
-                            else:
-                                # print(f"trigger event: {event_name}")
-                                if event['listener'] == cls.GLOBAL_LISTENER:
-                                    handler(args)
-                                else:
-                                    handler(event['listener'], args)
-        
-        for event in delay_events:
-            event[1]['delay'] -= 1;
-            cls.Trigger(*event)
-        
-        if cls.event_queue.empty() and len(cls.event_dict) == 0:
+        cls.in_tick = True
+        try:
+            return cls.tick()
+        finally:
+            cls.in_tick = False
+
+    @classmethod
+    def tick(cls):
+        start = time.perf_counter()
+        deadline = start + cls.budget
+        dispatched = 0
+
+        # 进度这种先处理, 同一个tick里之后到的图像之类的以它们为准
+        with cls.latest_lock:
+            latest_events, cls.latest_events = cls.latest_events, {}
+        if latest_events:
+            items = iter(list(latest_events.items()))
+            for (event_name, _), (target, args, trace) in items:
+                cls.run('latest', event_name, args, target, trace)
+                dispatched += 1
+                if not cls.has_time(deadline, dispatched):
+                    break
+            rest = dict(items)
+            if rest:
+                # 没做完的放回去, 这期间又来了新的就以新的为准
+                with cls.latest_lock:
+                    rest.update(cls.latest_events)
+                    cls.latest_events = rest
+
+        # 到时间了的按时间先后处理, 在这个tick里Trigger的前面
+        now = time.monotonic()
+        while cls.has_time(deadline, dispatched):
+            with cls.timer_lock:
+                if not cls.timers or cls.timers[0][0] > now:
+                    break
+                _, _, event_name, args, target, trace = heapq.heappop(cls.timers)
+            cls.run('timer', event_name, args, target, trace)
+            dispatched += 1
+
+        while cls.has_time(deadline, dispatched):
+            try:
+                event_name, args, target, trace = cls.event_queue.get_nowait()
+            except queue.Empty:
+                break
+            # print(f"trigger event: {event_name}")
+            cls.run('queue', event_name, args, target, trace)
+            dispatched += 1
+
+        with cls.latest_lock:
+            backlog = len(cls.latest_events)
+        backlog += cls.event_queue.qsize()
+        with cls.timer_lock:
+            next_due = cls.timers[0][0] if cls.timers else None
+        if next_due is not None and next_due <= now:
+            backlog += 1
+        end = time.perf_counter()
+        cls.record_tick(end - start, dispatched, backlog)
+        if EventTrace.enabled:
+            EventTrace.tick(start, end, dispatched, backlog)
+
+        with cls.registry_lock:
+            idle = len(cls.event_dict) == 0
+        if backlog == 0 and idle and next_due is None and cls.holds == 0:
             cls.stop()
-        
-        return cls.delay
-    
+            return cls.delay
+        if cls.delay is None:
+            return None
+
+        if backlog:
+            # 超了budget, 让blender先重画一下马上接着做
+            sleep = 0.0
+        elif dispatched:
+            cls.idle_ticks = 0
+            sleep = cls.delay
+        elif cls.holds:
+            # 有Future没完, 它们的结果多半是worker线程Post回来的, 那边wake不了, 不能睡长觉
+            cls.idle_ticks = 0
+            sleep = cls.delay
+        else:
+            # 一直闲着就越睡越久
+            cls.idle_ticks += 1
+            sleep = cls.delay if cls.idle_ticks < IDLE_TICKS else min(IDLE_DELAY, cls.sleep * 2)
+        # 下一个timer比这先到的话早点醒
+        if next_due is not None:
+            sleep = max(0.0, min(sleep, next_due - time.monotonic()))
+        cls.sleep = sleep
+        return sleep
+
+    @classmethod
+    def wake(cls):
+        """
+        在睡长觉的话, 主线程里来了事就马上排一个tick
+        别的线程碰不了bpy.app.timers, 只能等它自己醒, 最多IDLE_DELAY; Hold着的时候不睡长觉, 最多一帧
+        """
+        cls.idle_ticks = 0
+        # 先看是不是主线程: 别的线程里stop()随时可能把delay改成None
+        if threading.current_thread() is not threading.main_thread():
+            return
+        delay = cls.delay
+        if not cls.is_running or cls.in_tick or delay is None or cls.sleep <= delay:
+            return
+        if bpy.app.timers.is_registered(EventMan.process_events):
+            bpy.app.timers.unregister(EventMan.process_events)
+        cls.sleep = 0.0
+        bpy.app.timers.register(EventMan.process_events, first_interval=0.0)
+
     @classmethod
     def start(cls):
         if cls.is_running:
             return
-        
+
         # print("start event")
         cls.is_running = True
         cls.delay = 1.0 / FPS
+        cls.sleep = cls.delay
+        cls.idle_ticks = 0
         bpy.app.timers.register(EventMan.process_events, first_interval=cls.delay)
 
     @classmethod
     def stop(cls):
         if not cls.is_running:
             return
-        
+
         # print("stop event")
-        cls.is_running = False  
-        cls.delay = None
         cls.clear()
+        if cls.holds:
+            # 还有Future没完, 它们Post回来的还要跑, 不然等它们的永远等不到; holds归零了tick里自己停
+            return
+        cls.is_running = False
+        cls.delay = None
 
     # ------public methods------
+    @classmethod
+    def SetBudget(cls, seconds):
+        cls.budget = max(0.001, seconds)
+
+    @classmethod
+    def Stats(cls):
+        """
+        ResetStats以来每个tick的统计, 多了avg_tick: 有事做的tick平均花了几秒
+        """
+        stats = dict(cls.stats)
+        stats['avg_tick'] = stats['busy_time'] / stats['busy_ticks'] if stats['busy_ticks'] else 0.0
+        stats['budget'] = cls.budget
+        return stats
+
+    @classmethod
+    def ResetStats(cls):
+        cls.reset_stats()
+
+    @classmethod
+    def StartTrace(cls, max_records=200000):
+        """
+        之前记的清掉重新开始; 最多留max_records个事件和tick, 多了丢最早的
+        """
+        EventTrace.start(max_records)
+
+    @classmethod
+    def StopTrace(cls):
+        """
+        不再记了, 已经记下的还能ExportTrace
+        """
+        EventTrace.enabled = False
+
+    @classmethod
+    def IsTracing(cls):
+        return EventTrace.enabled
+
+    @classmethod
+    def ExportTrace(cls, path):
+        """
+        写成Chrome/Perfetto的trace JSON, 返回写了几条
+        """
+        return EventTrace.export(path)
+
     @classmethod
     def Add(cls, event_name, callback, listener=None):
         # print(f"add event: {event_name}")
-        if event_name not in cls.event_dict:
-            cls.event_dict[event_name] = []
-
         if listener is None:
             listener = cls.GLOBAL_LISTENER
 
-        registered = False
-        for event in cls.event_dict[event_name]:
-            if event['listener'] == listener:
+        with cls.registry_lock:
+            listeners = cls.event_dict.setdefault(event_name, {})
+            event = listeners.get(id(listener))
+            if event is None:
+                listeners[id(listener)] = {'listener': listener, 'handler': [callback]}
+            else:
                 event['handler'].append(callback)
-                registered = True
-                break
 
-        if not registered:
-            cls.event_dict[event_name].append({'listener': listener, 'handler': [callback]})
-        
         cls.start()
 
     @classmethod
@@ -93,23 +461,102 @@ class EventMan:
         if listener is None:
             listener = cls.GLOBAL_LISTENER
 
-        if event_name in cls.event_dict:
-            for i in range(len(cls.event_dict[event_name]) - 1, -1, -1):
-                event_args = cls.event_dict[event_name][i]
-                if event_args['listener'] == listener:
-                    if callback in event_args['handler']:
-                        event_args['handler'].remove(callback)
+        with cls.registry_lock:
+            listeners = cls.event_dict.get(event_name)
+            if listeners is None:
+                return
+            event = listeners.get(id(listener))
+            if event is None:
+                return
+            if callback in event['handler']:
+                event['handler'].remove(callback)
 
-                    if not event_args['handler']:
-                        cls.event_dict[event_name].pop(i)
+            if not event['handler']:
+                listeners.pop(id(listener))
 
-                    if len(cls.event_dict[event_name]) == 0:
-                        cls.event_dict.pop(event_name)
+            if len(listeners) == 0:
+                cls.event_dict.pop(event_name)
 
     @classmethod
     def Trigger(cls, event_name, args=None, target=None):
-        if event_name in cls.event_dict:
-            cls.event_queue.put((event_name, args, target))
+        """
+        任何线程都能调, 真的分发在主线程的process_events里
+        target: 只通知这一个监听者(Add时给的那个对象本身)
+        args里带'delay'的是以前的写法: 晚这么多帧(按FPS算)再处理, 现在就是TriggerAfter
+        """
+        if isinstance(args, dict) and args.get('delay', 0) > 0:
+            cls.TriggerAfter(args['delay'] / FPS, event_name, args, target)
+            return
+        with cls.registry_lock:
+            registered = event_name in cls.event_dict
+        if registered:
+            trace = EventTrace.triggered() if EventTrace.enabled else None
+            cls.event_queue.put((event_name, args, target, trace))
+            cls.wake()
+
+    @classmethod
+    def TriggerAfter(cls, seconds, event_name, args=None, target=None):
+        """
+        过seconds秒再处理, 按的是真的时间, 不是数帧; 准不准看process_events多久跑一次, 最多晚一帧
+        到时间时还没人监听就算了
+        """
+        cls.TriggerAt(time.monotonic() + seconds, event_name, args, target)
+
+    @classmethod
+    def TriggerAt(cls, when, event_name, args=None, target=None):
+        """
+        when是time.monotonic()的时间, 已经过了的下一个tick就处理
+        """
+        trace = EventTrace.triggered() if EventTrace.enabled else None
+        with cls.timer_lock:
+            heapq.heappush(cls.timers, (when, next(cls.timer_ids), event_name, args, target, trace))
+        if threading.current_thread() is threading.main_thread():
+            # 还没有监听者的时候EventMan可能没在跑, 不然这个timer就一直没人管
+            cls.start()
+            cls.wake()
+
+    @classmethod
+    def Post(cls, callback):
+        """
+        任何线程都能调, callback()在主线程的tick里跑, 和Trigger的排在同一个队列里, 先来先跑
+        不看有没有监听者; EventMan没在跑的话要在主线程里Post或者先Hold
+        """
+        trace = EventTrace.triggered() if EventTrace.enabled else None
+        cls.event_queue.put((None, callback, None, trace))
+        if threading.current_thread() is threading.main_thread():
+            cls.start()
+        cls.wake()
+
+    @classmethod
+    def Hold(cls):
+        """
+        Release之前没有监听者也一直跑着; 在主线程里调的话顺便start
+        """
+        with cls.hold_lock:
+            cls.holds += 1
+        if threading.current_thread() is threading.main_thread():
+            cls.start()
+            cls.wake()
+
+    @classmethod
+    def Release(cls):
+        with cls.hold_lock:
+            cls.holds = max(0, cls.holds - 1)
+
+    @classmethod
+    def TriggerLatest(cls, event_name, args=None, target=None):
+        """
+        只关心最新值的(比如进度), 两次process_events之间来多少个都只处理最后一个
+        不支持delay
+        """
+        with cls.registry_lock:
+            registered = event_name in cls.event_dict
+        if registered:
+            trace = EventTrace.triggered() if EventTrace.enabled else None
+            # 和Add/Remove一样按id认target, 不要求它能hash; target放在值里, 没处理之前id不会被别的对象用掉
+            with cls.latest_lock:
+                cls.latest_events[(event_name, id(target))] = (target, args, trace)
+            cls.wake()
 
-    
 
+EventMan.reset_stats()
@@ -4,19 +4,13 @@
 
 import bpy
 from .event import EventMan
+from .tasks import SubmitBackground, Then, ReportErrors
 import io
-import threading
 from .utils import get_mesh_data_for_gpu
 from .gpu_render import OffScreenCommandBuffer, ShaderBatch
 
 
-def bake(listener, args):
-    obj = listener["obj"]
-    if obj != args["object"]:
-        return
-
-    EventMan.Remove("mesh_data_for_gpu_ready", bake, listener)
-
+def bake(params, mesh_data):
     baker_vs = io.open("./glsl/baker.vs", "r").read()
     baker_fs = io.open("./glsl/baker.fs", "r").read()
 
@@ -24,15 +18,14 @@ def bake(listener, args):
     expand_fs = io.open("./glsl/expand.fs", "r").read()
 
     # input parameters
-    size = listener["size"]
-    modelMatrix = listener["modelMatrix"]
-    camera_pos = listener["camera_pos"]
-    camera_dir = listener["camera_dir"]
-    base_image = listener["base_image"]
-    proj_image = listener["proj_image"]
-    blend = listener["blend"]
-
-    mesh_data = args["data"]
+    size = params["size"]
+    modelMatrix = params["modelMatrix"]
+    camera_pos = params["camera_pos"]
+    camera_dir = params["camera_dir"]
+    base_image = params["base_image"]
+    proj_image = params["proj_image"]
+    blend = params["blend"]
+
     vertices = mesh_data["pos"]
     uvs = mesh_data["uv"]
     uv_proj = mesh_data["attributes"]["uv_proj"]
@@ -187,7 +180,7 @@ def StartBake(active_obj, size=1024):
     blend_offset = active_obj.projection_props.offset
     blend_range = active_obj.projection_props.blend
     
-    EventMan.Add("mesh_data_for_gpu_ready", bake, {
+    params = {
         "obj": active_obj,
         "size": size,
         "modelMatrix": modelMatrix,
@@ -196,20 +189,14 @@ def StartBake(active_obj, size=1024):
         "base_image": base_image,
         "proj_image": proj_image,
         "blend": (blend_offset, blend_range),
-    })
+    }
 
     depsgraph = bpy.context.evaluated_depsgraph_get()
     eval_mesh = active_obj.evaluated_get(depsgraph)
     eval_mesh_data = eval_mesh.data
 
-    def get_mesh_data_thread():
-        mesh_data = get_mesh_data_for_gpu(eval_mesh, eval_mesh_data, attribute_names=["uv_proj"])
-        EventMan.Trigger("mesh_data_for_gpu_ready", {"object": active_obj, "data": mesh_data})
-    
-    thread = threading.Thread(
-        target=get_mesh_data_thread
-    )
-    thread.start()
+    mesh_future = SubmitBackground(get_mesh_data_for_gpu, eval_mesh, eval_mesh_data, attribute_names=["uv_proj"])
+    ReportErrors(Then(mesh_future, lambda mesh_data: bake(params, mesh_data)), f"{active_obj.name} bake")
 
 
     
\ No newline at end of file
@@ -1,10 +1,13 @@
 import bpy
 from .event import EventMan
+from .tasks import SubmitBackground, Then, WhenAll, ReportErrors
 from .utils import get_mesh_data_for_gpu
-import threading
 from .gpu_render import ShaderBatch, OffScreenCommandBuffer
 from .utils import GetCameraVPMatrix
+from .comfy_bridge import HasFeature
+from .protocol import FEATURE_RAW, RawImage, DTYPE_FLOAT16
 from mathutils import Vector
+import numpy
 import os
 import tempfile
 
@@ -23,8 +26,10 @@ class DepthNormalRenderer:
         self.mesh_data = {}
         self.size = resolution
         self.collection_name = collection_name
-        self.in_loading = False
-        self.data_ready = False
+        # 所有物体的mesh data都取好了的Future, 几种图共用一次
+        self.mesh_future = None
+        # comfyBridge能收裸像素就不存PNG了
+        self.raw = HasFeature(FEATURE_RAW)
         
         collection = bpy.data.collections.get(self.collection_name)
         if collection:
@@ -62,48 +67,39 @@ class DepthNormalRenderer:
         if len(self.objects) == 0:
             return
 
-        if not self.data_ready:
-            self._get_mesh_data(callback)
-        else:
-            callback() 
-
-    def _on_mesh_data_ready(self, listener, data):
-        self.mesh_data[data["object"]] = data["data"]
-
-        self.data_ready = True
-        for obj in self.objects:
-            if obj not in self.mesh_data:
-                self.data_ready = False
-                break
-
-        if self.data_ready:
-            EventMan.Remove("mesh_data_for_gpu_ready", self._on_mesh_data_ready, listener)
-            if listener["fn"]:
-                listener["fn"]()
-
-    def _get_mesh_data(self, callback):
-        EventMan.Add("mesh_data_for_gpu_ready", self._on_mesh_data_ready, {"fn": callback})
-
-        if self.in_loading:
-            return
-
-        self.in_loading = True
-
-        def get_mesh_data_thread(obj, eval_mesh, eval_mesh_data):
-            data = get_mesh_data_for_gpu(eval_mesh, eval_mesh_data)
-            EventMan.Trigger("mesh_data_for_gpu_ready", {"object": obj, "data": data})
+        if self.mesh_future is None:
+            self.mesh_future = self._get_mesh_data()
+        ReportErrors(Then(self.mesh_future, lambda _: callback()), f"{self.collection_name} {callback.__name__}")
 
+    def _get_mesh_data(self):
+        futures = []
         for obj in self.objects:
             # 这一步丢thread里会在非Camera视图时闪退
             depsgraph = bpy.context.evaluated_depsgraph_get()
             eval_mesh = obj.evaluated_get(depsgraph)
             eval_mesh_data = eval_mesh.data
+            futures.append(SubmitBackground(get_mesh_data_for_gpu, eval_mesh, eval_mesh_data))
 
-            thread = threading.Thread(
-                target=get_mesh_data_thread,
-                args=(obj, eval_mesh, eval_mesh_data, )
-            )
-            thread.start()
+        def on_mesh_data(datas):
+            self.mesh_data = dict(zip(self.objects, datas))
+
+        return Then(WhenAll(futures), on_mesh_data)
+
+    def _output(self, image_name, buffer, is_float=False):
+        """
+        能发裸像素就直接把buffer交出去, 省掉存PNG再读回来
+        """
+        if not self.raw:
+            self._encode_png(image_name, buffer)
+            return
+
+        if is_float:
+            # 深度用半精度就够了, 比float32少一半数据
+            data = numpy.frombuffer(buffer, dtype=numpy.float32).astype(numpy.float16)
+            image = RawImage(self.size[0], self.size[1], data, dtype=DTYPE_FLOAT16)
+        else:
+            image = RawImage(self.size[0], self.size[1], buffer)
+        EventMan.Trigger("image_ready_to_send", {"name": image_name, "data": image, "cleanup": False})
 
     def _encode_png(self, image_name, buffer):
         if image_name not in bpy.data.images:
@@ -124,8 +120,7 @@ class DepthNormalRenderer:
                 os.remove(tmp_path)
             EventMan.Trigger("image_ready_to_send", {"name": image_name, "data": image_data, "cleanup": not self.debug, "image": image})
 
-        thread = threading.Thread(target=encode_png_thread)
-        thread.start()
+        ReportErrors(SubmitBackground(encode_png_thread), f"{image_name} png")
 
     def _render_depth(self):
         depth_vs = open("./glsl/depth.vs").read()
@@ -163,7 +158,8 @@ class DepthNormalRenderer:
                 matrix=obj.matrix_world
             )
 
-        cmb = OffScreenCommandBuffer(self.size)
+        # 发裸像素时深度画到半精度的float上, 不用挤在8bit里
+        cmb = OffScreenCommandBuffer(self.size, format='RGBA16F' if self.raw else 'RGBA8')
         cmb.clear((0,0,0,1))
         cmb.matrix_push()
         cmb.draw(depth_batch)
@@ -171,7 +167,7 @@ class DepthNormalRenderer:
         buffer = cmb.execute()
 
         image_name = f"{self.collection_name}_D"
-        self._encode_png(image_name, buffer)
+        self._output(image_name, buffer, is_float=self.raw)
 
     def _render_normal(self):
         normal_vs = open("./glsl/normal.vs").read()
@@ -218,7 +214,7 @@ class DepthNormalRenderer:
         buffer = cmb.execute()
 
         image_name = f"{self.collection_name}_N"
-        self._encode_png(image_name, buffer)
+        self._output(image_name, buffer)
 
     def _render_lineart(self):
         lineart_vs = open("./glsl/lineart.vs").read()
@@ -282,7 +278,7 @@ class DepthNormalRenderer:
         buffer = cmb.execute()
         
         image_name = f"{self.collection_name}_L"
-        self._encode_png(image_name, buffer)
+        self._output(image_name, buffer)
 
     def _render_mask(self):
         # 就填充个白色，没必要再写一个shader
@@ -332,4 +328,4 @@ class DepthNormalRenderer:
         buffer = cmb.execute()
         
         image_name = f"{self.collection_name}_M"
-        self._encode_png(image_name, buffer)
+        self._output(image_name, buffer)
@@ -180,11 +180,13 @@ class OffScreenCommandBuffer:
     """
     一个简陋的gpu offscreen渲染流程, 现在是用到哪写到哪
     抗锯齿什么的? 人家comfyUI那边在意吗?
+
+    format: 'RGBA8'时execute返回0~255的UBYTE buffer, 'RGBA16F'之类的返回FLOAT buffer
     """
-    def __init__(self, render_size):
+    def __init__(self, render_size, format='RGBA8'):
         self.render_size = render_size
-        self.offscreen_A = gpu.types.GPUOffScreen(render_size[0], render_size[1])
-        self.offscreen_B = gpu.types.GPUOffScreen(render_size[0], render_size[1])
+        self.offscreen_A = gpu.types.GPUOffScreen(render_size[0], render_size[1], format=format)
+        self.offscreen_B = gpu.types.GPUOffScreen(render_size[0], render_size[1], format=format)
         self.offscreen = self.offscreen_A
         self.commands = []
         self.fb = None
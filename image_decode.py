@@ -0,0 +1,212 @@
+"""
+收到的图在内存里解码成blender要的像素, 不再存临时文件让blender去读
+解码在一个单独的线程里做, 主线程上只剩一次pixels.foreach_set
+numpy是blender自带的; PNG用numpy+zlib自己解(comfyUI出的8bit RGB/RGBA, 不隔行), 装了PIL的话用PIL更快
+别的PNG(调色板, 16bit, 隔行)没有PIL就交回主线程用image.pack从内存里读
+"""
+
+import io
+import queue
+import struct
+import threading
+import zlib
+
+from .event import EventMan
+from .protocol import DTYPE_UINT8, DTYPE_FLOAT16, DTYPE_FLOAT32, isRawImage, unpackRawImage
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHUNK = struct.Struct('>I4s')
+PNG_IHDR = struct.Struct('>IIBBBBB')
+# color type -> 通道数, 调色板(3)不管
+PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+class DecodedImage:
+    """
+    pixels是一维的float32, 按blender的习惯: RGBA, 行从下往上
+    is_float: 原来就是float的数据, blender那边要建float buffer的图
+    """
+    def __init__(self, width, height, pixels, is_float=False):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        self.is_float = is_float
+
+
+def canDecode():
+    return numpy is not None
+
+def unfilterRows(data, filters, bpp):
+    """
+    data: (height, width, bpp)的uint8, 每行还是过滤过的; filters: 每行的过滤类型
+    只有None/Sub/Up的话一行一行整行做; 有Average/Paeth(要用左边刚解出来的像素)的话按反对角线扫,
+    一条对角线上的像素互相不依赖, 一次算完一条, 循环次数是宽+高而不是宽*高
+    """
+    height, width, _ = data.shape
+    if filters.max(initial=0) <= 2:
+        out = numpy.empty_like(data)
+        previous = numpy.zeros((width, bpp), dtype=numpy.uint8)
+        for row, kind in enumerate(filters):
+            line = data[row]
+            if kind == 1:
+                # uint8的cumsum自己就是模256
+                line = numpy.cumsum(line, axis=0, dtype=numpy.uint8)
+            elif kind == 2:
+                line = line + previous
+            out[row] = line
+            previous = out[row]
+        return out
+
+    # 多一行一列0, 第一行的上面和第一列的左边都当成0
+    out = numpy.zeros((height + 1, width + 1, bpp), dtype=numpy.int16)
+    source = data.astype(numpy.int16)
+    kinds = filters.astype(numpy.int16)
+    for diagonal in range(height + width - 1):
+        rows = numpy.arange(max(0, diagonal - width + 1), min(height - 1, diagonal) + 1)
+        columns = diagonal - rows
+        a = out[rows + 1, columns]
+        b = out[rows, columns + 1]
+        c = out[rows, columns]
+        kind = kinds[rows][:, None]
+        p = a + b - c
+        pa = numpy.abs(p - a)
+        pb = numpy.abs(p - b)
+        pc = numpy.abs(p - c)
+        paeth = numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+        predicted = numpy.select(
+            (kind == 1, kind == 2, kind == 3, kind == 4),
+            (a, b, (a + b) >> 1, paeth),
+            0,
+        )
+        out[rows + 1, columns + 1] = (source[rows, columns] + predicted) & 0xFF
+    return out[1:, 1:].astype(numpy.uint8)
+
+def decodePng(blob):
+    """
+    8bit, 不隔行的灰度/RGB/RGBA, 返回(height, width, channels)的uint8; 别的返回None
+    """
+    view = memoryview(blob).cast('B')
+    offset = len(PNG_SIGNATURE)
+    header = None
+    idat = []
+    while offset + PNG_CHUNK.size <= len(view):
+        length, kind = PNG_CHUNK.unpack_from(view, offset)
+        data = view[offset + PNG_CHUNK.size:offset + PNG_CHUNK.size + length]
+        # 后面还有4字节crc, 数据错了zlib的adler会发现
+        offset += PNG_CHUNK.size + length + 4
+        if kind == b'IHDR':
+            header = PNG_IHDR.unpack_from(data)
+        elif kind == b'IDAT':
+            idat.append(data)
+        elif kind == b'IEND':
+            break
+    if header is None:
+        return None
+    width, height, depth, color_type, _, _, interlace = header
+    channels = PNG_CHANNELS.get(color_type)
+    if depth != 8 or channels is None or interlace != 0:
+        return None
+
+    decompressor = zlib.decompressobj()
+    raw = b''.join(decompressor.decompress(data) for data in idat)
+    stride = width * channels
+    if len(raw) < height * (stride + 1):
+        raise ValueError('truncated PNG data')
+    rows = numpy.frombuffer(raw, dtype=numpy.uint8, count=height * (stride + 1)).reshape(height, stride + 1)
+    filters = rows[:, 0]
+    if filters.max(initial=0) > 4:
+        raise ValueError('bad PNG filter type')
+    data = rows[:, 1:].reshape(height, width, channels)
+    return unfilterRows(data, filters, channels)
+
+def decodeImage(blob):
+    """
+    返回DecodedImage, 这里解不了的(没有PIL时调色板/16bit/隔行的PNG, 不认识的格式)返回None
+    """
+    if numpy is None:
+        return None
+
+    if isRawImage(blob):
+        image = unpackRawImage(blob)
+        dtype = {DTYPE_UINT8: numpy.uint8, DTYPE_FLOAT16: numpy.float16, DTYPE_FLOAT32: numpy.float32}[image.dtype]
+        array = numpy.frombuffer(image.data, dtype=dtype).reshape(image.height, image.width, image.channels)
+        bottom_up = image.bottom_up
+    elif Image is not None and bytes(blob[:len(PNG_SIGNATURE)]) == PNG_SIGNATURE:
+        with Image.open(io.BytesIO(blob)) as image:
+            if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            array = numpy.asarray(image)
+        if array.ndim == 2:
+            array = array[:, :, None]
+        bottom_up = False
+    elif bytes(blob[:len(PNG_SIGNATURE)]) == PNG_SIGNATURE:
+        array = decodePng(blob)
+        if array is None:
+            return None
+        bottom_up = False
+    else:
+        return None
+
+    height, width, channels = array.shape
+    is_float = array.dtype != numpy.uint8
+    pixels = numpy.empty((height, width, 4), dtype=numpy.float32)
+    # 灰度复制到RGB, 没有alpha的补1
+    if channels < 3:
+        pixels[:, :, :3] = array[:, :, :1]
+    else:
+        pixels[:, :, :3] = array[:, :, :3]
+    if channels in (2, 4):
+        pixels[:, :, 3] = array[:, :, -1]
+    else:
+        pixels[:, :, 3] = 255 if not is_float else 1.0
+    if not is_float:
+        pixels *= 1.0 / 255
+    if not bottom_up:
+        pixels = pixels[::-1]
+    return DecodedImage(width, height, numpy.ascontiguousarray(pixels).reshape(-1), is_float)
+
+
+class ImageDecoder:
+    """
+    一个线程按收到的顺序解码, 同名的图先到的先生效
+    解完了把pixels塞进pack里再Trigger on_image_received, 解不了的pixels就是None
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, pack):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put(pack)
+
+    def close(self):
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread = None
+
+    def run(self):
+        while True:
+            pack = self.queue.get()
+            if pack is None:
+                return
+            try:
+                pack['pixels'] = decodeImage(pack['data'])
+            except Exception as e:
+                print(f'~~~~~~~~~decode image {pack["name"]} failed:{e}')
+                pack['pixels'] = None
+            EventMan.Trigger('on_image_received', pack)
@@ -0,0 +1,233 @@
+"""
+client发送用的op队列
+有上限, 满了按overflow策略处理; 带key的op还没发出去时, 同key的新op直接顶替它
+按priority分几条队, 交互的先发, 批量的等交互的发完再发
+线程安全, blender主线程往里放, sender线程(或者asyncio的loop)往外拿
+"""
+
+import threading
+import time
+from collections import deque
+
+
+# 满了把最早排进来的那一组(到group_end为止)扔掉, 新的照样进来; 只扔半组的话剩下的QUEUE_PROMPT用的图就不对了
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+# 满了新来的直接扔掉
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+# 满了等一会儿, 还是满的就扔掉新来的
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+# OVERFLOW_BLOCK最多等这么久, 放op的一般是blender主线程, 不能一直卡着
+BLOCK_TIMEOUT = 1.0
+
+# 一组开始发了, 后面的op隔这么久还没放进来就不等了, 别的优先级可以发了
+GROUP_TIMEOUT = 1.0
+
+# 数字小的先发
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+
+class OpQueue:
+    """
+    op是add_operation里拼的那个dict, 'key'不是None的可以被合并
+    只有同key的op排在队尾时才合并: 它后面要是还有别的op(比如QUEUE_PROMPT),
+    那些op用的还是它, 不能换掉
+    'priority'决定排在哪条队; 一组op(REQUEST_IMAGE, SEND_IMAGE, 到'group_end'的QUEUE_PROMPT为止)
+    开始发了就先把这一组发完, 不让别的优先级插到中间, 不然对面的图和名字就乱了
+    这一组后面的还没放进来也等着, 最多等GROUP_TIMEOUT; 所以一组op最好一口气放进来
+    """
+    def __init__(self, max_size=256, overflow=OVERFLOW_DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'unknown overflow policy: {overflow}')
+        self.max_size = max_size
+        self.overflow = overflow
+        self.items = {priority: deque() for priority in PRIORITIES}
+        # 正在发的那一组的priority, 组发完了是None; 这一组上一次拿出op的时间
+        self.group = None
+        self.group_at = 0.0
+        self.condition = threading.Condition()
+        self.woken = False
+        # 每次有东西放进来都调用一下, asyncio版靠它叫醒loop
+        self.listener = None
+        self.stats = {'queued': 0, 'merged': 0, 'dropped': 0, 'peak': 0}
+
+    def __len__(self):
+        return sum(len(items) for items in self.items.values())
+
+    def put(self, operation):
+        """
+        返回因为满了被扔掉的op, 可能是之前排着的, 也可能就是这个
+        """
+        dropped = []
+        priority = operation.get('priority', PRIORITY_INTERACTIVE)
+        with self.condition:
+            items = self.items[priority]
+            key = operation.get('key')
+            if key is not None and items and items[-1].get('key') == key:
+                items[-1] = operation
+                self.stats['merged'] += 1
+            else:
+                if len(self) >= self.max_size and self.overflow == OVERFLOW_BLOCK:
+                    deadline = time.monotonic() + BLOCK_TIMEOUT
+                    while len(self) >= self.max_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    # 等的时候remove()/clear()可能换掉了这条队
+                    items = self.items[priority]
+
+                if len(self) >= self.max_size:
+                    if self.overflow == OVERFLOW_DROP_OLDEST:
+                        # 先扔批量的
+                        oldest = next(items for _, items in sorted(self.items.items(), reverse=True) if items)
+                        dropped += self.drop_group(oldest)
+                    else:
+                        dropped.append(operation)
+                        operation = None
+                if operation is not None:
+                    items.append(operation)
+                    self.stats['queued'] += 1
+                    self.stats['peak'] = max(self.stats['peak'], len(self))
+                self.stats['dropped'] += len(dropped)
+            self.condition.notify_all()
+
+        if self.listener is not None:
+            self.listener()
+        return dropped
+
+    def drop_group(self, items):
+        """
+        从队头扔到第一个group_end为止(包括它), 后面没有group_end的话就是剩下的全部
+        """
+        # 扔的是正在发的那一组剩下的部分
+        if self.group is not None and self.items.get(self.group) is items:
+            self.group = None
+        dropped = []
+        while items:
+            operation = items.popleft()
+            dropped.append(operation)
+            if operation.get('group_end'):
+                break
+        return dropped
+
+    def ready(self):
+        """
+        拿着condition的时候调用, 返回下一个op该从哪条队拿, 现在不能拿是None
+        """
+        if self.group is not None:
+            items = self.items[self.group]
+            if items:
+                return items
+            if self.group_wait() > 0:
+                return None
+            print('~~~~~~~~~op group not finished in time, let other priorities go')
+            self.group = None
+        return next((items for _, items in sorted(self.items.items()) if items), None)
+
+    def group_wait(self):
+        """
+        正在等的那一组还要等多久, 没在等是0
+        """
+        if self.group is None or self.items[self.group]:
+            return 0.0
+        return max(0.0, self.group_at + GROUP_TIMEOUT - time.monotonic())
+
+    def pop(self, items):
+        operation = items.popleft()
+        self.group = None if operation.get('group_end') else operation.get('priority', PRIORITY_INTERACTIVE)
+        self.group_at = time.monotonic()
+        # OVERFLOW_BLOCK的可能在等空位
+        self.condition.notify_all()
+        return operation
+
+    def get(self, timeout=None):
+        """
+        阻塞到有op为止, 超时或者被wake()叫醒了返回None
+        """
+        with self.condition:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            items = self.ready()
+            while items is None and not self.woken:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # 在等一组后面的op的话, 到时间了得醒过来放别的走
+                group_wait = self.group_wait()
+                if group_wait > 0:
+                    remaining = group_wait if remaining is None else min(remaining, group_wait)
+                self.condition.wait(remaining)
+                items = self.ready()
+            self.woken = False
+            if items is None:
+                return None
+            return self.pop(items)
+
+    def get_nowait(self):
+        """
+        没有能拿的返回None; 是在等一组后面的op的话, group_wait()秒以后再来拿
+        """
+        with self.condition:
+            items = self.ready()
+            if items is None:
+                return None
+            return self.pop(items)
+
+    def remove(self, predicate):
+        """
+        把还没发出去的, predicate(op)为True的op拿掉, 返回拿掉的
+        """
+        removed = []
+        with self.condition:
+            for priority, items in self.items.items():
+                kept = deque()
+                for operation in items:
+                    (removed if predicate(operation) else kept).append(operation)
+                self.items[priority] = kept
+            # 正在发的那一组的group_end被拿掉了, 不用再等它
+            if self.group is not None and not any(operation.get('group_end') for operation in self.items[self.group]):
+                self.group = None
+            self.condition.notify_all()
+        return removed
+
+    def remove_group(self, predicate):
+        """
+        和remove一样, 不过predicate(op)为True的op所在的那一组(到group_end为止)还没发出去的都一起拿掉
+        """
+        removed = []
+        with self.condition:
+            for priority, items in self.items.items():
+                kept = deque()
+                group = []
+                for operation in items:
+                    group.append(operation)
+                    if operation.get('group_end'):
+                        (removed if any(predicate(op) for op in group) else kept).extend(group)
+                        group = []
+                # 最后一组还没放齐
+                (removed if any(predicate(op) for op in group) else kept).extend(group)
+                self.items[priority] = kept
+            if self.group is not None and not any(operation.get('group_end') for operation in self.items[self.group]):
+                self.group = None
+            self.condition.notify_all()
+        return removed
+
+    def wake(self):
+        """
+        让阻塞在get()里的线程回去看看是不是该退出了, 或者有没有插队的控制消息
+        """
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+        if self.listener is not None:
+            self.listener()
+
+    def clear(self):
+        with self.condition:
+            for items in self.items.values():
+                items.clear()
+            self.group = None
+            self.condition.notify_all()
@@ -0,0 +1,336 @@
+"""
+与comfyUI那边的comfyBridge通信的协议
+只管字节怎么排, 不碰socket也不碰bpy, 离开blender也能用
+"""
+
+import struct
+import zlib
+
+# 快的压缩库有就用, 没有也不强求
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+'''
+-------------------------------------------------------------
+--OpCodes--
+'''
+HANDSHAKE = 101
+HEARTBEAT = 102
+NEGOTIATE = 103
+RESUME = 104
+SHM_ATTACH = 105
+
+SEND_IMAGE = 201
+REQUEST_IMAGE = 202
+QUEUE_PROMPT = 203
+RESPONSED_IMAGE = 204
+IMAGE_REF = 205
+IMAGE_MISS = 206
+IMAGE_CHUNK = 207
+CHUNK_ACK = 208
+SHM_RELEASE = 209
+CANCEL = 210
+
+PROGRESS = 301
+
+ERROR = 404
+OK = 666
+
+# 统计和日志里显示用
+OPCODE_NAMES = {
+    HANDSHAKE: 'HANDSHAKE', HEARTBEAT: 'HEARTBEAT', NEGOTIATE: 'NEGOTIATE', RESUME: 'RESUME', SHM_ATTACH: 'SHM_ATTACH',
+    SEND_IMAGE: 'SEND_IMAGE', REQUEST_IMAGE: 'REQUEST_IMAGE', QUEUE_PROMPT: 'QUEUE_PROMPT',
+    RESPONSED_IMAGE: 'RESPONSED_IMAGE', IMAGE_REF: 'IMAGE_REF', IMAGE_MISS: 'IMAGE_MISS',
+    IMAGE_CHUNK: 'IMAGE_CHUNK', CHUNK_ACK: 'CHUNK_ACK', SHM_RELEASE: 'SHM_RELEASE', CANCEL: 'CANCEL',
+    PROGRESS: 'PROGRESS', ERROR: 'ERROR', OK: 'OK',
+}
+'''
+-------------------------------------------------------------
+'''
+
+# v1: 老协议, opcode, int, string一个接一个裸着发, 什么回复对应什么请求全靠猜
+PROTOCOL_V1 = 1
+# v2: 每一帧都是 opcode + request_id + payload长度, 然后才是payload
+PROTOCOL_V2 = 2
+
+# HANDSHAKE之后用NEGOTIATE商量出双方都支持的功能, 用逗号连起来发
+FEATURE_PIPELINE = 'pipeline' # 多个QUEUE_PROMPT同时在跑, 结果和进度按request_id对回去
+FEATURE_RAW = 'raw'           # SEND_IMAGE里可以直接发像素, 不用先压成PNG
+FEATURE_DEDUP = 'dedup'       # 对面已经有的图只发hash(IMAGE_REF), 没有的再补发
+#   IMAGE_REF: count + (name, digest)*, 对面用同一个request_id回IMAGE_MISS: 没有的那些名字
+#   SEND_IMAGE: 每张图后面多跟一个digest blob, 对面按digest存起来留着下次用
+FEATURE_CHUNKED = 'chunked'   # 大的消息拆成IMAGE_CHUNK分几帧发, 中间可以插别的帧
+#   IMAGE_CHUNK: payload就是原消息payload的一段, 同一个request_id的按顺序拼起来
+#   最后一段用原来的opcode发, 对面收到它才把整条消息拼好处理
+#   对面每收到一段回一个CHUNK_ACK: 这个request_id一共收到了多少字节
+FEATURE_RESUME = 'resume'     # 断线重连后接着用原来的session
+#   NEGOTIATE之后client马上发RESUME: session id, 对面回RESUME: 是否还记得这个session, 这个session一共收到了多少帧
+#   之后对面回HEARTBEAT时request_id填的也是收到的帧数, client据此扔掉已经送到了的op, 没送到的重连后重发
+FEATURE_SHM = 'shm'           # 在同一台机器上: 图像写进client建的共享内存环里, blob里只放位置和长度
+#   client发SHM_ATTACH: 共享内存名字, 大小; 对面回SHM_ATTACH: 成功没有, unix socket路径(没有就是空的)
+#   有路径的话client换成unix socket重连, 靠RESUME接着用同一个session
+#   对面每读完一个共享内存里的blob回一个SHM_RELEASE: 按顺序释放了几个
+FEATURE_CANCEL = 'cancel'     # 不要了的job可以叫对面停掉
+#   CANCEL: job id(当初QUEUE_PROMPT的request_id); 还在排队的直接扔掉, 正在跑的打断, 都不用回
+#   已经在路上的PROGRESS和RESPONSED_IMAGE client自己扔掉
+FEATURE_PARAMS = 'params'     # 同一个工作流换几个参数(seed之类)跑好几遍
+#   QUEUE_PROMPT带一个string: 这次要改的参数, JSON的{名字: 值}, 空的就是不改
+#   对面在收到QUEUE_PROMPT时就把参数, 图和REQUEST_IMAGE的名字都定下来, 之后再SEND_IMAGE不影响排着的job
+# 'codec:xxx' 表示这种压缩双方都能解
+CODEC_FEATURE_PREFIX = 'codec:'
+
+FRAME_HEADER = struct.Struct('>III')
+# 防止读到一帧乱码时按长度去申请几个G的内存
+MAX_FRAME_SIZE = 1024 * 1024 * 1024
+
+# 收到的各种消息后面跟着什么字段, v1和v2都一样, 只是v2外面多包了一层帧头
+INCOMING_LAYOUTS = {
+    HEARTBEAT: (),
+    NEGOTIATE: ('int', 'str'),
+    RESUME: ('int', 'int'),
+    SHM_ATTACH: ('int', 'str'),
+    RESPONSED_IMAGE: ('str', 'blob', 'int'),
+    IMAGE_MISS: ('strs',),
+    CHUNK_ACK: ('int',),
+    SHM_RELEASE: ('int',),
+    PROGRESS: ('int', 'int'),
+    OK: (),
+    ERROR: (),
+}
+
+
+# 裸像素的图像头: magic, 宽, 高, 通道数, 数据类型, 压缩方式, flags
+RAW_IMAGE_HEADER = struct.Struct('>4sIIBBBB')
+RAW_IMAGE_MAGIC = b'CBRW'
+
+DTYPE_UINT8 = 0
+DTYPE_FLOAT16 = 1
+DTYPE_FLOAT32 = 2
+DTYPE_SIZES = {DTYPE_UINT8: 1, DTYPE_FLOAT16: 2, DTYPE_FLOAT32: 4}
+
+# 像素行从下往上排, 也就是opengl和blender的习惯
+RAW_FLAG_BOTTOM_UP = 1
+
+# 写在共享内存里的blob, 真正发出去的只有: magic, offset, 长度
+SHM_REF = struct.Struct('>4sII')
+SHM_REF_MAGIC = b'CBSM'
+
+CODEC_NONE = 'none'
+# 名字 -> (写在图像头里的id, 压缩函数), 按越快越好的顺序排
+CODECS = {}
+# 图像头里的id -> 解压函数
+DECOMPRESSORS = {0: lambda data: data}
+if lz4 is not None:
+    CODECS['lz4'] = (2, lambda data: lz4.frame.compress(data))
+    DECOMPRESSORS[2] = lambda data: lz4.frame.decompress(data)
+if zstandard is not None:
+    CODECS['zstd'] = (3, lambda data: zstandard.ZstdCompressor(level=1).compress(data))
+    DECOMPRESSORS[3] = lambda data: zstandard.ZstdDecompressor().decompress(data)
+CODECS['zlib'] = (1, lambda data: zlib.compress(data, 1))
+DECOMPRESSORS[1] = lambda data: zlib.decompress(data)
+CODEC_IDS = {CODEC_NONE: 0, **{name: codec[0] for name, codec in CODECS.items()}}
+
+
+class RawImage:
+    """
+    没编码过的像素, 从gpu buffer里直接拿出来的那种
+    data是任何支持buffer协议的东西, 长度 = width * height * channels * dtype大小
+    """
+    def __init__(self, width, height, data, channels=4, dtype=DTYPE_UINT8, bottom_up=True):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.dtype = dtype
+        # float的buffer直接len出来的是float的个数, 统一按字节看
+        self.data = memoryview(data).cast('B')
+        self.bottom_up = bottom_up
+
+        size = width * height * channels * DTYPE_SIZES[dtype]
+        if len(self.data) != size:
+            raise ValueError(f'raw image expects {size} bytes, got {len(self.data)}')
+
+    def __len__(self):
+        return len(self.data)
+
+
+def packInt(value):
+    return value.to_bytes(4, byteorder='big')
+
+def packString(string):
+    string_bytes = string.encode('utf-8')
+    return [packInt(len(string_bytes)), string_bytes]
+
+def packBlob(data):
+    """
+    只加个长度在前面, data本身不复制
+    """
+    return [packInt(len(data)), data]
+
+def packFrame(opCode, request_id, parts):
+    length = sum(len(part) for part in parts)
+    return [FRAME_HEADER.pack(opCode, request_id, length), *parts]
+
+def fieldsSize(layout, fields):
+    """
+    v1的消息是一个字段一个字段读的, 读完了再算一下在线上占了多少字节, 统计用
+    """
+    size = 0
+    for field, value in zip(layout, fields):
+        if field == 'int':
+            size += 4
+        elif field == 'str':
+            size += 4 + len(value.encode('utf-8'))
+        elif field == 'strs':
+            size += 4 + sum(4 + len(item.encode('utf-8')) for item in value)
+        else:
+            size += 4 + len(value)
+    return size
+
+def packFields(layout, fields):
+    """
+    fieldsSize反过来: v1一个字段一个字段读出来的消息再拼回payload, 抓包用
+    """
+    parts = []
+    for field, value in zip(layout, fields):
+        if field == 'int':
+            parts.append(packInt(value))
+        elif field == 'str':
+            parts += packString(value)
+        elif field == 'strs':
+            parts.append(packInt(len(value)))
+            for item in value:
+                parts += packString(item)
+        else:
+            parts += packBlob(value)
+    return parts
+
+def splitParts(parts, size):
+    """
+    把一串parts按size切成好几段, 每段也是一串parts
+    切的是memoryview, 不复制数据
+    """
+    chunk = []
+    chunk_size = 0
+    for part in parts:
+        view = memoryview(part).cast('B')
+        while len(view) > 0:
+            piece = view[:size - chunk_size]
+            chunk.append(piece)
+            chunk_size += len(piece)
+            view = view[len(piece):]
+            if chunk_size == size:
+                yield chunk
+                chunk = []
+                chunk_size = 0
+    if chunk:
+        yield chunk
+
+def packRawImage(image, codec=CODEC_NONE):
+    """
+    返回一个blob需要的parts, 不压缩时像素数据本身不复制
+    """
+    data = image.data
+    if codec != CODEC_NONE:
+        data = CODECS[codec][1](data)
+    flags = RAW_FLAG_BOTTOM_UP if image.bottom_up else 0
+    header = RAW_IMAGE_HEADER.pack(
+        RAW_IMAGE_MAGIC, image.width, image.height,
+        image.channels, image.dtype, CODEC_IDS[codec], flags
+    )
+    return [packInt(len(header) + len(data)), header, data]
+
+def isRawImage(blob):
+    return bytes(blob[:len(RAW_IMAGE_MAGIC)]) == RAW_IMAGE_MAGIC
+
+def unpackRawImage(blob):
+    """
+    packRawImage反过来, 不压缩的话像素还是blob的memoryview切片
+    """
+    view = memoryview(blob)
+    magic, width, height, channels, dtype, codec_id, flags = RAW_IMAGE_HEADER.unpack(view[:RAW_IMAGE_HEADER.size])
+    if magic != RAW_IMAGE_MAGIC:
+        raise ValueError('not a raw image')
+    if codec_id not in DECOMPRESSORS:
+        raise ValueError(f'unsupported raw image codec: {codec_id}')
+    data = DECOMPRESSORS[codec_id](view[RAW_IMAGE_HEADER.size:])
+    return RawImage(width, height, data, channels, dtype, bool(flags & RAW_FLAG_BOTTOM_UP))
+
+def packShmRef(offset, length):
+    return SHM_REF.pack(SHM_REF_MAGIC, offset, length)
+
+def isShmRef(blob):
+    return len(blob) == SHM_REF.size and bytes(blob[:len(SHM_REF_MAGIC)]) == SHM_REF_MAGIC
+
+def unpackShmRef(blob):
+    """
+    返回(offset, 长度)
+    """
+    _, offset, length = SHM_REF.unpack(blob)
+    return offset, length
+
+def codecFeatures(codecs):
+    return {CODEC_FEATURE_PREFIX + codec for codec in codecs}
+
+def pickCodec(features):
+    """
+    双方都支持的压缩里挑最快的那个
+    """
+    for codec in CODECS:
+        if CODEC_FEATURE_PREFIX + codec in features:
+            return codec
+    return CODEC_NONE
+
+def packFeatures(features):
+    return ','.join(sorted(features))
+
+def unpackFeatures(string):
+    return {feature for feature in string.split(',') if feature}
+
+
+class PayloadReader:
+    """
+    从收到的一整帧payload里按顺序读字段
+    blob返回的是memoryview切片, 不复制
+    """
+    def __init__(self, payload):
+        self.view = memoryview(payload)
+        self.offset = 0
+
+    def readBytes(self, size):
+        if self.offset + size > len(self.view):
+            raise ValueError('frame payload too short')
+        data = self.view[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def readInt(self):
+        return int.from_bytes(self.readBytes(4), byteorder='big')
+
+    def readString(self):
+        length = self.readInt()
+        return str(self.readBytes(length), 'utf-8')
+
+    def readBlob(self):
+        length = self.readInt()
+        return self.readBytes(length)
+
+    def readStrings(self):
+        count = self.readInt()
+        return [self.readString() for _ in range(count)]
+
+    def readFields(self, layout):
+        readers = {
+            'int': self.readInt,
+            'str': self.readString,
+            'strs': self.readStrings,
+            'blob': self.readBlob,
+        }
+        return [readers[field]() for field in layout]
@@ -10,21 +10,35 @@ def ExecuteQueuePrompt(context, senders, receivers):
     undo_steps = bpy.context.preferences.edit.undo_steps
     sender_count = len(senders)
     request_count = len(receivers)
+    # 正在等哪个sender的render_complete, BatchQueue渲的也会发render_complete
+    rendering = None
+    # 渲好的图先攒着, 全渲完了和要的名字, QueuePrompt一口气排进发送队列, 和batch_queue一样
+    # 渲一个发一个的话一组op要隔着好几次渲染才放齐, 等不了那么久sender就放批量的插进来了
+    names = []
+    image_datas = []
+    request_names = [item.text for item in receivers] if request_count > 0 else ["None"]
 
     def send_queue_prompt():
+        bpy.context.preferences.edit.undo_steps = undo_steps
+        if names:
+            SendImages(names, image_datas)
+        SendRequestNames(request_names, group_end=request_count == 0)
         if request_count > 0:
-            bpy.context.preferences.edit.undo_steps = undo_steps
             QueuePrompt()
 
     def on_render_done(data):
-        SendImages(data['names'], data['image_datas'])
+        nonlocal rendering
+        if data['sender'] != rendering:
+            return
+        names.extend(data['names'])
+        image_datas.extend(data['image_datas'])
 
         if len(senders) == 0:
             EventMan.Remove("render_complete", on_render_done)
             send_queue_prompt()
         else:
-            sender = senders.pop(0)
-            RenderCollection(context, sender)
+            rendering = senders.pop(0)
+            RenderCollection(context, rendering)
 
     if request_count > 0:
         def record_camera():
@@ -44,16 +58,12 @@ def ExecuteQueuePrompt(context, senders, receivers):
                     receiver.fov = fov
 
         record_camera()
-        request_names = [item.text for item in receivers]
-        SendRequestNames(request_names)
-    else:
-        SendRequestNames(["None"])
 
     if sender_count > 0:
         bpy.context.preferences.edit.undo_steps = 0
         EventMan.Add("render_complete", on_render_done)
-        sender = senders.pop(0)
-        RenderCollection(context, sender)
+        rendering = senders.pop(0)
+        RenderCollection(context, rendering)
     else:
         send_queue_prompt()
 
@@ -62,6 +72,7 @@ def on_receiver_changed(context):
     receiver_names = [item.text for item in cb_props.receiver_list if item.enabled]
     if len(receiver_names) == 0:
         receiver_names = ["None"]
-    SendRequestNames(receiver_names)
+    # 后面没有QueuePrompt, 自己就是一组
+    SendRequestNames(receiver_names, group_end=True)
     print(f"receiver changed")
 
@@ -1,8 +1,8 @@
 import bpy
 import tempfile
 import os
-import threading
 from .event import EventMan
+from .tasks import SubmitBackground, ReportErrors
 from .tmp_setting import TmpSetting
 from mathutils import Vector
 from .gpu_depth_normal import DepthNormalRenderer
@@ -28,10 +28,12 @@ def RenderCollection(context, sender):
                 os.remove(tmp_path)
                 EventMan.Trigger("image_ready_to_send", {'name': f"{sender_name}_C", 'data': image_data, 'cleanup': False})
 
-        thread = threading.Thread(target=file_thread)
-        thread.start()
+        ReportErrors(SubmitBackground(file_thread), f"{sender_name}_C read")
 
     def on_image_ready_to_send(data):
+        # 同时在渲的别的sender的图也会发到这里来
+        if data['name'] not in names_in_list:
+            return
         if data['cleanup']:
             bpy.data.images.remove(data['image'])
 
@@ -39,8 +41,7 @@ def RenderCollection(context, sender):
         names.append(img_name)
         image_datas.append(data['data'])
 
-        if img_name in names_in_list:
-            names_in_list.remove(img_name)
+        names_in_list.remove(img_name)
 
         if len(names_in_list) == 0:
             EventMan.Remove("image_ready_to_send", on_image_ready_to_send)
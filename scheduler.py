@@ -0,0 +1,91 @@
+"""
+线程版client用的定时器: 一个线程, 一个按到期时间排的堆
+heartbeat, 断线检测, 以后要加的各种重试都往这里放, 不再每次开一个线程去sleep
+asyncio版直接用event loop的call_later, 那本身就是同样的东西
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer:
+    """
+    call_later返回的东西, 还没到期的可以cancel
+    取消了的不会马上从堆里拿掉, 轮到它的时候直接跳过
+    """
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    回调都在scheduler线程里跑, 不要在里面做会阻塞的事(比如写socket), 不然后面的定时器都会被拖住
+    """
+    def __init__(self, name='ComfyBridge-scheduler'):
+        self.name = name
+        self.heap = []
+        # 同一时间到期的按加进来的顺序, 也免得去比较Timer
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.heap.clear()
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (when, next(self.counter), timer))
+            # 比现在等着的那个还早才需要叫醒
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if not self.running:
+                    return
+                _, _, timer = heapq.heappop(self.heap)
+
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f'~~~~~~~~~timer error:{e}')
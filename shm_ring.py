@@ -0,0 +1,97 @@
+"""
+同一台机器上时, 图像不走socket, 直接写进一块共享内存里
+client这边建一个环形buffer, SEND_IMAGE里只放位置和长度, 对面读完了回SHM_RELEASE
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+class ShmRing:
+    """
+    head和tail都是一直往上加的位置, 对size取模才是在共享内存里的offset
+    对面是按顺序读的, 所以也按顺序释放: 每个SHM_RELEASE释放最早的一段
+    一段放不到末尾的话末尾那点就空着不用, 从头开始放
+    """
+    def __init__(self, size):
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        # 每段分配结束时的head, 释放的时候tail直接跳到这里
+        self.allocations = deque()
+        self.lock = threading.Lock()
+        # 等着有空间的Future, 下次释放时全部叫醒
+        self.waiters = []
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def allocate(self, length):
+        """
+        返回offset, 现在没地方了返回None
+        """
+        if length > self.size:
+            return None
+        with self.lock:
+            position = self.head % self.size
+            padding = 0 if position + length <= self.size else self.size - position
+            if self.head + padding + length - self.tail > self.size:
+                return None
+            self.head += padding
+            offset = self.head % self.size
+            self.head += length
+            self.allocations.append(self.head)
+            return offset
+
+    def wait_release(self):
+        """
+        allocate失败后拿一个Future, 下次有东西释放时完成
+        拿到之后要再allocate一次, 免得释放正好发生在这中间
+        """
+        future = Future()
+        with self.lock:
+            self.waiters.append(future)
+        return future
+
+    def write(self, offset, parts):
+        view = self.memory.buf
+        for part in parts:
+            length = len(part)
+            view[offset:offset + length] = memoryview(part).cast('B')
+            offset += length
+
+    def release(self, count=1):
+        with self.lock:
+            for _ in range(min(count, len(self.allocations))):
+                self.tail = self.allocations.popleft()
+            waiters, self.waiters = self.waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(True)
+
+    def reset(self):
+        """
+        断线了对面不会再释放了, 全部作废
+        """
+        with self.lock:
+            self.allocations.clear()
+            self.tail = self.head
+            waiters, self.waiters = self.waiters, []
+        for future in waiters:
+            future.cancel()
+
+    def close(self):
+        self.reset()
+        try:
+            self.memory.close()
+            self.memory.unlink()
+        except Exception as e:
+            pass
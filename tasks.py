@@ -0,0 +1,171 @@
+"""
+worker线程要主线程做的事不用再Trigger一个事件, 再挂一个带着一堆参数的监听者去对是不是自己的
+RunOnMain(fn, *args)返回Future, fn在EventMan的tick里跑, 和别的事件一样受budget管
+SubmitBackground(fn, *args)反过来, 丢到后台的线程池里
+Then把几步串起来: 前一步的结果是后一步的参数, 出错和取消一路往后传; 取消Then返回的只取消它自己排的那一步, 传进来的future可能还有别人在等, 不管
+Future就是concurrent.futures.Future, 在主线程里不要result()等RunOnMain的, 它要等主线程的tick才跑
+"""
+
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+import os
+import threading
+
+from .event import EventMan
+
+BACKGROUND_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class Background:
+    executor = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls.lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(BACKGROUND_WORKERS, thread_name_prefix='ComfyBridge-background')
+            return cls.executor
+
+    @classmethod
+    def shutdown(cls):
+        with cls.lock:
+            executor, cls.executor = cls.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def held(future):
+    """
+    future没完之前EventMan不停, 后面的步骤才有人Post
+    """
+    EventMan.Hold()
+    future.add_done_callback(lambda _: EventMan.Release())
+    return future
+
+
+def settle(target, source):
+    """
+    source的结果, 异常或者取消原样给target; target已经被取消了就算了
+    """
+    try:
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+    except InvalidStateError:
+        pass
+
+
+# ------public methods------
+def RunOnMain(fn, *args, **kwargs):
+    """
+    任何线程都能调, 返回的Future在fn跑完以后有结果; 跑之前cancel的话就不跑了
+    """
+    future = held(Future())
+
+    def call():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    call.__qualname__ = getattr(fn, '__qualname__', call.__qualname__)
+    EventMan.Post(call)
+    return future
+
+
+def SubmitBackground(fn, *args, **kwargs):
+    """
+    fn里不要碰bpy的数据, 要碰的先在主线程里取出来当参数传进去, 或者Then一步回主线程
+    """
+    return held(Background.get().submit(fn, *args, **kwargs))
+
+
+def Then(future, fn, on_main=True):
+    """
+    future有结果以后fn(结果), on_main是False的话在后台跑; 返回fn的结果的Future
+    future出错或者取消了fn就不跑, 返回的Future也一样出错或者取消
+    返回的Future被取消了fn就不跑或者取消掉fn那一步, future本身不动
+    """
+    chained = held(Future())
+    # fn那一步的Future, future有结果之前是None
+    step = [None]
+
+    def on_done(done):
+        if chained.done():
+            return
+        if done.cancelled() or done.exception() is not None:
+            settle(chained, done)
+            return
+        step[0] = (RunOnMain if on_main else SubmitBackground)(fn, done.result())
+        if chained.cancelled():
+            step[0].cancel()
+            return
+        step[0].add_done_callback(lambda result: settle(chained, result))
+
+    def on_chained_done(done):
+        if done.cancelled() and step[0] is not None:
+            step[0].cancel()
+
+    chained.add_done_callback(on_chained_done)
+    future.add_done_callback(on_done)
+    return chained
+
+
+def WhenAll(futures):
+    """
+    都有结果了以后是按顺序的结果list; 有一个出错或者取消就是那样, 剩下的都取消掉
+    """
+    futures = list(futures)
+    gathered = held(Future())
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(done):
+        if done.cancelled() or done.exception() is not None:
+            settle(gathered, done)
+            return
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        try:
+            gathered.set_result([future.result() for future in futures])
+        except InvalidStateError:
+            pass
+
+    def on_gathered_done(done):
+        if done.cancelled() or done.exception() is not None:
+            for future in futures:
+                future.cancel()
+
+    gathered.add_done_callback(on_gathered_done)
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
+
+
+def ReportErrors(future, what):
+    """
+    串起来的最后一步没人result()的话, 出错了至少打出来
+    """
+    def on_done(done):
+        if not done.cancelled() and done.exception() is not None:
+            print(f'~~~~~~~~~{what} failed: {done.exception()!r}')
+    future.add_done_callback(on_done)
+    return future
+
+
+def ShutdownBackground():
+    """
+    卸载插件时调, 还没开始的后台任务都取消
+    """
+    Background.shutdown()
@@ -0,0 +1,235 @@
+"""
+连接的统计: 每种opcode收发了多少帧多少字节, 几段关键的耗时
+出图慢的时候看一眼就知道是网络(heartbeat来回), bridge(排队, 到第一个PROGRESS)还是出图本身(到RESPONSED_IMAGE)
+收发线程, sender线程都会往里记, 所以都在锁里
+"""
+
+import copy
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from .protocol import OPCODE_NAMES
+
+
+# add_operation到开始往socket上写
+METRIC_QUEUE_TO_WIRE = 'queue_to_wire'
+# QUEUE_PROMPT发出去到收到这个job的第一个PROGRESS, 基本就是comfyUI排队+开始跑
+METRIC_PROMPT_TO_PROGRESS = 'prompt_to_progress'
+# QUEUE_PROMPT发出去到收到这个job的第一张图
+METRIC_PROMPT_TO_IMAGE = 'prompt_to_image'
+# QUEUE_PROMPT发出去到这个job要的图都收齐
+METRIC_PROMPT_TO_DONE = 'prompt_to_done'
+# HEARTBEAT发出去到对面回的HEARTBEAT
+METRIC_HEARTBEAT_RTT = 'heartbeat_rtt'
+# 开始连到握手(含协商, RESUME)做完
+METRIC_CONNECT = 'connect'
+METRICS = (
+    METRIC_CONNECT, METRIC_HEARTBEAT_RTT, METRIC_QUEUE_TO_WIRE,
+    METRIC_PROMPT_TO_PROGRESS, METRIC_PROMPT_TO_IMAGE, METRIC_PROMPT_TO_DONE,
+)
+
+# 还没结束的QUEUE_PROMPT最多记这么多, 对面一直不回的话不会越攒越多
+MAX_PENDING_PROMPTS = 256
+
+
+class Histogram:
+    """
+    按2倍分桶的耗时直方图, 不存每一个值
+    分位数给的是桶的上界, 看得出是几毫秒还是几秒就够了; 最大, 最小, 平均是准的
+    """
+    # 第一个桶是10微秒以内, 最后一个桶到10微秒*2^31, 6个小时
+    BASE = 1e-5
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        seconds = max(seconds, 0.0)
+        if seconds <= self.BASE:
+            index = 0
+        else:
+            index = min(self.BUCKETS - 1, int(math.log2(seconds / self.BASE)) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if count and running >= target:
+                return min(self.max, max(self.min, self.BASE * 2 ** index))
+        return self.max
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        """
+        单位都是秒
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min or 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # opCode -> [发出去的帧数, 字节数, 收到的帧数, 字节数]
+            self.opcodes = {}
+            self.latency = {metric: Histogram() for metric in METRICS}
+            # job key -> {'sent', 'progress', 'image'}, 按发出去的顺序
+            self.prompts = OrderedDict()
+            self.heartbeat_at = None
+            # replay_log满了扔掉的op, 断线的话这些不会重发
+            self.replay_overflows = 0
+
+    # ------记------
+    def sent(self, opCode, size):
+        with self.lock:
+            counter = self.opcodes.setdefault(opCode, [0, 0, 0, 0])
+            counter[0] += 1
+            counter[1] += size
+
+    def received(self, opCode, size):
+        with self.lock:
+            counter = self.opcodes.setdefault(opCode, [0, 0, 0, 0])
+            counter[2] += 1
+            counter[3] += size
+
+    def record(self, metric, seconds):
+        with self.lock:
+            self.latency[metric].add(seconds)
+
+    def heartbeat_sent(self):
+        with self.lock:
+            # 上一个还没回的话从最早的那个算
+            if self.heartbeat_at is None:
+                self.heartbeat_at = time.monotonic()
+
+    def heartbeat_received(self):
+        with self.lock:
+            if self.heartbeat_at is not None:
+                self.latency[METRIC_HEARTBEAT_RTT].add(time.monotonic() - self.heartbeat_at)
+                self.heartbeat_at = None
+
+    def replay_overflow(self):
+        with self.lock:
+            self.replay_overflows += 1
+
+    def prompt_sent(self, key):
+        """
+        key是job id, v1里回复不带id, 用0, 同时只能算一个
+        """
+        with self.lock:
+            self.prompts[key] = {'sent': time.monotonic(), 'progress': False, 'image': False}
+            self.prompts.move_to_end(key)
+            while len(self.prompts) > MAX_PENDING_PROMPTS:
+                self.prompts.popitem(last=False)
+
+    def prompt_progress(self, key):
+        with self.lock:
+            prompt = self.prompts.get(key)
+            if prompt is not None and not prompt['progress']:
+                prompt['progress'] = True
+                self.latency[METRIC_PROMPT_TO_PROGRESS].add(time.monotonic() - prompt['sent'])
+
+    def prompt_image(self, key, finished):
+        """
+        finished: 这个job要的图都收齐了
+        """
+        with self.lock:
+            prompt = self.prompts.get(key)
+            if prompt is None:
+                return
+            elapsed = time.monotonic() - prompt['sent']
+            if not prompt['image']:
+                prompt['image'] = True
+                self.latency[METRIC_PROMPT_TO_IMAGE].add(elapsed)
+            if finished:
+                self.latency[METRIC_PROMPT_TO_DONE].add(elapsed)
+                self.prompts.pop(key)
+
+    def prompt_failed(self, key):
+        with self.lock:
+            self.prompts.pop(key, None)
+
+    def connection_lost(self):
+        """
+        断了的话还在等的都不会回来了, 不能算进去
+        """
+        with self.lock:
+            self.prompts.clear()
+            self.heartbeat_at = None
+
+    def merge(self, other):
+        """
+        把另一条连接的统计加进来, 连接池汇总用
+        """
+        with other.lock:
+            opcodes = {opCode: list(counter) for opCode, counter in other.opcodes.items()}
+            latency = {metric: copy.deepcopy(histogram) for metric, histogram in other.latency.items()}
+            prompts = OrderedDict(other.prompts)
+            replay_overflows = other.replay_overflows
+        with self.lock:
+            self.replay_overflows += replay_overflows
+            for opCode, counter in opcodes.items():
+                mine = self.opcodes.setdefault(opCode, [0, 0, 0, 0])
+                for index, value in enumerate(counter):
+                    mine[index] += value
+            for metric, histogram in latency.items():
+                self.latency[metric].merge(histogram)
+            for key, prompt in prompts.items():
+                self.prompts[(id(other), key)] = prompt
+
+    # ------查------
+    def snapshot(self):
+        """
+        HANDSHAKE和NEGOTIATE是在这之外裸着收发的, 不算在opcodes里
+        {'opcodes': {名字: {frames_out, bytes_out, frames_in, bytes_in}},
+         'latency': {指标: Histogram.summary()},
+         'pending_prompts': 还没收齐图的QUEUE_PROMPT个数,
+         'replay_overflows': replay_log满了没法重发的op个数}
+        """
+        with self.lock:
+            opcodes = {
+                OPCODE_NAMES.get(opCode, str(opCode)): {
+                    'frames_out': counter[0], 'bytes_out': counter[1],
+                    'frames_in': counter[2], 'bytes_in': counter[3],
+                }
+                for opCode, counter in sorted(self.opcodes.items())
+            }
+            latency = {metric: histogram.summary() for metric, histogram in self.latency.items()}
+            return {
+                'opcodes': opcodes, 'latency': latency, 'pending_prompts': len(self.prompts),
+                'replay_overflows': self.replay_overflows,
+            }
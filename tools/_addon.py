@@ -0,0 +1,47 @@
+"""
+tools下的脚本都是在blender外面跑的
+插件目录本身是个一import就要bpy的包, 这里把它伪装成一个叫comfybridge的空包,
+不执行__init__.py, 之后 from comfybridge.xxx import ... 用到哪个子模块加载哪个
+
+    import _addon
+    from comfybridge.protocol import ...
+"""
+
+import os
+import sys
+import types
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'comfybridge'
+
+
+def install_bpy_stub():
+    """
+    client那几个模块只碰了bpy.app.timers, 没装blender就给个什么都不做的
+    装了的话(比如用blender --python跑)就用真的
+    """
+    try:
+        import bpy
+        return
+    except ImportError:
+        pass
+
+    class Timers:
+        def register(self, function, first_interval=0, persistent=False):
+            pass
+
+        def unregister(self, function):
+            pass
+
+        def is_registered(self, function):
+            return False
+
+    bpy = types.ModuleType('bpy')
+    bpy.app = types.SimpleNamespace(timers=Timers())
+    sys.modules['bpy'] = bpy
+
+
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ADDON_DIR]
+    sys.modules[PACKAGE] = package
@@ -0,0 +1,229 @@
+"""
+EventMan注册, 分发, 注销的开销, 监听的人很多的时候
+监听者用的是和gpu_baker一样的大dict, 以前按==比的时候每次都要一项一项比过去
+
+    python tools/bench_event.py
+    python tools/bench_event.py --listeners 1000,10000 --events 500
+    python tools/bench_event.py --trace bench_trace.json    # 同时开着EventMan的trace, 看开了以后慢多少
+
+几项(都是每次操作的微秒数):
+    add         每个监听者Add一次
+    dispatch    Trigger一次所有监听者都收到, 算到每个handler头上
+    targeted    Trigger给其中一个监听者(target)
+    remove      每个监听者Remove一次, 按Add的顺序
+    cross       另一个线程一直在Trigger, 主线程同时Add/Remove和process_events, 不能出错也不能丢
+    timers      排着很多还没到时间的TriggerAfter时, 一次process_events多久; 到时间的晚了多少毫秒
+    budget      一下来一堆慢handler(每个--handler-ms)时, 每个tick最多花多久, 几个tick做完
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import _addon
+_addon.install_bpy_stub()
+from comfybridge.event import EventMan
+
+EVENT = 'bench_event'
+
+
+def makeListener(index):
+    # 和gpu_baker的参数差不多: 一堆矩阵, 向量, 图像名, 前面都一样, 只有最后一项不同
+    return {
+        'size': 2048,
+        'modelMatrix': [[float(row == column) for column in range(4)] for row in range(4)],
+        'camera_pos': (0.0, -10.0, 5.0),
+        'camera_dir': (0.0, 1.0, -0.5),
+        'base_image': 'base',
+        'proj_image': 'proj',
+        'blend': (0.1, 0.2),
+        'obj': f'object_{index}',
+    }
+
+
+def reset():
+    EventMan.clear()
+    # 清空排着的事件, 上一项剩下的不能算到这一项里
+    while not EventMan.event_queue.empty():
+        EventMan.event_queue.get()
+
+
+def timed(count, function):
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def benchListeners(count, events):
+    reset()
+    calls = [0]
+
+    def handler(listener, args):
+        calls[0] += 1
+
+    listeners = [makeListener(index) for index in range(count)]
+    result = {}
+
+    def add():
+        for listener in listeners:
+            EventMan.Add(EVENT, handler, listener)
+    result['add'] = timed(count, add)
+
+    def dispatch():
+        for _ in range(events):
+            EventMan.Trigger(EVENT, {})
+            EventMan.process_events()
+    result['dispatch'] = timed(count * events, dispatch)
+    assert calls[0] == count * events, calls[0]
+
+    targets = [listeners[(index * 7919) % count] for index in range(events)]
+
+    def targeted():
+        for target in targets:
+            EventMan.Trigger(EVENT, {}, target)
+            EventMan.process_events()
+    calls[0] = 0
+    result['targeted'] = timed(events, targeted)
+    assert calls[0] == events, calls[0]
+
+    def remove():
+        for listener in listeners:
+            EventMan.Remove(EVENT, handler, listener)
+    result['remove'] = timed(count, remove)
+    assert EVENT not in EventMan.event_dict
+    return result
+
+
+def benchCross(count, seconds):
+    """
+    返回(主线程收到了几个, 另一个线程发了几个, 出了什么错)
+    """
+    reset()
+    received = [0]
+    errors = []
+
+    def handler(args):
+        received[0] += 1
+
+    # 一直挂着一个全局的, 后台线程Trigger的都该收到
+    EventMan.Add(EVENT, handler)
+    stop = threading.Event()
+    triggered = [0]
+
+    def trigger():
+        while not stop.is_set():
+            EventMan.Trigger(EVENT, {})
+            triggered[0] += 1
+            if triggered[0] % 64 == 0:
+                time.sleep(0)
+
+    thread = threading.Thread(target=trigger)
+    thread.start()
+    listeners = [makeListener(index) for index in range(count)]
+
+    def other(listener, args):
+        pass
+
+    deadline = time.perf_counter() + seconds
+    try:
+        while time.perf_counter() < deadline:
+            for listener in listeners:
+                EventMan.Add(EVENT, other, listener)
+            EventMan.process_events()
+            for listener in listeners:
+                EventMan.Remove(EVENT, other, listener)
+            EventMan.process_events()
+    except Exception as e:
+        errors.append(repr(e))
+    stop.set()
+    thread.join()
+    EventMan.process_events()
+    return received[0], triggered[0], errors
+
+
+def benchTimers(count, ticks):
+    """
+    返回(每次process_events的微秒数, 平均晚了几毫秒, 最多晚了几毫秒)
+    """
+    reset()
+    fired = []
+
+    def handler(args):
+        fired.append(time.monotonic() - args['due'])
+
+    EventMan.Add(EVENT, handler)
+    for _ in range(count):
+        EventMan.TriggerAfter(3600, EVENT, {'due': 0})
+    tick = timed(ticks, lambda: [EventMan.process_events() for _ in range(ticks)])
+    assert not fired
+
+    # 按process_events返回的间隔睡, 和bpy.app.timers一样
+    for index in range(20):
+        seconds = 0.005 + index * 0.003
+        EventMan.TriggerAfter(seconds, EVENT, {'due': time.monotonic() + seconds})
+    while len(fired) < 20:
+        time.sleep(EventMan.process_events())
+    late = [value * 1e3 for value in fired]
+    reset()
+    return tick, sum(late) / len(late), max(late)
+
+
+def benchBudget(count, handler_ms, budget_ms):
+    """
+    返回(EventMan.Stats(), 每个tick之间最长隔了几毫秒没有把控制还给blender)
+    """
+    reset()
+    EventMan.ResetStats()
+    EventMan.SetBudget(budget_ms / 1000)
+    done = [0]
+
+    def handler(args):
+        time.sleep(handler_ms / 1000)
+        done[0] += 1
+
+    EventMan.Add(EVENT, handler)
+    for _ in range(count):
+        EventMan.Trigger(EVENT, {})
+    longest = 0.0
+    while done[0] < count:
+        start = time.perf_counter()
+        EventMan.process_events()
+        longest = max(longest, time.perf_counter() - start)
+    stats = EventMan.Stats()
+    reset()
+    return stats, longest * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EventMan add/dispatch/remove cost with many listeners')
+    parser.add_argument('--listeners', default='100,1000,5000', help='comma separated listener counts')
+    parser.add_argument('--events', type=int, default=200, help='events triggered per dispatch run')
+    parser.add_argument('--cross-seconds', type=float, default=1.0)
+    parser.add_argument('--handler-ms', type=float, default=1.0, help='time each handler takes in the budget run')
+    parser.add_argument('--budget-ms', type=float, default=8.0)
+    parser.add_argument('--trace', default='', help='run with EventMan tracing on and export it to this file')
+    parser.add_argument('--timers', type=int, default=10000, help='pending timers for the timers run')
+    args = parser.parse_args()
+    if args.trace:
+        EventMan.StartTrace()
+
+    print(f'{"listeners":>9} {"add us":>9} {"dispatch us":>12} {"targeted us":>12} {"remove us":>10}')
+    for count in (int(value) for value in args.listeners.split(',')):
+        result = benchListeners(count, args.events)
+        print(f'{count:9} {result["add"]:9.2f} {result["dispatch"]:12.3f} {result["targeted"]:12.2f} {result["remove"]:10.2f}')
+
+    received, triggered, errors = benchCross(200, args.cross_seconds)
+    print(f'cross-thread: {triggered} triggered, {received} received' + (f', errors: {errors}' if errors else ''))
+    tick, late, worst = benchTimers(args.timers, 1000)
+    print(f'timers: {args.timers} pending, {tick:.2f} us per tick, late {late:.2f} ms avg, {worst:.2f} ms max')
+    stats, longest = benchBudget(200, args.handler_ms, args.budget_ms)
+    print(f'budget: 200 x {args.handler_ms}ms handlers in {stats["busy_ticks"]} ticks, longest {longest:.1f} ms, '
+          f'{stats["overruns"]} overruns (max {stats["max_overrun"] * 1e3:.1f} ms), max backlog {stats["max_backlog"]}')
+    if args.trace:
+        print(f'trace: {EventMan.ExportTrace(args.trace)} records written to {args.trace}')
+    return 1 if errors or received != triggered else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
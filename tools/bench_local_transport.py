@@ -0,0 +1,86 @@
+"""
+同一台机器上: 共享内存+unix socket 和 普通TCP 比一比
+stand-in server单独起一个进程, 和真的comfyBridge一样不共享GIL
+
+    python tools/bench_local_transport.py
+    python tools/bench_local_transport.py --size 3840x2160 --count 20 --backend asyncio
+
+两项:
+    upload: count张RGBA8裸像素图一张一张SendImages, 再QueuePrompt等结果回来, 算MB/s和client进程的CPU时间
+    round trip: 只QueuePrompt要一张8x8的图, 看控制消息来回一趟要多久
+TCP那一路不压缩, 不然比的就是zlib了
+"""
+
+import argparse
+import statistics
+import time
+
+from bench_protocol import BACKENDS, startServer, stopServer, connect, disconnect, waitJob, percentile, makeImage
+
+MODES = {
+    'tcp': {'shared_memory': False, 'codec': 'none', 'dedup': False},
+    'shm': {'shared_memory': True, 'codec': 'none', 'dedup': False},
+}
+
+
+def runMode(mode, args, port):
+    client = connect(args.backend, port, MODES[mode])
+    width, height = args.size
+    image = makeImage(width, height)
+    client.SendRequestNames(['_out'])
+
+    # 热身, 顺便让共享内存里的页都碰过一遍
+    waitJob(client, client.QueuePrompt())
+    client.SendImages(['_D'], [image])
+    waitJob(client, client.QueuePrompt())
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for index in range(args.count):
+        client.SendImages([f'_D{index}'], [image])
+    waitJob(client, client.QueuePrompt())
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+    trips = []
+    for _ in range(args.trips):
+        start = time.perf_counter()
+        waitJob(client, client.QueuePrompt())
+        trips.append(time.perf_counter() - start)
+
+    result = {
+        'transport': f'{client.transport}{"+shm" if client.shm is not None else ""}',
+        'mb_per_s': len(image.data) * args.count / wall / 1e6,
+        'cpu_per_image_ms': cpu / args.count * 1000,
+        'trip_p50_ms': statistics.median(trips) * 1000,
+        'trip_p99_ms': percentile(trips, 0.99) * 1000,
+    }
+    disconnect(client)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='shared memory vs TCP on loopback')
+    parser.add_argument('--size', default='1920x1080', help='WxH of the RGBA8 images sent')
+    parser.add_argument('--count', type=int, default=30)
+    parser.add_argument('--trips', type=int, default=200)
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='thread')
+    args = parser.parse_args()
+    args.size = tuple(int(value) for value in args.size.lower().split('x'))
+
+    process, port = startServer('--result-size', '8x8', '--steps', '0')
+    try:
+        print(f'{args.count} x {args.size[0]}x{args.size[1]} RGBA8, {args.backend} backend')
+        for mode in MODES:
+            result = runMode(mode, args, port)
+            print(
+                f'{mode:4} {result["transport"]:9} {result["mb_per_s"]:9.1f} MB/s  '
+                f'cpu {result["cpu_per_image_ms"]:6.2f} ms/image  '
+                f'round trip p50 {result["trip_p50_ms"]:.3f} ms  p99 {result["trip_p99_ms"]:.3f} ms'
+            )
+    finally:
+        stopServer(process)
+
+
+if __name__ == '__main__':
+    main()
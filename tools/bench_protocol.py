@@ -0,0 +1,465 @@
+"""
+不开comfyUI和blender, 用stand-in server测client的收发
+bpy换成什么都不做的, 用的就是插件里真的BridgeClient, 走真的socket
+stand-in单独起进程, 每一项都重新起一个, 结束时顺便拿到它用掉的CPU时间
+
+    python tools/bench_protocol.py
+    python tools/bench_protocol.py --backend asyncio --size 3840x2160 --count 10
+    python tools/bench_protocol.py --latency 20 --bandwidth 100    # 装成隔着一段网络
+    python tools/bench_protocol.py --result-size 2048x2048 --only receive
+
+几项:
+    handshake   连上(HANDSHAKE, NEGOTIATE, RESUME都做完)要多久, 每次都是新的client
+    send        SendImages一张裸像素图, 再QueuePrompt要一张8x8的图回来, 一个一个做, 算来回时间
+    send_burst  count张图一口气SendImages, 最后QueuePrompt等它回来, 算MB/s
+    receive     QueuePrompt要一张result-size的噪点PNG, 算来回时间和下载MB/s
+                等到on_image_received为止, 有numpy的话包括在后台线程里解码的时间
+    round_trip  只QueuePrompt要一张8x8的图, 控制消息来回一趟
+    grouping    不是测速度: 批量的一组op隔一会儿才放齐, 中间来一个交互的QueuePrompt,
+                看sender实际发的顺序里交互的有没有插到批量那一组中间, 插了就exit 1
+    drops       也不是测速度: stand-in每DROP_EVERY帧断一次, 一口气排count个批量job,
+                看是不是每个job都结束了(收齐了或者失败了都算), 有卡住的就exit 1
+    dedup_lru   也不是测速度: 去重只记2张, 按A B A C A的顺序发, 第二次发的A用到了就不该被C挤掉,
+                最后一次A还是只发hash, 不是就exit 1
+    requeue     也不是测速度: stand-in停掉, client在重连的时候排一个带rename的批量job, 再把stand-in起来,
+                看job有没有记着, 结束了没有, 图是不是按rename收的, 不对就exit 1
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import _addon
+_addon.install_bpy_stub()
+from comfybridge.bridge_client import Connect_Info
+from comfybridge.bridge_thread import ThreadBridgeClient
+from comfybridge.bridge_asyncio import AsyncioBridgeClient
+from comfybridge.dedup import imageDigest
+from comfybridge.event import EventMan
+from comfybridge.op_queue import PRIORITY_BATCH
+from comfybridge.protocol import RawImage
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BACKENDS = {'thread': ThreadBridgeClient, 'asyncio': AsyncioBridgeClient}
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ('handshake', 'send', 'send_burst', 'receive', 'round_trip', 'grouping', 'drops', 'dedup_lru', 'requeue')
+JOB_TIMEOUT = 120
+# drops的时候stand-in每收到这么多帧断一次
+DROP_EVERY = 25
+# drops的时候断了几次之后每个job最多等这么久, 重连本身要不了这么久
+DROP_JOB_TIMEOUT = 20
+
+
+# ------stand-in server------
+def childCpu():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def startServer(*extra, port=0):
+    """
+    返回(进程, 端口), port是0的话由系统挑一个
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(TOOLS_DIR, 'stand_in_server.py'), '--port', str(port), *extra],
+        stdout=subprocess.PIPE, text=True
+    )
+    # [stand-in] listening on 127.0.0.1:PORT, features: ...
+    line = process.stdout.readline()
+    port = int(line.split(':')[1].split(',')[0])
+    # 后面打印的东西也得有人读, 不然管道满了server就卡住了
+    threading.Thread(target=process.stdout.read, daemon=True).start()
+    return process, port
+
+
+def stopServer(process):
+    """
+    返回server进程一共用掉的CPU秒数, 拿不到(比如windows)就是None
+    """
+    before = childCpu()
+    process.terminate()
+    process.wait()
+    after = childCpu()
+    return None if before is None else after - before
+
+
+# ------client------
+def connect(backend, port, options=None):
+    client = BACKENDS[backend]('127.0.0.1', port, options)
+    # job结束时叫醒等着的主线程, 不忙等, 不然CPU时间都算在轮询上了
+    client.job_finished = threading.Condition()
+    on_job_image = client.on_job_image
+
+    def notify(job_id, name):
+        result = on_job_image(job_id, name)
+        with client.job_finished:
+            client.job_finished.notify_all()
+        return result
+
+    client.on_job_image = notify
+    end_job = client.end_job
+
+    def notify_end(job_id, ok):
+        # 失败了的job不会经过on_job_image
+        result = end_job(job_id, ok)
+        with client.job_finished:
+            client.job_finished.notify_all()
+        return result
+
+    client.end_job = notify_end
+    client.start()
+    deadline = time.monotonic() + 10
+    while not Connect_Info['isConnected']:
+        if time.monotonic() > deadline:
+            client.stop()
+            raise TimeoutError('can not connect to the stand-in server')
+        time.sleep(0.001)
+    return client
+
+
+def disconnect(client):
+    client.stop()
+    Connect_Info['isClosing'] = False
+
+
+def waitJob(client, job, timeout=JOB_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    with client.job_finished:
+        while job in client.jobs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'job {job} did not finish')
+            client.job_finished.wait(remaining)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def makeImage(width, height):
+    # 随机像素, 压缩和去重都帮不上忙
+    return RawImage(width, height, os.urandom(width * height * 4))
+
+
+# ------scenarios------
+def benchHandshake(args, port):
+    times = []
+    cpu = time.process_time()
+    for _ in range(args.handshakes):
+        start = time.perf_counter()
+        client = connect(args.backend, port, args.options)
+        times.append(time.perf_counter() - start)
+        disconnect(client)
+    return {'ops': len(times), 'times': times, 'cpu': time.process_time() - cpu}
+
+
+def benchSend(args, port):
+    client = connect(args.backend, port, args.options)
+    width, height = args.size
+    images = [makeImage(width, height) for _ in range(2)]
+    client.SendRequestNames(['_out'])
+    waitJob(client, client.QueuePrompt())
+
+    times = []
+    cpu = time.process_time()
+    for index in range(args.count):
+        start = time.perf_counter()
+        client.SendImages(['_D'], [images[index % 2]])
+        waitJob(client, client.QueuePrompt())
+        times.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu
+    disconnect(client)
+    return {'ops': args.count, 'times': times, 'cpu': cpu, 'bytes': len(images[0].data) * args.count}
+
+
+def benchSendBurst(args, port):
+    client = connect(args.backend, port, args.options)
+    width, height = args.size
+    images = [makeImage(width, height) for _ in range(2)]
+    client.SendRequestNames(['_out'])
+    waitJob(client, client.QueuePrompt())
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for index in range(args.count):
+        client.SendImages([f'_D{index}'], [images[index % 2]])
+    waitJob(client, client.QueuePrompt())
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    disconnect(client)
+    return {'ops': args.count, 'wall': wall, 'cpu': cpu, 'bytes': len(images[0].data) * args.count}
+
+
+def benchReceive(args, port):
+    received = []
+    on_image_received = lambda pack: received.append(len(pack['data']))
+    EventMan.Add('on_image_received', on_image_received)
+    client = connect(args.backend, port, args.options)
+    client.SendRequestNames(['_out'])
+    waitJob(client, client.QueuePrompt())
+    while not received:
+        EventMan.process_events()
+        time.sleep(0.0005)
+    received.clear()
+
+    times = []
+    cpu = time.process_time()
+    for index in range(args.count):
+        start = time.perf_counter()
+        waitJob(client, client.QueuePrompt())
+        # blender里是timer在主线程上处理的, 这里自己来; 解码是在后台线程里的, 要等它Trigger
+        while len(received) <= index:
+            EventMan.process_events()
+            time.sleep(0.0005)
+        times.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu
+    disconnect(client)
+    EventMan.Remove('on_image_received', on_image_received)
+    return {'ops': args.count, 'times': times, 'cpu': cpu, 'bytes': sum(received)}
+
+
+def benchRoundTrip(args, port):
+    client = connect(args.backend, port, args.options)
+    client.SendRequestNames(['_out'])
+    waitJob(client, client.QueuePrompt())
+
+    times = []
+    cpu = time.process_time()
+    for _ in range(args.trips):
+        start = time.perf_counter()
+        waitJob(client, client.QueuePrompt())
+        times.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu
+    disconnect(client)
+    return {'ops': args.trips, 'times': times, 'cpu': cpu}
+
+
+def benchGrouping(args, port):
+    client = connect(args.backend, port, args.options)
+    order = []
+    operation_steps = client.operation_steps
+
+    def record(operation):
+        # 在sender里, 开始跑一个op的时候; heartbeat不在哪一组里
+        if 'priority' not in operation:
+            return operation_steps(operation)
+        order.append((operation['priority'], operation['op'].__name__, operation['group_end']))
+        return operation_steps(operation)
+
+    client.operation_steps = record
+    client.SendRequestNames(['_out'])
+    waitJob(client, client.QueuePrompt())
+    del order[:]
+
+    image = makeImage(64, 64)
+    rounds = 5
+    cpu = time.process_time()
+    for _ in range(rounds):
+        client.SendImages(['_D'], [image], PRIORITY_BATCH)
+        time.sleep(0.02)
+        # 批量那一组已经开始发了, 交互的只能等它发完
+        client.SendImages(['_D'], [image])
+        client.SendRequestNames(['_out'])
+        interactive = client.QueuePrompt()
+        time.sleep(0.02)
+        client.SendRequestNames(['_out'], PRIORITY_BATCH)
+        batch = client.QueuePrompt(PRIORITY_BATCH)
+        waitJob(client, interactive)
+        waitJob(client, batch)
+    cpu = time.process_time() - cpu
+    disconnect(client)
+
+    interleaved = 0
+    group = None
+    for priority, name, group_end in order:
+        if group is not None and priority != group:
+            interleaved += 1
+        group = None if group_end else priority
+    return {'ops': len(order), 'cpu': cpu, 'check': interleaved == 0,
+            'detail': f'{interleaved} ops sent inside another priority\'s group'}
+
+
+def benchDrops(args, port):
+    client = connect(args.backend, port, args.options)
+    cpu = time.process_time()
+    jobs = []
+    for _ in range(args.count):
+        client.SendRequestNames(['_out'], PRIORITY_BATCH)
+        jobs.append(client.QueuePrompt(PRIORITY_BATCH))
+
+    hung = []
+    deadline = time.monotonic() + DROP_JOB_TIMEOUT
+    for job in jobs:
+        try:
+            waitJob(client, job, max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            hung.append(job)
+    cpu = time.process_time() - cpu
+    disconnect(client)
+    return {'ops': len(jobs), 'cpu': cpu, 'check': not hung,
+            'detail': f'{len(hung)} jobs never finished {hung}'}
+
+
+def benchDedupLru(args, port):
+    client = connect(args.backend, port, {**args.options, 'dedup': True, 'dedup_entries': 2})
+    images = {label: makeImage(64, 64) for label in 'ABC'}
+    client.SendRequestNames(['_out'])
+    cpu = time.process_time()
+    for label in 'ABACA':
+        client.SendImages([f'_{label}'], [images[label]])
+    waitJob(client, client.QueuePrompt())
+    cpu = time.process_time() - cpu
+    kept = imageDigest(images['A']) in client.image_index
+    stats = dict(client.dedup_stats)
+    disconnect(client)
+    return {'ops': 5, 'cpu': cpu, 'check': kept and stats['hits'] == 2,
+            'detail': f'A kept {kept}, {stats["hits"]} hits, {stats["sent"]} sent'}
+
+
+def benchRequeue(args, port):
+    client = connect(args.backend, port, args.options)
+    targets = []
+    on_job_image = client.on_job_image
+
+    def record(job_id, name):
+        target, finished = on_job_image(job_id, name)
+        targets.append(target)
+        return target, finished
+
+    client.on_job_image = record
+    finished = {}
+    end_job = client.end_job
+
+    def record_end(job_id, ok):
+        job = end_job(job_id, ok)
+        if job is not None:
+            finished[job_id] = ok
+        return job
+
+    client.end_job = record_end
+
+    cpu = time.process_time()
+    # 停掉的server由main里stopServer收尾, 这里起一个新的顶上
+    stopServer(args.servers[-1])
+    deadline = time.monotonic() + 10
+    while not client.info['isReconnecting']:
+        if time.monotonic() > deadline:
+            raise TimeoutError('the client did not notice the server was gone')
+        time.sleep(0.001)
+    client.SendRequestNames(['_out'], PRIORITY_BATCH)
+    job = client.QueuePrompt(PRIORITY_BATCH, None, {'_out': '_out.v1'})
+    tracked = job in client.jobs
+    process, _ = startServer(*serverArgs(args, 'requeue'), port=port)
+    args.servers.append(process)
+    try:
+        waitJob(client, job, DROP_JOB_TIMEOUT)
+    except TimeoutError:
+        pass
+    cpu = time.process_time() - cpu
+    disconnect(client)
+    ok = tracked and finished.get(job) is True and targets == ['_out.v1']
+    return {'ops': 1, 'cpu': cpu, 'check': ok,
+            'detail': f'tracked {tracked}, finished {finished.get(job)}, received {targets}'}
+
+
+BENCHES = {
+    'handshake': benchHandshake,
+    'send': benchSend,
+    'send_burst': benchSendBurst,
+    'receive': benchReceive,
+    'round_trip': benchRoundTrip,
+    'grouping': benchGrouping,
+    'drops': benchDrops,
+    'dedup_lru': benchDedupLru,
+    'requeue': benchRequeue,
+}
+
+
+def serverArgs(args, scenario):
+    extra = ['--steps', '0', '--latency', str(args.latency), '--bandwidth', str(args.bandwidth)]
+    if scenario == 'receive':
+        extra += ['--result-size', args.result_size, '--noise']
+    else:
+        extra += ['--result-size', '8x8']
+    if scenario == 'drops':
+        extra += ['--drop-every', str(DROP_EVERY)]
+    return extra
+
+
+def report(scenario, result, server_cpu):
+    ops = result['ops']
+    line = f'{scenario:11} {ops:5} ops'
+    if 'bytes' in result:
+        wall = result['wall'] if 'wall' in result else sum(result['times'])
+        line += f'  {result["bytes"] / wall / 1e6:9.1f} MB/s'
+    else:
+        line += ' ' * 16
+    if 'times' in result:
+        line += f'  p50 {percentile(result["times"], 0.5) * 1000:8.3f} ms  p99 {percentile(result["times"], 0.99) * 1000:8.3f} ms'
+    else:
+        line += ' ' * 34
+    if 'check' in result:
+        line += f'  {"ok" if result["check"] else "FAILED"}: {result["detail"]}'
+        print(line)
+        return
+    line += f'  client cpu {result["cpu"] / ops * 1000:7.3f} ms/op'
+    if server_cpu is not None:
+        line += f'  server cpu {server_cpu / ops * 1000:7.3f} ms/op'
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ComfyBridge client protocol benchmarks against the stand-in server')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='thread')
+    parser.add_argument('--only', default=','.join(SCENARIOS), help=f'comma separated, from: {", ".join(SCENARIOS)}')
+    parser.add_argument('--size', default='1920x1080', help='WxH of the RGBA8 images sent')
+    parser.add_argument('--count', type=int, default=20, help='images per send/receive scenario')
+    parser.add_argument('--result-size', default='1920x1080', help='WxH of the noise PNG received')
+    parser.add_argument('--handshakes', type=int, default=20)
+    parser.add_argument('--trips', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0, help='extra round trip time in ms on the server')
+    parser.add_argument('--bandwidth', type=float, default=0, help='MB/s in each direction on the server, 0 means unlimited')
+    parser.add_argument('--codec', default='none', help='codec for raw images, see protocol.CODECS')
+    parser.add_argument('--shared-memory', action='store_true', help='allow the same-host shared memory path')
+    parser.add_argument('--verbose', action='store_true', help='keep the client log')
+    args = parser.parse_args()
+    args.size = tuple(int(value) for value in args.size.lower().split('x'))
+    args.options = {'codec': args.codec, 'shared_memory': args.shared_memory, 'dedup': False}
+
+    print(
+        f'{args.backend} backend, send {args.size[0]}x{args.size[1]} RGBA8, receive {args.result_size} PNG, '
+        f'latency {args.latency} ms, bandwidth {args.bandwidth or "unlimited"} MB/s'
+    )
+    failed = False
+    for scenario in args.only.split(','):
+        process, port = startServer(*serverArgs(args, scenario))
+        # requeue会把server停掉再起一个, 最后全都停掉
+        args.servers = [process]
+        try:
+            # client连上断开都要打印, 20次握手就是一屏
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+                result = BENCHES[scenario](args, port)
+        finally:
+            server_cpu = stopServer(process)
+            for process in args.servers[1:]:
+                cpu = stopServer(process)
+                server_cpu = None if server_cpu is None or cpu is None else server_cpu + cpu
+        report(scenario, result, server_cpu)
+        failed = failed or result.get('check') is False
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+SEND_IMAGE用sendmsg一起发 和 以前每个buffer一次sendall 比一比
+只看线程版: asyncio那边的写是transport自己攒起来发的, 不归我们管
+系统调用是在python这层数的: sendall换成一次次send, 每次send/sendmsg算一次
+
+    python tools/bench_send_syscalls.py
+    python tools/bench_send_syscalls.py --images 4 --size 512x512 --count 200
+
+两项:
+    send        每次SendImages带images张图, 最后QueuePrompt等结果回来, 算每个op几次系统调用和MB/s
+    round trip  只QueuePrompt要一张8x8的图, 小消息会不会被Nagle压着
+before是没有sendmsg, 也不开TCP_NODELAY; after是现在的默认
+"""
+
+import argparse
+import contextlib
+import io
+import statistics
+import sys
+import time
+
+from bench_protocol import startServer, stopServer, disconnect, waitJob, percentile, makeImage, connect
+from comfybridge import bridge_thread
+
+MODES = {
+    'before': {'sendmsg': False, 'options': {'tcp_nodelay': False}},
+    'after': {'sendmsg': True, 'options': {}},
+}
+OPTIONS = {'codec': 'none', 'dedup': False, 'shared_memory': False}
+
+
+class CountingSocket:
+    """
+    包一层socket, 数往外写了几次
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while len(view):
+            sent = self.sock.send(view)
+            self.calls += 1
+            view = view[sent:]
+
+    def sendmsg(self, buffers, *args):
+        self.calls += 1
+        return self.sock.sendmsg(buffers, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def countingConnect(client):
+    connect_socket = client.connect_socket
+
+    def wrapped():
+        connected = connect_socket()
+        if connected:
+            client.client_socket = CountingSocket(client.client_socket)
+        return connected
+
+    client.connect_socket = wrapped
+
+
+def runMode(mode, args, port):
+    setting = MODES[mode]
+    bridge_thread.HAS_SENDMSG = setting['sendmsg'] and hasattr(bridge_thread.socket.socket, 'sendmsg')
+    # connect()里就start了, 要在那之前换掉connect_socket
+    start = bridge_thread.ThreadBridgeClient.start
+
+    def startCounting(client):
+        countingConnect(client)
+        start(client)
+
+    bridge_thread.ThreadBridgeClient.start = startCounting
+    try:
+        client = connect('thread', port, {**OPTIONS, **setting['options']})
+    finally:
+        bridge_thread.ThreadBridgeClient.start = start
+
+    width, height = args.size
+    images = [makeImage(width, height) for _ in range(args.images)]
+    names = [f'_D{index}' for index in range(args.images)]
+    client.SendRequestNames(['_out'])
+    waitJob(client, client.QueuePrompt())
+    client.SendImages(names, images)
+    waitJob(client, client.QueuePrompt())
+
+    calls = client.client_socket.calls
+    wall = time.perf_counter()
+    for _ in range(args.count):
+        client.SendImages(names, images)
+    waitJob(client, client.QueuePrompt())
+    wall = time.perf_counter() - wall
+    # 最后那个QueuePrompt也是一次, 不值得减掉
+    calls = client.client_socket.calls - calls
+
+    trips = []
+    for _ in range(args.trips):
+        start_at = time.perf_counter()
+        waitJob(client, client.QueuePrompt())
+        trips.append(time.perf_counter() - start_at)
+
+    result = {
+        'calls_per_op': calls / args.count,
+        'mb_per_s': sum(len(image.data) for image in images) * args.count / wall / 1e6,
+        'trip_p50_ms': statistics.median(trips) * 1000,
+        'trip_p99_ms': percentile(trips, 0.99) * 1000,
+    }
+    disconnect(client)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sendmsg + TCP_NODELAY vs one sendall per buffer')
+    parser.add_argument('--size', default='256x256', help='WxH of the RGBA8 images sent')
+    parser.add_argument('--images', type=int, default=4, help='images per SendImages')
+    parser.add_argument('--count', type=int, default=200, help='SendImages calls')
+    parser.add_argument('--trips', type=int, default=50)
+    args = parser.parse_args()
+    args.size = tuple(int(value) for value in args.size.lower().split('x'))
+
+    # tcp才有Nagle, 不让它换到unix socket
+    process, port = startServer('--result-size', '8x8', '--steps', '0', '--no-unix')
+    try:
+        print(f'{args.count} x SendImages({args.images} x {args.size[0]}x{args.size[1]} RGBA8), thread backend, tcp')
+        for mode in MODES:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = runMode(mode, args, port)
+            print(
+                f'{mode:6} {result["calls_per_op"]:7.1f} syscalls/op  {result["mb_per_s"]:8.1f} MB/s  '
+                f'round trip p50 {result["trip_p50_ms"]:.3f} ms  p99 {result["trip_p99_ms"]:.3f} ms'
+            )
+    finally:
+        stopServer(process)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,430 @@
+"""
+把插件抓下来的会话(偏好设置里的Capture File, 或者client的capture选项)照着再放一遍
+线上的情况(图多大, PROGRESS多密, heartbeat什么时候来)不用真的comfyUI和blender也能重现, 拿来比前后的性能
+
+    python tools/replay_capture.py session.cbcap                        # 看看录了些什么
+    python tools/replay_capture.py session.cbcap --play client          # 装成client, 把录的发给一个新起的stand-in
+    python tools/replay_capture.py session.cbcap --play client --port 17777   # 发给已经开着的comfyBridge
+    python tools/replay_capture.py session.cbcap --play server          # 装成comfyBridge, 把录的回给插件里真的client
+    python tools/replay_capture.py session.cbcap --play server --port 17777 --wait  # 等外面的client(比如blender)连上来
+    python tools/replay_capture.py session.cbcap --play server --fast   # 不按录的时间, 能多快发多快
+
+client: 录下来client发的每一帧按原来的时间(或者--fast一口气)发出去, 对面回的只数不管内容
+server: 握手那几个(HANDSHAKE, NEGOTIATE, RESUME, SHM_ATTACH)等client问了才回, 别的按原来的时间发
+        SHM_ATTACH一律回没attach上, 共享内存没法重放; 想重放图像的话抓的时候把Shared Memory关掉
+        v1的会话只能--play client, 不知道老client发的每种消息有多长
+一条录下来的连接对应重放的一条连接, 每条都从client的HANDSHAKE开始; 两边都放完了再等--idle秒收尾
+"""
+
+import argparse
+import collections
+import socket
+import sys
+import threading
+import time
+
+import _addon
+_addon.install_bpy_stub()
+from comfybridge.protocol import (
+    HANDSHAKE, NEGOTIATE, RESUME, SHM_ATTACH, RESPONSED_IMAGE, FRAME_HEADER, INCOMING_LAYOUTS, OPCODE_NAMES,
+    packInt, packString
+)
+from comfybridge.wire_capture import DIRECTION_SENT, DIRECTION_RECEIVED, openCapture, packRecord, recordSize
+
+# server这边要等client先问了才能回的
+GATED = (HANDSHAKE, NEGOTIATE, RESUME, SHM_ATTACH)
+# v1里server会回的消息, HANDSHAKE不带字段
+REPLY_LAYOUTS = {HANDSHAKE: (), **INCOMING_LAYOUTS}
+# client在切到v2之前发的
+REQUEST_LAYOUTS = {HANDSHAKE: (), NEGOTIATE: ('int', 'str')}
+
+
+def opName(opCode):
+    return OPCODE_NAMES.get(opCode, str(opCode))
+
+
+def splitConnections(records):
+    """
+    client每发一次HANDSHAKE就是一条新连接
+    """
+    connections = []
+    for record in records:
+        if not connections or (record.direction == DIRECTION_SENT and record.opCode == HANDSHAKE):
+            connections.append([])
+        connections[-1].append(record)
+    return connections
+
+
+# ------socket------
+def recvExactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError('connection closed')
+        received += count
+    return buffer
+
+
+def closeSocket(sock):
+    """
+    只close的话另一个线程还卡在recv里, 先shutdown叫醒它
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def readUnframed(sock, layouts):
+    """
+    v1的一条消息: opcode, 再按layout一个字段一个字段读; 返回(opcode, 一共几个字节)
+    """
+    opCode = int.from_bytes(recvExactly(sock, 4), 'big')
+    layout = layouts.get(opCode)
+    if layout is None:
+        raise ConnectionError(f'unknown v1 message {opCode}')
+    size = 4
+    for field in layout:
+        value = int.from_bytes(recvExactly(sock, 4), 'big')
+        size += 4
+        if field in ('str', 'blob'):
+            recvExactly(sock, value)
+            size += value
+        elif field == 'strs':
+            for _ in range(value):
+                length = int.from_bytes(recvExactly(sock, 4), 'big')
+                recvExactly(sock, length)
+                size += 4 + length
+    return opCode, size
+
+
+def readFrame(sock):
+    opCode, request_id, length = FRAME_HEADER.unpack(recvExactly(sock, FRAME_HEADER.size))
+    recvExactly(sock, length)
+    return opCode, FRAME_HEADER.size + length
+
+
+class Counter:
+    """
+    另一个线程读对面发来的, 这边只数: 每种opcode几个, 一共多少字节, 最后一个什么时候到的
+    """
+    def __init__(self, sock, layouts, unframed):
+        """
+        unframed: 开头有几条是v1格式的, None就是全是v1
+        """
+        self.sock = sock
+        self.layouts = layouts
+        self.unframed = unframed
+        self.counts = collections.Counter()
+        self.frames = 0
+        self.bytes = 0
+        self.last_at = time.perf_counter()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                if self.unframed is None or self.frames < self.unframed:
+                    opCode, size = readUnframed(self.sock, self.layouts)
+                else:
+                    opCode, size = readFrame(self.sock)
+                with self.condition:
+                    self.counts[opCode] += 1
+                    self.frames += 1
+                    self.bytes += size
+                    self.last_at = time.perf_counter()
+                    self.condition.notify_all()
+        except (ConnectionError, OSError):
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def wait_for(self, predicate, idle):
+        """
+        等到predicate成立, 或者对面idle秒都没动静, 或者断了
+        """
+        with self.condition:
+            while not predicate() and not self.closed:
+                remaining = self.last_at + idle - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return predicate()
+
+
+class Pacer:
+    """
+    speed是0的话不等, 不然按录的时间的1/speed倍发
+    """
+    def __init__(self, first, speed):
+        self.first = first
+        self.speed = speed
+        self.start = time.perf_counter()
+        self.late = 0.0
+
+    def wait(self, record):
+        if not self.speed:
+            return
+        due = self.start + (record.time - self.first) / self.speed
+        now = time.perf_counter()
+        if due > now:
+            time.sleep(due - now)
+        else:
+            self.late = max(self.late, now - due)
+
+
+def sendRecord(sock, record, payload=None):
+    if payload is not None:
+        record.payload = payload
+    sock.sendall(b''.join(packRecord(record)))
+    return recordSize(record)
+
+
+# ------summary------
+def summarize(meta, connections):
+    print(f'capture of {meta.get("backend", "?")} client to {meta.get("host")}:{meta.get("port")}, '
+          f'started {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta.get("started", 0)))}')
+    records = [record for connection in connections for record in connection]
+    if not records:
+        print('no frames')
+        return
+    duration = records[-1].time - records[0].time
+    elided = sum(record.elided for record in records)
+    print(f'{len(connections)} connections, {len(records)} frames over {duration:.3f} s'
+          + (f', {elided} with the payload cut down' if elided else ''))
+    for direction, label in ((DIRECTION_SENT, 'sent'), (DIRECTION_RECEIVED, 'received')):
+        counts = collections.Counter()
+        sizes = collections.Counter()
+        for record in records:
+            if record.direction == direction:
+                counts[record.opCode] += 1
+                sizes[record.opCode] += recordSize(record)
+        print(f'{label}:')
+        for opCode, count in counts.most_common():
+            print(f'    {opName(opCode):16} {count:7}  {sizes[opCode] / 1024 / 1024:10.2f} MB')
+
+
+# ------play client------
+def playClient(connections, host, port, speed, idle):
+    """
+    装成client把录的发出去, 返回(发了几帧, 发的字节, 收了几帧, 收的字节, 用了几秒, 最多比录的晚了几秒, 收到的每种几个)
+    """
+    sent_frames = sent_bytes = received_frames = received_bytes = 0
+    late = 0.0
+    received = collections.Counter()
+    skipped_shm = 0
+    start = time.perf_counter()
+    for connection in connections:
+        replies = [record for record in connection if record.direction == DIRECTION_RECEIVED]
+        legacy = not any(record.framed for record in connection)
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        counter = Counter(sock, REPLY_LAYOUTS, None if legacy else sum(not record.framed for record in replies))
+        pacer = Pacer(connection[0].time, speed)
+        try:
+            for record in connection:
+                if record.direction != DIRECTION_SENT:
+                    continue
+                if record.opCode == SHM_ATTACH:
+                    skipped_shm += 1
+                    continue
+                pacer.wait(record)
+                sent_bytes += sendRecord(sock, record)
+                sent_frames += 1
+            counter.wait_for(lambda: counter.frames >= len(replies), idle)
+        except (ConnectionError, OSError) as e:
+            print(f'connection closed by the server: {e}')
+        finally:
+            closeSocket(sock)
+            counter.thread.join()
+        late = max(late, pacer.late)
+        received_frames += counter.frames
+        received_bytes += counter.bytes
+        received.update(counter.counts)
+    if skipped_shm:
+        print(f'skipped {skipped_shm} SHM_ATTACH, shared memory images can not be replayed')
+    return sent_frames, sent_bytes, received_frames, received_bytes, time.perf_counter() - start, late, received
+
+
+# ------play server------
+def serveConnection(listener, connection, speed, idle):
+    """
+    等一个client连上来, 把这条连接里录的server发的按顺序回给它
+    """
+    sock, _ = listener.accept()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # client切到v2之前只发HANDSHAKE和NEGOTIATE
+    counter = Counter(sock, REQUEST_LAYOUTS, sum(not record.framed for record in connection if record.direction == DIRECTION_SENT))
+    pacer = Pacer(connection[0].time, speed)
+    asked = collections.Counter()
+    sent_frames = sent_bytes = 0
+    wall = 0.0
+    try:
+        for record in connection:
+            if record.direction == DIRECTION_SENT:
+                asked[record.opCode] += 1
+                continue
+            if record.opCode in GATED:
+                needed = asked[record.opCode]
+                if not counter.wait_for(lambda: counter.counts[record.opCode] >= needed, idle):
+                    print(f'client never sent {opName(record.opCode)}, stop this connection')
+                    break
+            pacer.wait(record)
+            payload = None
+            if record.opCode == SHM_ATTACH:
+                payload = b''.join([packInt(0), *packString('')])
+            sent_bytes += sendRecord(sock, record, payload)
+            sent_frames += 1
+        wall = time.perf_counter() - pacer.start
+        # 给client留点时间把最后的图收完
+        counter.wait_for(lambda: False, idle)
+    except (ConnectionError, OSError) as e:
+        print(f'connection closed by the client: {e}')
+    finally:
+        closeSocket(sock)
+        counter.thread.join()
+    return sent_frames, sent_bytes, counter.frames, counter.bytes, wall, pacer.late
+
+
+def playServer(connections, listener, speed, idle, result):
+    """
+    在另一个线程里跑, 放完了把统计放进result, 用了几秒只算到每条连接最后一帧发出去为止
+    """
+    totals = [0, 0, 0, 0, 0.0]
+    late = 0.0
+    for connection in connections:
+        *counts, connection_late = serveConnection(listener, connection, speed, idle)
+        totals = [total + count for total, count in zip(totals, counts)]
+        late = max(late, connection_late)
+    result.extend([*totals, late])
+
+
+def runClient(backend, port, done):
+    """
+    插件里真的client连到回放的server上, 收到的图照常解码, 返回(收到几张图, 图一共多少字节, 第一张到最后一张解完用了几秒)
+    """
+    from comfybridge.bridge_client import Connect_Info
+    from comfybridge.bridge_thread import ThreadBridgeClient
+    from comfybridge.bridge_asyncio import AsyncioBridgeClient
+    from comfybridge.event import EventMan
+
+    images = []
+
+    def on_image_received(pack):
+        images.append((time.perf_counter(), len(pack['data'])))
+
+    EventMan.Add('on_image_received', on_image_received)
+    EventMan.Add('on_progress', lambda args: None)
+    client_class = {'thread': ThreadBridgeClient, 'asyncio': AsyncioBridgeClient}[backend]
+    client = client_class('127.0.0.1', port, {'shared_memory': False, 'reconnect_delay': 0.05})
+    client.start()
+    first_at = None
+    while not done.is_set():
+        EventMan.process_events()
+        if first_at is None and RESPONSED_IMAGE in client.telemetry.opcodes:
+            first_at = time.perf_counter()
+        time.sleep(0.001)
+    EventMan.process_events()
+    client.stop()
+    Connect_Info['isClosing'] = False
+    EventMan.Remove('on_image_received', on_image_received)
+    if not images:
+        return 0, 0, 0.0
+    return len(images), sum(size for _, size in images), images[-1][0] - (first_at or images[0][0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a ComfyBridge wire capture against a server or a client')
+    parser.add_argument('capture', help='file written by the capture option')
+    parser.add_argument('--play', choices=('client', 'server'), help='which side to play back, leave out to just summarize')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='client: server to send to, 0 starts a stand-in; server: port to listen on')
+    parser.add_argument('--speed', type=float, default=1.0, help='times the recorded speed')
+    parser.add_argument('--fast', action='store_true', help='ignore the recorded timing, send as fast as possible')
+    parser.add_argument('--idle', type=float, default=2.0, help='seconds without traffic before a connection counts as done')
+    parser.add_argument('--backend', choices=('thread', 'asyncio'), help='server: client backend to run in process, defaults to the captured one')
+    parser.add_argument('--wait', action='store_true', help='server: wait for an outside client instead of running one')
+    args = parser.parse_args()
+    speed = 0 if args.fast else args.speed
+
+    meta, records = openCapture(args.capture)
+    connections = splitConnections(list(records))
+    if not args.play:
+        summarize(meta, connections)
+        return 0
+    if not connections:
+        print('no frames to replay')
+        return 1
+
+    direction = DIRECTION_SENT if args.play == 'client' else DIRECTION_RECEIVED
+    elided = sum(record.elided for connection in connections for record in connection if record.direction == direction)
+    if elided:
+        # 补0的图对面多半解不了, 压缩过的更是
+        print(f'{elided} frames were cut down when captured (capture_payload_limit), the other side may reject them')
+
+    if args.play == 'client':
+        process = None
+        port = args.port
+        if not port:
+            from bench_protocol import startServer
+            process, port = startServer()
+        try:
+            sent_frames, sent_bytes, received_frames, received_bytes, wall, late, received = playClient(
+                connections, args.host, port, speed, args.idle
+            )
+        finally:
+            if process is not None:
+                from bench_protocol import stopServer
+                stopServer(process)
+        recorded = collections.Counter(
+            record.opCode for connection in connections for record in connection if record.direction == DIRECTION_RECEIVED
+        )
+        print(f'sent {sent_frames} frames, {sent_bytes / 1024 / 1024:.2f} MB; '
+              f'received {received_frames} frames, {received_bytes / 1024 / 1024:.2f} MB in {wall:.3f} s'
+              + (f', at most {late * 1000:.1f} ms behind the recording' if speed else ''))
+        for opCode in sorted(set(recorded) | set(received)):
+            print(f'    {opName(opCode):16} {received[opCode]:7} received, {recorded[opCode]:7} recorded')
+        return 0
+
+    if not any(record.framed for connection in connections for record in connection):
+        print('v1 captures can only be played as the client')
+        return 1
+    listener = socket.create_server((args.host, args.port))
+    port = listener.getsockname()[1]
+    result = []
+    server = threading.Thread(target=playServer, args=(connections, listener, speed, args.idle, result), daemon=True)
+    server.start()
+    if args.wait:
+        print(f'waiting for a client on {args.host}:{port}')
+        server.join()
+        client_result = None
+    else:
+        done = threading.Event()
+        threading.Thread(target=lambda: (server.join(), done.set()), daemon=True).start()
+        client_result = runClient(args.backend or meta.get('backend') or 'thread', port, done)
+    listener.close()
+    if not result:
+        return 1
+
+    sent_frames, sent_bytes, received_frames, received_bytes, wall, late = result
+    print(f'sent {sent_frames} frames, {sent_bytes / 1024 / 1024:.2f} MB in {wall:.3f} s; '
+          f'received {received_frames} frames, {received_bytes / 1024 / 1024:.2f} MB'
+          + (f', at most {late * 1000:.1f} ms behind the recording' if speed else ''))
+    if client_result is not None:
+        images, image_bytes, span = client_result
+        line = f'client got {images} images, {image_bytes / 1024 / 1024:.2f} MB'
+        if images and span > 0:
+            line += f', {image_bytes / span / 1e6:.1f} MB/s from the first image frame to the last decoded'
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
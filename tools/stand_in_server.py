@@ -0,0 +1,654 @@
+"""
+假装自己是comfyUI那边的comfyBridge, 不用开comfyUI也能测client
+v1, v2, NEGOTIATE, 裸像素, IMAGE_REF去重, 共享内存都按插件这边的理解实现了一遍
+QUEUE_PROMPT不跑任何工作流, 发几个PROGRESS, 再把REQUEST_IMAGE要的图各回一张纯色PNG
+
+    python tools/stand_in_server.py --port 17777
+    python tools/stand_in_server.py --legacy        # 装成不认识NEGOTIATE的老版本
+    python tools/stand_in_server.py --drop-every 50 # 每收到50帧就故意断一次, 测重连
+    python tools/stand_in_server.py --stall-every 50 # 每50帧就装死, 不断开也不回, 测断线检测
+    python tools/stand_in_server.py --no-unix       # 共享内存照样用, 但不开unix socket
+    python tools/stand_in_server.py --latency 20 --bandwidth 100  # 装成隔着一段网络: 来回多20ms, 每个方向100MB/s
+    python tools/stand_in_server.py --result-size 2048x2048 --noise # 回的图是噪点, 压不小, 测下载
+    python tools/stand_in_server.py --step-time 200 # 每个PROGRESS隔200ms, 像真的在跑, 测CANCEL
+"""
+
+import argparse
+import os
+import queue
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import _addon
+from comfybridge import protocol
+from comfybridge.dedup import HashIndex
+from comfybridge.protocol import (
+    HANDSHAKE, HEARTBEAT, NEGOTIATE, RESUME, SHM_ATTACH,
+    SEND_IMAGE, REQUEST_IMAGE, QUEUE_PROMPT, RESPONSED_IMAGE, IMAGE_REF, IMAGE_MISS, IMAGE_CHUNK, CHUNK_ACK,
+    SHM_RELEASE, CANCEL, PROGRESS, ERROR, OK
+)
+from comfybridge.shm_ring import shared_memory
+
+# 不传--features的话, 能支持的全都支持
+SERVER_FEATURES = {
+    protocol.FEATURE_PIPELINE, protocol.FEATURE_RAW, protocol.FEATURE_DEDUP, protocol.FEATURE_CHUNKED,
+    protocol.FEATURE_RESUME, protocol.FEATURE_CANCEL, protocol.FEATURE_PARAMS,
+    *protocol.codecFeatures(protocol.CODECS)
+}
+if shared_memory is not None:
+    SERVER_FEATURES.add(protocol.FEATURE_SHM)
+
+# --bandwidth的时候一次收发这么多再去算要不要等
+THROTTLE_CHUNK = 64 * 1024
+
+
+# 用命令行单独跑的, 不是被测试脚本import进来和client在同一个进程里
+STANDALONE = False
+
+
+def attachSharedMemory(name):
+    """
+    共享内存是client建的, 也由它删; 这边只是attach,
+    不能让resource_tracker在这个进程退出时把它删了
+    和client在同一个进程里的话, 登记的就是client自己的那一份, 不能动
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    memory = shared_memory.SharedMemory(name=name)
+    if not STANDALONE:
+        return memory
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    except Exception:
+        pass
+    return memory
+
+
+def makePng(width, height, color=(128, 128, 128, 255), noise=False):
+    """
+    RGBA PNG, 只用zlib拼出来, client那边当普通图像收
+    默认纯色, 只有几百字节; noise=True是随机像素, 压不小, 大小和真的渲染结果差不多
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    if noise:
+        # 每行都不一样太慢了, 几行轮着用, zlib的窗口只有32K, 照样压不下去
+        rows = [b'\x00' + random.randbytes(width * 4) for _ in range(min(height, 16))]
+        pixels = b''.join(rows[y % len(rows)] for y in range(height))
+        data = zlib.compress(pixels, 1)
+    else:
+        data = zlib.compress((b'\x00' + bytes(color) * width) * height)
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', header)
+        + chunk(b'IDAT', data)
+        + chunk(b'IEND', b'')
+    )
+
+
+class Throttle:
+    """
+    --bandwidth用的令牌桶, 一个方向一个, 超了就sleep
+    """
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.allowance = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # 最多攒50ms的量, 不然闲了一会儿之后第一大块就不受限了
+            self.allowance = min(self.rate * 0.05, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SocketReader:
+    """
+    v1没有帧, 字段直接从socket上一个一个读, 方法名和PayloadReader保持一样
+    """
+    def __init__(self, sock, throttle=None):
+        self.sock = sock
+        self.throttle = throttle
+
+    def readBytes(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:], min(size - received, THROTTLE_CHUNK) if self.throttle else size - received)
+            if count == 0:
+                raise ConnectionError('connection closed by client')
+            received += count
+            if self.throttle is not None:
+                self.throttle.consume(count)
+        return buffer
+
+    def readInt(self):
+        return int.from_bytes(self.readBytes(4), byteorder='big')
+
+    def readString(self):
+        return self.readBytes(self.readInt()).decode('utf-8')
+
+    def readBlob(self):
+        return self.readBytes(self.readInt())
+
+    def readStrings(self):
+        return [self.readString() for _ in range(self.readInt())]
+
+
+class Session:
+    """
+    断线重连后还要接着用的东西, 没有RESUME的连接用的是一个匿名的
+    """
+    def __init__(self):
+        self.images = {}
+        self.request_names = []
+        # 这个session一共收到了多少帧
+        self.frames = 0
+        # client的共享内存, 重连后它会再发一次SHM_ATTACH
+        self.shm = None
+
+    def attach(self, name):
+        if self.shm is not None and self.shm.name.lstrip('/') == name.lstrip('/'):
+            return
+        self.detach()
+        self.shm = attachSharedMemory(name)
+
+    def detach(self):
+        if self.shm is not None:
+            try:
+                self.shm.close()
+            except (OSError, BufferError):
+                pass
+            self.shm = None
+
+
+class ServerConnection:
+    """
+    一个client一条连接, 一个线程从头读到尾
+    """
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.reader = SocketReader(sock, Throttle(server.bandwidth) if server.bandwidth else None)
+        self.send_throttle = Throttle(server.bandwidth) if server.bandwidth else None
+        self.protocol = protocol.PROTOCOL_V1
+        self.features = set()
+        self.writer_lock = threading.Lock()
+
+        self.session = Session()
+        # 这条连接上收到的帧数, drop_every用
+        self.messages = 0
+        # request_id -> 还没收完的分块消息, 断了就作废, client会整个重发
+        self.partial = {}
+        # --step-time的时候QUEUE_PROMPT排在这里, 一个线程一个一个跑, 读消息的线程才能收到CANCEL
+        self.prompts = None
+        self.cancelled = set()
+
+        self.handlers = {
+            HANDSHAKE: self.on_handshake,
+            NEGOTIATE: self.on_negotiate,
+            HEARTBEAT: self.on_heartbeat,
+            RESUME: self.on_resume,
+            SHM_ATTACH: self.on_shm_attach,
+            SEND_IMAGE: self.on_send_image,
+            IMAGE_REF: self.on_image_ref,
+            REQUEST_IMAGE: self.on_request_image,
+            QUEUE_PROMPT: self.on_queue_prompt,
+            CANCEL: self.on_cancel,
+        }
+
+    # ------收------
+    def read_message(self):
+        """
+        返回(opCode, request_id, reader), reader按消息的字段接着读
+        """
+        if self.protocol < protocol.PROTOCOL_V2:
+            opCode = self.reader.readInt()
+            self.drop_on_purpose()
+            return opCode, 0, self.reader
+
+        while True:
+            opCode, request_id, length = protocol.FRAME_HEADER.unpack(self.reader.readBytes(protocol.FRAME_HEADER.size))
+            if length > protocol.MAX_FRAME_SIZE:
+                raise ConnectionError(f'frame too large: {length}')
+            payload = self.reader.readBytes(length)
+            self.drop_on_purpose()
+            self.session.frames += 1
+            if opCode != IMAGE_CHUNK and request_id not in self.partial:
+                return opCode, request_id, protocol.PayloadReader(payload)
+
+            # 分块的: 先攒着, 每块都ACK, 等到原来的opcode那一块再拼起来
+            buffer = self.partial.setdefault(request_id, bytearray())
+            buffer += payload
+            self.server.count('chunks')
+            self.send(CHUNK_ACK, [protocol.packInt(len(buffer))], request_id)
+            if opCode != IMAGE_CHUNK:
+                return opCode, request_id, protocol.PayloadReader(self.partial.pop(request_id))
+
+    def drop_on_purpose(self):
+        """
+        --drop-every: 每收到N帧就断一次, 这一帧当作没收到, 看client会不会重发
+        --stall-every: 每收到N帧就再也不读不回, 连接也不断, 像是对面机器死了
+        """
+        self.messages += 1
+        if self.server.drop_every and self.messages % self.server.drop_every == 0:
+            print(f'[stand-in] dropping {self.address} on purpose')
+            self.server.count('drops')
+            raise ConnectionError('dropped on purpose')
+        if self.server.stall_every and self.messages % self.server.stall_every == 0:
+            print(f'[stand-in] stalling {self.address} on purpose')
+            self.server.count('stalls')
+            # client那边断开了也不管, 一直等到server停下
+            self.server.stopped.wait()
+            raise ConnectionError('stalled on purpose')
+
+    def serve(self):
+        try:
+            while self.server.running:
+                if self.server.latency > 0 and self.protocol >= protocol.PROTOCOL_V2:
+                    self.serve_delayed()
+                    return
+                opCode, request_id, reader = self.read_message()
+                if self.server.latency > 0:
+                    # 协商完之前都是一问一答, 直接等就行
+                    time.sleep(self.server.latency)
+                if not self.handle(opCode, request_id, reader):
+                    return
+        except (ConnectionError, OSError) as e:
+            pass
+        finally:
+            self.close()
+
+    def serve_delayed(self):
+        """
+        --latency: 一个线程只管读, 记下每帧到的时间, 这里到点了才处理
+        连着到的几帧不会越拖越久, 就像隔着一段网络
+        v2的帧自带长度才能这么做, v1的字段是handler自己从socket上读的
+        CHUNK_ACK是读的时候就回的, 不算在延迟里
+        """
+        arrivals = queue.Queue()
+
+        def read_loop():
+            try:
+                while self.server.running:
+                    message = self.read_message()
+                    arrivals.put((time.monotonic(), *message))
+            except (ConnectionError, OSError) as e:
+                pass
+            arrivals.put(None)
+
+        threading.Thread(target=read_loop, daemon=True).start()
+        while True:
+            item = arrivals.get()
+            if item is None:
+                return
+            arrived, opCode, request_id, reader = item
+            delay = arrived + self.server.latency - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not self.handle(opCode, request_id, reader):
+                return
+
+    def handle(self, opCode, request_id, reader):
+        """
+        返回False表示这条连接不要了
+        """
+        self.server.count('messages')
+        handler = self.handlers.get(opCode)
+        if handler is None or (opCode == NEGOTIATE and self.server.legacy):
+            # 老版本遇到不认识的就回ERROR, v2里带着request_id只算这一个请求失败
+            print(f'[stand-in] unknown operation: {opCode}')
+            self.send(ERROR, (), request_id)
+            return self.protocol >= protocol.PROTOCOL_V2
+        handler(request_id, reader)
+        return True
+
+    # ------发------
+    def send(self, opCode, parts=(), request_id=0):
+        if self.protocol >= protocol.PROTOCOL_V2:
+            buffers = protocol.packFrame(opCode, request_id, parts)
+        else:
+            buffers = [protocol.packInt(opCode), *parts]
+        data = b''.join(buffers)
+        with self.writer_lock:
+            if self.send_throttle is None:
+                self.sock.sendall(data)
+                return
+            view = memoryview(data)
+            for offset in range(0, len(view), THROTTLE_CHUNK):
+                piece = view[offset:offset + THROTTLE_CHUNK]
+                self.send_throttle.consume(len(piece))
+                self.sock.sendall(piece)
+
+    def close(self):
+        if self.prompts is not None:
+            self.prompts.put(None)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.server.forget(self)
+
+    # ------handlers------
+    def on_handshake(self, request_id, reader):
+        self.send(HANDSHAKE)
+
+    def on_negotiate(self, request_id, reader):
+        version = reader.readInt()
+        features = protocol.unpackFeatures(reader.readString())
+        # 回复还是用v1的格式, 发完才切到v2
+        self.send(NEGOTIATE, [
+            protocol.packInt(min(version, protocol.PROTOCOL_V2)),
+            *protocol.packString(protocol.packFeatures(features & self.server.features))
+        ])
+        self.protocol = min(version, protocol.PROTOCOL_V2)
+        self.features = features & self.server.features
+
+    def on_heartbeat(self, request_id, reader):
+        # 支持resume的话顺便告诉client收到了多少帧
+        self.send(HEARTBEAT, (), self.session.frames if protocol.FEATURE_RESUME in self.features else 0)
+
+    def on_resume(self, request_id, reader):
+        session_id = reader.readString()
+        session = self.server.sessions.get(session_id)
+        if session is None:
+            # RESUME自己不算, 从它后面开始数
+            self.session.frames = 0
+            self.server.sessions[session_id] = self.session
+        else:
+            self.session = session
+            self.server.count('resumes')
+        self.send(RESUME, [protocol.packInt(0 if session is None else 1), protocol.packInt(self.session.frames)], request_id)
+
+    def on_shm_attach(self, request_id, reader):
+        name = reader.readString()
+        size = reader.readInt()
+        try:
+            self.session.attach(name)
+            attached = self.session.shm.size >= size
+        except (OSError, ValueError) as e:
+            print(f'[stand-in] can not attach shared memory {name}: {e}')
+            attached = False
+        path = self.server.unix_path if attached and self.server.unix_path else ''
+        self.send(SHM_ATTACH, [protocol.packInt(1 if attached else 0), *protocol.packString(path)], request_id)
+
+    def read_shm_blob(self, blob):
+        """
+        共享内存里的图读出来就马上释放, client那边就能接着往里写
+        """
+        offset, length = protocol.unpackShmRef(blob)
+        data = bytes(self.session.shm.buf[offset:offset + length])
+        self.send(SHM_RELEASE, [protocol.packInt(1)])
+        self.server.count('shm_images')
+        return data
+
+    def on_send_image(self, request_id, reader):
+        with_digest = protocol.FEATURE_DEDUP in self.features
+        for _ in range(reader.readInt()):
+            name = reader.readString()
+            blob = bytes(reader.readBlob())
+            if protocol.isShmRef(blob) and self.session.shm is not None:
+                blob = self.read_shm_blob(blob)
+            if protocol.isRawImage(blob):
+                # 解一遍, 格式不对的话这里就会抛出来
+                protocol.unpackRawImage(blob)
+                self.server.count('raw_images')
+            self.session.images[name] = blob
+            self.server.count('images')
+            self.server.count('image_bytes', len(blob))
+            if with_digest:
+                digest = bytes(reader.readBlob())
+                self.server.image_store.add(digest, len(blob), blob)
+
+    def on_image_ref(self, request_id, reader):
+        missed = []
+        for _ in range(reader.readInt()):
+            name = reader.readString()
+            digest = bytes(reader.readBlob())
+            blob = self.server.image_store.get(digest)
+            if blob is None:
+                missed.append(name)
+                self.server.count('dedup_misses')
+            else:
+                self.session.images[name] = blob
+                self.server.count('dedup_hits')
+
+        parts = [protocol.packInt(len(missed))]
+        for name in missed:
+            parts += protocol.packString(name)
+        self.send(IMAGE_MISS, parts, request_id)
+
+    def on_request_image(self, request_id, reader):
+        self.session.request_names = reader.readStrings()
+
+    def on_queue_prompt(self, request_id, reader):
+        self.server.count('prompts')
+        if protocol.FEATURE_PARAMS in self.features and reader.readString():
+            # 不跑工作流, 参数只数一下
+            self.server.count('params')
+        names = list(self.session.request_names)
+        if self.server.step_time <= 0:
+            self.run_prompt(request_id, names)
+            return
+        if self.prompts is None:
+            self.prompts = queue.Queue()
+            threading.Thread(target=self.prompt_loop, daemon=True).start()
+        self.prompts.put((request_id, names))
+
+    def prompt_loop(self):
+        try:
+            while True:
+                item = self.prompts.get()
+                if item is None:
+                    return
+                self.run_prompt(*item)
+        except (ConnectionError, OSError) as e:
+            pass
+
+    def run_prompt(self, request_id, names):
+        steps = self.server.progress_steps
+        for step in range(1, steps + 1):
+            if request_id in self.cancelled:
+                self.server.count('interrupted')
+                return
+            time.sleep(self.server.step_time)
+            self.send(PROGRESS, [protocol.packInt(step), protocol.packInt(steps)], request_id)
+
+        width, height = self.server.result_size
+        for name in names:
+            if name == 'None' or request_id in self.cancelled:
+                continue
+            self.send(RESPONSED_IMAGE, [
+                *protocol.packString(name),
+                *protocol.packBlob(self.server.result_image(width, height)),
+                protocol.packInt(OK)
+            ], request_id)
+
+    def on_cancel(self, request_id, reader):
+        self.server.count('cancels')
+        self.cancelled.add(reader.readInt())
+
+
+class StandInServer:
+    def __init__(self, host='127.0.0.1', port=17777, legacy=False, features=None,
+                 result_size=(512, 512), progress_steps=4, drop_every=0, stall_every=0,
+                 store_entries=256, store_bytes=1024 * 1024 * 1024, unix=True,
+                 latency=0.0, bandwidth=0, noise=False, step_time=0.0):
+        self.host = host
+        self.port = port
+        self.legacy = legacy
+        self.features = set() if legacy else set(SERVER_FEATURES if features is None else features)
+        self.result_size = result_size
+        self.progress_steps = progress_steps
+        self.drop_every = drop_every
+        self.stall_every = stall_every
+        # 秒, 每条消息到了之后晚这么久才处理
+        self.latency = latency
+        # 字节/秒, 每个方向, 0是不限
+        self.bandwidth = bandwidth
+        self.noise = noise
+        # 秒, 每个PROGRESS之间隔多久, 0就是收到QUEUE_PROMPT马上回完
+        self.step_time = step_time
+        self.stopped = threading.Event()
+        # session id -> Session
+        self.sessions = {}
+
+        # digest -> 图像, 所有连接共用, client断了重连也还在
+        self.image_store = HashIndex(store_entries, store_bytes)
+        self.png_cache = {}
+
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.connections = set()
+        self.listen_socket = None
+        self.accept_thread = None
+        # 用共享内存的client握手后会换到这个unix socket上来
+        self.unix = unix and protocol.FEATURE_SHM in self.features and hasattr(socket, 'AF_UNIX')
+        self.unix_path = ''
+        self.unix_socket = None
+        self.unix_thread = None
+        self.running = False
+
+    def start(self):
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((self.host, self.port))
+        self.listen_socket.listen()
+        # port=0的时候由系统挑一个
+        self.port = self.listen_socket.getsockname()[1]
+        self.running = True
+        self.accept_thread = threading.Thread(target=self.accept_loop, args=(self.listen_socket,), daemon=True)
+        self.accept_thread.start()
+
+        if self.unix:
+            self.unix_path = os.path.join(tempfile.gettempdir(), f'comfybridge-stand-in-{self.port}.sock')
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_socket.bind(self.unix_path)
+            self.unix_socket.listen()
+            self.unix_thread = threading.Thread(target=self.accept_loop, args=(self.unix_socket,), daemon=True)
+            self.unix_thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        for listen_socket in (self.listen_socket, self.unix_socket):
+            if listen_socket is None:
+                continue
+            try:
+                # 和client那边一样, 光close叫不醒阻塞在accept里的线程
+                listen_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                listen_socket.close()
+            except OSError:
+                pass
+        self.drop_connections()
+        for thread in (self.accept_thread, self.unix_thread):
+            if thread is not None:
+                thread.join()
+        self.accept_thread = None
+        self.unix_thread = None
+        if self.unix_path and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+        for session in self.sessions.values():
+            session.detach()
+
+    def accept_loop(self, listen_socket):
+        while self.running:
+            try:
+                sock, address = listen_socket.accept()
+            except OSError:
+                return
+            connection = ServerConnection(self, sock, address)
+            self.connections.add(connection)
+            self.count('connections')
+            threading.Thread(target=connection.serve, daemon=True).start()
+
+    def drop_connections(self):
+        """
+        所有连接都断掉, 模拟网络出问题
+        """
+        for connection in list(self.connections):
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def forget(self, connection):
+        self.connections.discard(connection)
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def result_image(self, width, height):
+        key = (width, height)
+        if key not in self.png_cache:
+            self.png_cache[key] = makePng(width, height, noise=self.noise)
+        return self.png_cache[key]
+
+
+def main():
+    global STANDALONE
+    STANDALONE = True
+    parser = argparse.ArgumentParser(description='stand-in ComfyBridge server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=17777)
+    parser.add_argument('--legacy', action='store_true', help='v1 only, answer NEGOTIATE with ERROR like old versions')
+    parser.add_argument('--features', default=None, help='comma separated, default: everything')
+    parser.add_argument('--result-size', default='512x512', help='WxH of the images sent back')
+    parser.add_argument('--steps', type=int, default=4, help='PROGRESS messages per prompt')
+    parser.add_argument('--drop-every', type=int, default=0, help='drop the connection every N frames')
+    parser.add_argument('--stall-every', type=int, default=0, help='stop reading and replying every N frames')
+    parser.add_argument('--no-unix', action='store_true', help='do not offer a unix socket to same-host clients')
+    parser.add_argument('--latency', type=float, default=0, help='extra round trip time in ms')
+    parser.add_argument('--bandwidth', type=float, default=0, help='MB/s in each direction, 0 means unlimited')
+    parser.add_argument('--noise', action='store_true', help='send back incompressible noise instead of flat PNGs')
+    parser.add_argument('--step-time', type=float, default=0, help='ms between PROGRESS messages, prompts run one at a time')
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.result_size.lower().split('x'))
+    features = None if args.features is None else protocol.unpackFeatures(args.features)
+    server = StandInServer(
+        args.host, args.port, args.legacy, features, (width, height), args.steps, args.drop_every, args.stall_every,
+        unix=not args.no_unix, latency=args.latency / 1000, bandwidth=int(args.bandwidth * 1e6), noise=args.noise,
+        step_time=args.step_time / 1000
+    ).start()
+    print(f'[stand-in] listening on {server.host}:{server.port}, features: {protocol.packFeatures(server.features) or "-"}')
+    if server.unix_path:
+        print(f'[stand-in] unix socket: {server.unix_path}')
+    try:
+        server.accept_thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f'[stand-in] {server.stats}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+把client收发的每一帧连同时间记到文件里, 之后用tools/replay_capture.py照着再放一遍
+收发线程上只把payload复制一份丢进队列, 压缩和写文件在单独的线程里做, 不拖慢收发
+
+文件: CAPTURE_MAGIC, 版本, 一个JSON的meta(host, port, backend, 开始的时间), 然后一条接一条:
+    CAPTURE_RECORD: 方向, flags, 从开始过了几秒, opcode, request_id, payload原长, 后面跟着的字节数
+    再跟着payload(可能压缩过, 可能只留了头尾)
+每条连接都从client发的HANDSHAKE开始, 重连和换transport都能从这里分开
+"""
+
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from .protocol import FRAME_HEADER, packInt, packFrame
+
+CAPTURE_MAGIC = b'CBCP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('>4sBI')
+CAPTURE_RECORD = struct.Struct('>BBdIIII')
+
+DIRECTION_SENT = 0
+DIRECTION_RECEIVED = 1
+
+FLAG_FRAMED = 1       # v2的帧, 不是的话就是v1裸着发的 opcode + payload
+FLAG_COMPRESSED = 2   # 存的是zlib压过的
+FLAG_ELIDED = 4       # payload太大只留了头尾, 中间放回去的时候补0
+# 只留头尾的时候尾巴留这么多, 图像消息最后的OK, digest之类在这里面
+ELIDED_TAIL = 64
+# 比这小的不值得压
+COMPRESS_MIN = 1024
+# 还没写进文件的最多攒这么多字节, 磁盘跟不上的话新来的就扔掉, 不让内存一直涨
+# 按字节不按条数: 一阵控制消息很多但都很小, 一张图就能有几十M
+QUEUE_LIMIT = 256 * 1024 * 1024
+
+
+class CaptureRecord:
+    def __init__(self, direction, time, opCode, request_id, payload, framed=True, elided=False):
+        self.direction = direction
+        self.time = time
+        self.opCode = opCode
+        self.request_id = request_id
+        self.payload = payload
+        self.framed = framed
+        # 原来的payload比存下来的长, 中间的已经补成0了
+        self.elided = elided
+
+
+def headAndTail(parts, head_size, tail_size):
+    """
+    一串parts拼起来的前head_size和最后tail_size字节, 不把整串拼起来
+    """
+    views = [memoryview(part).cast('B') for part in parts if len(part)]
+    head = bytearray()
+    for view in views:
+        if len(head) >= head_size:
+            break
+        head += view[:head_size - len(head)]
+    tail = bytearray()
+    for view in reversed(views):
+        if len(tail) >= tail_size:
+            break
+        tail[:0] = view[max(0, len(view) - (tail_size - len(tail))):]
+    return bytes(head + tail)
+
+
+class WireCapture:
+    """
+    payload_limit: payload比这大的只留头尾, 0是全都留着
+    文件在构造的时候就打开, 打不开(目录不存在, 没权限)直接抛OSError, 不等到写的线程里才发现
+    """
+    def __init__(self, path, payload_limit=0, meta=None):
+        self.path = path
+        self.payload_limit = payload_limit
+        self.meta = {**(meta or {}), 'started': time.time()}
+        self.started = time.monotonic()
+        self.queue = queue.Queue()
+        # 在队列里还没写的字节数
+        self.queued_bytes = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.closed = False
+        # 队列满了扔掉的条数, 有的话这份记录放不全
+        self.dropped = 0
+
+        meta = json.dumps(self.meta).encode('utf-8')
+        self.file = open(path, 'wb')
+        try:
+            self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, len(meta)))
+            self.file.write(meta)
+        except OSError:
+            self.file.close()
+            raise
+
+    def sent(self, opCode, request_id, parts, framed):
+        self.record(DIRECTION_SENT, opCode, request_id, parts, framed)
+
+    def received(self, opCode, request_id, parts, framed):
+        self.record(DIRECTION_RECEIVED, opCode, request_id, parts, framed)
+
+    def record(self, direction, opCode, request_id, parts, framed):
+        """
+        收发线程里调用, 只复制要留下的字节
+        """
+        if self.closed:
+            return
+        elapsed = time.monotonic() - self.started
+        length = sum(len(part) for part in parts)
+        flags = FLAG_FRAMED if framed else 0
+        if self.payload_limit and length > self.payload_limit:
+            flags |= FLAG_ELIDED
+            tail = min(ELIDED_TAIL, self.payload_limit)
+            stored = headAndTail(parts, self.payload_limit - tail, tail)
+        else:
+            stored = b''.join(parts)
+
+        with self.lock:
+            if self.closed:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if self.queued_bytes + len(stored) > QUEUE_LIMIT:
+                self.dropped += 1
+                if self.dropped == 1:
+                    print(f'~~~~~~~~~capture can not keep up, dropping records: {self.path}')
+                return
+            self.queued_bytes += len(stored)
+            self.queue.put((direction, flags, elapsed, opCode, request_id, length, stored))
+
+    def close(self):
+        """
+        已经记下的都写完才返回
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            thread = self.thread
+        if thread is None:
+            self.file.close()
+            return
+        self.queue.put(None)
+        thread.join()
+
+    def run(self):
+        file = self.file
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                direction, flags, elapsed, opCode, request_id, length, stored = item
+                with self.lock:
+                    self.queued_bytes -= len(stored)
+                if len(stored) >= COMPRESS_MIN:
+                    compressed = zlib.compress(stored, 1)
+                    # 省不到1/8的(比如噪点, 已经压过的PNG)就不压了, 读的时候也省事
+                    if len(compressed) < len(stored) - len(stored) // 8:
+                        stored = compressed
+                        flags |= FLAG_COMPRESSED
+                file.write(CAPTURE_RECORD.pack(direction, flags, elapsed, opCode, request_id, length, len(stored)))
+                file.write(stored)
+        except Exception as e:
+            # 比如磁盘满了; 之后record的都不要了
+            print(f'~~~~~~~~~capture {self.path} failed:{e}')
+            with self.lock:
+                self.closed = True
+                # 排着的都不会写了, 别让它们占着内存
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queued_bytes = 0
+        finally:
+            file.close()
+
+
+def openCapture(path):
+    """
+    返回(meta, records), records是按时间顺序的CaptureRecord的generator
+    """
+    file = open(path, 'rb')
+    magic, version, meta_size = CAPTURE_HEADER.unpack(file.read(CAPTURE_HEADER.size))
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        file.close()
+        raise ValueError(f'{path} is not a ComfyBridge capture')
+    meta = json.loads(file.read(meta_size).decode('utf-8'))
+
+    def records():
+        with file:
+            while True:
+                header = file.read(CAPTURE_RECORD.size)
+                if len(header) < CAPTURE_RECORD.size:
+                    # 没正常close的话最后一条可能写了一半
+                    return
+                direction, flags, elapsed, opCode, request_id, length, size = CAPTURE_RECORD.unpack(header)
+                stored = file.read(size)
+                if len(stored) < size:
+                    return
+                if flags & FLAG_COMPRESSED:
+                    stored = zlib.decompress(stored)
+                if flags & FLAG_ELIDED:
+                    tail = min(ELIDED_TAIL, len(stored))
+                    stored = stored[:len(stored) - tail] + bytes(length - len(stored)) + stored[len(stored) - tail:]
+                yield CaptureRecord(
+                    direction, elapsed, opCode, request_id, stored,
+                    framed=bool(flags & FLAG_FRAMED), elided=bool(flags & FLAG_ELIDED)
+                )
+
+    return meta, records()
+
+
+def packRecord(record):
+    """
+    按录下来的样子再拼回线上的字节
+    """
+    if record.framed:
+        return packFrame(record.opCode, record.request_id, [record.payload])
+    return [packInt(record.opCode), record.payload]
+
+
+def recordSize(record):
+    return (FRAME_HEADER.size if record.framed else 4) + len(record.payload)